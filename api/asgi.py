@@ -0,0 +1,499 @@
+"""非同期 (ASGI) で動かすためのエントリポイント
+
+Gemini や Fish Audio を待つ間にワーカースレッドを占有しないよう、
+外部APIを呼ぶルート (/api/chat, /api/chat/stream, /api/tts, /api/tts/stream) は
+非同期クライアントを使う Quart のハンドラで処理する。
+音声入力の WebSocket (/api/stt/stream) も Quart で受け付ける。
+それ以外のルートは index.py の Flask アプリをそのままスレッドプールで動かす。
+
+実行方法:
+    pip install -r requirements-asgi.txt
+    python api/asgi.py
+    # または hypercorn api.asgi:app --bind 0.0.0.0:5000
+"""
+import asyncio
+import json
+import os
+import time
+
+import httpx
+from google.genai import types as genai_types
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, Response, jsonify, request, websocket
+
+try:
+    import index
+except ModuleNotFoundError:
+    # リポジトリのルートから hypercorn api.asgi:app で起動した場合
+    from api import index
+
+logger = index.logger
+
+async_app = Quart(__name__)
+
+# Flaskアプリに渡すリクエストボディの上限 (ペルソナ追加時のファイルアップロード用)
+WSGI_MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# 非同期ハンドラで処理するルート (それ以外はFlaskアプリに渡す)
+ASYNC_ROUTES = {"/api/chat", "/api/chat/stream", "/api/tts", "/api/tts/stream"}
+
+# Fish Audio 用の共有HTTPクライアント (before_serving で作成する)
+http_client = None
+
+@async_app.before_serving
+async def start_http_client():
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(index.FISH_AUDIO_TIMEOUT, connect=5.0),
+        limits=httpx.Limits(max_connections=256, max_keepalive_connections=64)
+    )
+    # 常駐サーバーでは最初のチャットを待たせないよう、起動時にGeminiクライアントを作っておく
+    await asyncio.to_thread(index.get_genai_client)
+    # 最初の音声合成で接続を待たないよう、Fish Audio への接続も開いておく (起動は待たせない)
+    async_app.add_background_task(warm_tts_connections_async)
+
+async def warm_tts_connections_async():
+    """index.warm_tts_connections() の非同期版 (httpx のクライアントの接続プールに接続を開いておく)"""
+    if not index.FISH_AUDIO_TOKEN or index.TTS_WARM_CONNECTIONS <= 0:
+        return
+
+    async def connect():
+        try:
+            await http_client.head(index.FISH_AUDIO_API_URL, timeout=index.fish_audio_upstream.connect_timeout)
+        except httpx.HTTPError as e:
+            logger.debug(f"Fish Audio への接続を開けませんでした: {e}")
+
+    await asyncio.gather(*(connect() for _ in range(index.TTS_WARM_CONNECTIONS)))
+
+@async_app.after_serving
+async def close_http_client():
+    await http_client.aclose()
+
+# --------------------------
+# Gemini 呼び出し (非同期版)
+# --------------------------
+
+async def generate_gemini_content_async(deadline=None, **kwargs):
+    """index.generate_gemini_content() の非同期版 (同じ Upstream で再試行・期限・サーキットブレーカーを共有する)"""
+    client = index.get_genai_client()
+    if not client:
+        raise Exception("Geminiクライアントが初期化されていません。APIキーを確認してください。")
+    config = kwargs.pop("config", None) or genai_types.GenerateContentConfig()
+
+    async def send(timeout):
+        http_options = genai_types.HttpOptions(timeout=int(timeout * 1000))
+        return await client.aio.models.generate_content(
+            config=config.model_copy(update={"http_options": http_options}), **kwargs
+        )
+
+    return await index.gemini_upstream.acall(send, deadline=deadline)
+
+# --------------------------
+# Fish Audio 呼び出し (非同期版)
+# --------------------------
+
+async def get_ada_voice_async(text: str, voice=None):
+    """get_ada_voice() の非同期版 (キャッシュも共有する)"""
+    logger.debug("🎤 音声生成を開始します...")
+    if not index.FISH_AUDIO_TOKEN:
+        logger.warning("Fish Audio token が設定されていません。")
+        return None
+
+    voice = voice or index.VoiceSettings()
+    cache_key = index.tts_cache_key(text, voice)
+    # ディスクやBlobを読む可能性があるためスレッドで実行する
+    cached = await asyncio.to_thread(index.tts_cache.get, cache_key)
+    if cached is not None:
+        logger.debug("✅ 音声キャッシュを使用しました")
+        return cached
+
+    headers = {
+        "Authorization": f"Bearer {index.FISH_AUDIO_TOKEN}",
+        "Content-Type": "application/json"
+    }
+    data = voice.request_body(text)
+
+    async def send(timeout):
+        r = await http_client.post(index.FISH_AUDIO_API_URL, headers=headers, json=data, timeout=timeout)
+        r.raise_for_status()
+        return r
+
+    async def synthesize():
+        # 同期版と同じ Upstream を使い、再試行・期限・サーキットブレーカーと統計を共有する
+        with index.span("tts"):
+            r = await index.fish_audio_upstream.acall(send, deadline=index.upstream.Deadline(index.TTS_DEADLINE))
+        logger.debug("✅ 音声生成完了")
+        await asyncio.to_thread(index.tts_cache.put, cache_key, r.content)
+        return r.content
+
+    try:
+        # 同じボイス・同じテキストの合成が実行中なら、その結果を待って受け取る
+        # (待っている呼び出し元がすべてキャンセルされた場合だけ合成を中断する)
+        return await index.tts_flight.ado(cache_key, synthesize)
+    except index.upstream.UpstreamError as e:
+        logger.warning(f"⚠️ Fish Audio API を呼び出せません: {e}")
+        return None
+    except httpx.HTTPError as e:
+        logger.error(f"❌ Fish Audio API エラー: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"❌ 音声生成中に予期せぬエラー: {e}")
+        return None
+
+async def synthesize_sentences_async(sentences, voice=None):
+    """synthesize_sentences() の非同期版 (同時に合成するのは TTS_CONCURRENCY 件まで)"""
+    window = max(1, index.TTS_CONCURRENCY)
+    tasks = [asyncio.create_task(get_ada_voice_async(sentence, voice)) for sentence in sentences[:window]]
+    next_index = len(tasks)
+    try:
+        while tasks:
+            audio = await tasks.pop(0)
+            if next_index < len(sentences):
+                tasks.append(asyncio.create_task(get_ada_voice_async(sentences[next_index], voice)))
+                next_index += 1
+            if audio:
+                yield audio
+    finally:
+        # クライアント切断時などは残りの合成をキャンセルする
+        for task in tasks:
+            task.cancel()
+
+# --------------------------
+# エンドポイント (非同期版)
+# --------------------------
+
+# 会話セッション・応答キャッシュ・Markdown の変換は同期処理 (ロックやファイルの読み書きを含む) のため、
+# イベントループを止めないよう以下の関数をまとめてスレッドで実行する
+
+def load_session(session_id, personality_name, prompt):
+    """セッションIDを確定し、(session_id, 会話履歴) を返す"""
+    session_id = index.chat_sessions.resolve_id(session_id)
+    history = index.chat_sessions.get_history(session_id, personality_name) if prompt else []
+    return session_id, history
+
+async def parse_chat(d):
+    """チャットのリクエストボディから (prompt, personality, session_id, history) を取り出す"""
+    prompt = d.get("prompt", "").strip()
+    personality_name = d.get("personality", "Default Assistant") # デフォルト値
+    session_id, history = await asyncio.to_thread(load_session, d.get("session_id"), personality_name, prompt)
+    return prompt, personality_name, session_id, history
+
+def lookup_cached_response(personality_name, prompt, session_id, history):
+    """応答キャッシュを引き、ヒットした場合は会話履歴に追加して (キー, 応答) を返す"""
+    cache_key = index.chat_response_cache_key(personality_name, prompt, history)
+    cached = index.chat_response_cache.get(cache_key)
+    if cached is not None:
+        index.chat_sessions.append(session_id, personality_name, prompt, cached["text"])
+        logger.debug("✅ 応答キャッシュを使用しました。")
+    return cache_key, cached
+
+def save_response(cache_key, personality_name, prompt, session_id, md_text, render_html):
+    """応答を変換して会話履歴と応答キャッシュに保存し、(html, plain) を返す"""
+    with index.span("markdown_render"):
+        html_content = render_html()
+        plain_text = index.markdown_to_plaintext(md_text)
+    index.chat_sessions.append(session_id, personality_name, prompt, md_text)
+    index.chat_response_cache.put(cache_key, md_text, html_content, plain_text)
+    return html_content, plain_text
+
+def feed_chunk(md_stream, speech_normalizer, text):
+    """ストリーミングのチャンクを変換し、delta イベントのデータを返す"""
+    fragment, pending = md_stream.feed(text)
+    speech = index.split_speech_sentences(speech_normalizer.feed(text))
+    return {"text": text, "html": fragment, "pending": pending, "speech": speech}
+
+@async_app.route("/api/chat", methods=['POST'])
+async def api_chat():
+    """index.api_chat() の非同期版"""
+    logger.debug("💬 /api/chat がリクエストされました。(async)")
+    genai_client = index.get_genai_client()
+    if not genai_client:
+        return jsonify({"error": "Geminiクライアントが初期化されていません。APIキーを確認してください。"}), 500
+
+    d = await request.get_json(force=True, silent=True) or {}
+    prompt, personality_name, session_id, history = await parse_chat(d)
+    if not prompt:
+        return jsonify({"error": "プロンプトが空です。"}), 400
+
+    cache_key, cached = await asyncio.to_thread(lookup_cached_response, personality_name, prompt, session_id, history)
+    if cached is not None:
+        return jsonify({"html": cached["html"], "plain": cached["plain"], "session_id": session_id, "cached": True})
+    try:
+        # コンテキストキャッシュの作成は同期処理のためスレッドで実行する
+        contents, config = await asyncio.to_thread(index.build_chat_request, personality_name, prompt, history)
+        with index.span("llm"):
+            response = await generate_gemini_content_async(
+                model=index.GEMINI_MODEL,
+                contents=contents,
+                config=config,
+                deadline=index.upstream.Deadline(index.CHAT_DEADLINE)
+            )
+        md_text = getattr(response, "text", str(response))
+        html_content, plain_text = await asyncio.to_thread(
+            save_response, cache_key, personality_name, prompt, session_id, md_text,
+            lambda: index.markdown_to_html(md_text)
+        )
+        logger.debug("✅ チャット応答生成完了。")
+        return jsonify({"html": html_content, "plain": plain_text, "session_id": session_id})
+    except Exception as e:
+        logger.error(f"❌ Gemini API エラー: {e}")
+        return jsonify({"error": f"Gemini API エラー: {e}"}), 500
+
+@async_app.route("/api/chat/stream", methods=['POST'])
+async def api_chat_stream():
+    """index.api_chat_stream() の非同期版 (イベントの形式は同じ)"""
+    logger.debug("💬 /api/chat/stream がリクエストされました。(async)")
+    genai_client = index.get_genai_client()
+    if not genai_client:
+        return jsonify({"error": "Geminiクライアントが初期化されていません。APIキーを確認してください。"}), 500
+
+    d = await request.get_json(force=True, silent=True) or {}
+    prompt, personality_name, session_id, history = await parse_chat(d)
+    if not prompt:
+        return jsonify({"error": "プロンプトが空です。"}), 400
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    events = chat_stream_events_async(genai_client, personality_name, prompt, session_id, history)
+
+    async def generate():
+        async for event, data in events:
+            yield index.sse_event(event, data)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers=sse_headers
+    )
+
+async def chat_stream_events_async(genai_client, personality_name, prompt, session_id, history):
+    """index.chat_stream_events() の非同期版 ((イベント名, データ) の組を返す)"""
+    cache_key, cached = await asyncio.to_thread(lookup_cached_response, personality_name, prompt, session_id, history)
+    if cached is not None:
+        yield "done", index.cached_chat_done(cached, session_id)
+        return
+
+    md_stream = index.MarkdownStream()
+    speech_normalizer = index.SpeechNormalizer()
+    first_token = True
+    try:
+        contents, config = await asyncio.to_thread(index.build_chat_request, personality_name, prompt, history)
+        started = time.perf_counter()
+        with index.gemini_upstream.guard():
+            async for chunk in await genai_client.aio.models.generate_content_stream(
+                model=index.GEMINI_MODEL,
+                contents=contents,
+                config=config
+            ):
+                text = getattr(chunk, "text", None)
+                if not text:
+                    continue
+                if first_token:
+                    index.record_span("llm_first_token", time.perf_counter() - started)
+                    first_token = False
+                yield "delta", await asyncio.to_thread(feed_chunk, md_stream, speech_normalizer, text)
+        index.record_span("llm", time.perf_counter() - started)
+
+        html_content, plain_text = await asyncio.to_thread(
+            save_response, cache_key, personality_name, prompt, session_id, md_stream.text, md_stream.html
+        )
+        speech = await asyncio.to_thread(lambda: index.split_speech_sentences(speech_normalizer.finish()))
+        yield "done", {
+            "html": html_content,
+            "plain": plain_text,
+            "speech": speech,
+            "session_id": session_id
+        }
+        logger.debug("✅ チャット応答のストリーミング完了。")
+    except Exception as e:
+        logger.error(f"❌ Gemini API エラー: {e}")
+        yield "error", {"error": f"Gemini API エラー: {e}"}
+
+@async_app.route("/api/tts", methods=['POST'])
+async def api_tts():
+    """index.api_tts() の非同期版 (Range はGETの /api/tts/audio/<key> で扱う)"""
+    logger.debug("🔊 /api/tts がリクエストされました。(async)")
+    d = await request.get_json(force=True, silent=True) or {}
+    text = d.get("text", "")
+
+    if not text:
+        return jsonify({"error": "テキストが空です。"}), 400
+
+    # ペルソナのボイスの参照はストアやファイルを読む可能性があるためスレッドで実行する
+    voice = await asyncio.to_thread(index.persona_voice, d.get("personality"))
+    voice = index.negotiate_tts_format(voice, request.headers.get("Accept"))
+    cache_key = index.tts_cache_key(text, voice)
+    if cache_key in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{cache_key}"'})
+
+    audio_content = await get_ada_voice_async(text, voice)
+    if not audio_content:
+        return jsonify({"error": "音声生成に失敗しました。"}), 500
+    return Response(audio_content, mimetype=index.audio_mimetype(audio_content), headers={
+        "ETag": f'"{cache_key}"',
+        "X-TTS-Cache-Key": cache_key,
+        "Cache-Control": f"public, max-age={index.TTS_AUDIO_MAX_AGE}, immutable"
+    })
+
+@async_app.route("/api/tts/stream", methods=['POST'])
+async def api_tts_stream():
+    """index.api_tts_stream() の非同期版"""
+    logger.debug("🔊 /api/tts/stream がリクエストされました。(async)")
+    d = await request.get_json(force=True, silent=True) or {}
+    sentences = index.split_speech_sentences(d.get("text", ""))
+
+    if not sentences:
+        return jsonify({"error": "テキストが空です。"}), 400
+
+    voice = await asyncio.to_thread(index.persona_voice, d.get("personality"))
+    audio_chunks = synthesize_sentences_async(sentences, voice.with_format("mp3"))
+    first_chunk = await anext(audio_chunks, None)
+    if first_chunk is None:
+        return jsonify({"error": "音声生成に失敗しました。"}), 500
+
+    async def generate():
+        yield first_chunk
+        async for chunk in audio_chunks:
+            yield chunk
+
+    return Response(generate(), mimetype="audio/mpeg")
+
+# --------------------------
+# 音声入力 (非同期版)
+# --------------------------
+
+async def transcribe_gemini_async(pcm, sample_rate):
+    """index.GeminiTranscriber の非同期版 (WAV の作成だけをスレッドで行う)"""
+    wav = await asyncio.to_thread(index.speech_input.pcm_to_wav, pcm, sample_rate)
+    audio = genai_types.Part.from_bytes(data=wav, mime_type="audio/wav")
+    response = await generate_gemini_content_async(
+        model=index.GEMINI_MODEL,
+        contents=[index.STT_PROMPT, audio],
+        deadline=index.upstream.Deadline(index.CHAT_DEADLINE)
+    )
+    return (getattr(response, "text", None) or "").strip()
+
+# 非同期版のある文字起こしのバックエンド (それ以外は同期のバックエンドをスレッドで実行する)
+ASYNC_TRANSCRIBERS = {"gemini": transcribe_gemini_async}
+
+async def transcribe_async(pcm, sample_rate):
+    transcribe = ASYNC_TRANSCRIBERS.get(index.STT_BACKEND)
+    if transcribe is not None:
+        return await transcribe(pcm, sample_rate)
+    transcriber = index.speech_input.get_transcriber(index.STT_BACKEND)
+    return await asyncio.to_thread(transcriber.transcribe, pcm, sample_rate)
+
+async def utterance_events_async(pcm, sample_rate, personality_name, session_id, chat=True):
+    """index.utterance_events() の非同期版 (文字起こしとチャットの応答待ちでスレッドを占有しない)"""
+    speech_ended = time.perf_counter()
+    try:
+        with index.span("stt"):
+            text = await transcribe_async(pcm, sample_rate)
+    except Exception as e:
+        logger.error(f"❌ 文字起こしエラー: {e}")
+        yield "error", {"error": f"文字起こしエラー: {e}"}
+        return
+    yield "transcript", {
+        "text": text,
+        "duration": round(len(pcm) / index.speech_input.SAMPLE_WIDTH / sample_rate, 3),
+        "latency_ms": round((time.perf_counter() - speech_ended) * 1000, 1),
+    }
+    if not text:
+        yield "error", {"error": "音声を認識できませんでした。"}
+        return
+    if not chat:
+        return
+
+    genai_client = index.get_genai_client()
+    if not genai_client:
+        yield "error", {"error": "Geminiクライアントが初期化されていません。APIキーを確認してください。"}
+        return
+    history = await asyncio.to_thread(index.chat_sessions.get_history, session_id, personality_name)
+    first_token = True
+    async for event, data in chat_stream_events_async(genai_client, personality_name, text, session_id, history):
+        if first_token and event in ("delta", "done"):
+            # 発話の終わりから応答の最初の断片までの時間 (音声入力の体感の待ち時間)
+            index.record_span("stt_first_token", time.perf_counter() - speech_ended)
+            first_token = False
+        yield event, data
+
+@async_app.websocket("/api/stt/stream")
+async def stt_stream_ws():
+    """index.api_stt_stream() の WebSocket 版 (録音しながら送り、発話の終わりを検出したらすぐに応答を返す)
+
+    クライアントはバイナリのメッセージで PCM を送り、入力を終える場合はテキストの "end" を送る。
+    サーバーは {"event": イベント名, "data": データ} の JSON を送り、応答を送り終えたら接続を閉じる。
+    イベントはチャンク転送版と同じ (vad / transcript / delta / done / error)。
+    """
+    logger.debug("🎙️ /api/stt/stream (WebSocket) に接続されました。")
+    args = websocket.args
+    sample_rate = args.get('sample_rate', index.STT_SAMPLE_RATE, type=int)
+    personality_name = args.get('personality', 'Default Assistant')
+    session_id = await asyncio.to_thread(index.chat_sessions.resolve_id, args.get('session_id'))
+    chat = args.get('chat', '1') not in ('0', 'false')
+
+    async def send_event(event, data):
+        await websocket.send(json.dumps({"event": event, "data": data}, ensure_ascii=False))
+
+    if not 8000 <= sample_rate <= 48000:
+        await send_event("error", {"error": "sample_rate は 8000 から 48000 の間で指定してください。"})
+        return
+
+    vad = index.create_vad(sample_rate)
+    while not vad.done:
+        message = await websocket.receive()
+        if isinstance(message, str): # "end": 入力の終わり
+            break
+        # フレームごとのエネルギーの計算はスレッドで行う
+        for event in await asyncio.to_thread(vad.feed, message):
+            await send_event("vad", event)
+    end_event = vad.flush()
+    if end_event:
+        await send_event("vad", end_event)
+    if vad.utterance is None:
+        await send_event("error", {"error": "発話が検出されませんでした。"})
+        return
+
+    async for event, data in utterance_events_async(vad.utterance, sample_rate, personality_name, session_id, chat):
+        await send_event(event, data)
+
+# --------------------------
+# ASGIアプリケーション
+# --------------------------
+
+flask_app = AsyncioWSGIMiddleware(index.app, max_body_size=WSGI_MAX_BODY_SIZE)
+
+async def instrumented_async_app(scope, receive, send):
+    """非同期ハンドラのリクエストも Flask 側と同じメトリクス・ログに記録する"""
+    start, spans = index.begin_request_metrics()
+    status = 500
+
+    async def send_with_status(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        await send(message)
+
+    try:
+        await async_app(scope, receive, send_with_status)
+    finally:
+        # レスポンスの本文 (ストリーミングを含む) を送り終えた時点の時間を記録する
+        headers = dict(scope.get("headers") or [])
+        request_bytes = int(headers.get(b"content-length") or 0) # チャンク転送の場合は 0
+        index.finish_request_metrics(start, spans, scope["method"], scope["path"], scope["path"], status, request_bytes)
+
+async def app(scope, receive, send):
+    """外部APIを呼ぶルートは非同期ハンドラへ、それ以外はFlaskアプリへ振り分ける"""
+    if scope["type"] in ("lifespan", "websocket"):
+        await async_app(scope, receive, send)
+    elif scope.get("path") in ASYNC_ROUTES:
+        await instrumented_async_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
+
+if __name__ == '__main__':
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"0.0.0.0:{os.environ.get('PORT', '5000')}"]
+    asyncio.run(serve(app, config))
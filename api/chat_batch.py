@@ -0,0 +1,110 @@
+"""JSONL のプロンプトをまとめて実行するコマンド (/api/chat/batch のクライアント)
+
+入力の各行: {"prompt": ..., "persona": ペルソナ名, "id": 任意の識別子}
+結果は完了した順に JSONL で出力し、最後にスループットとレイテンシの分布を標準エラーに表示する。
+
+使い方:
+    # 起動中のサーバーに送る
+    python api/chat_batch.py prompts.jsonl -o results.jsonl --url http://127.0.0.1:5000
+    # サーバーを起動せずにこのプロセスで実行する
+    python api/chat_batch.py prompts.jsonl -o results.jsonl --local --concurrency 8
+"""
+import argparse
+import json
+import sys
+
+
+def run_remote(url, lines, concurrency, max_retries):
+    """サーバーの /api/chat/batch に送り、返ってきた結果を1件ずつ返す"""
+    import requests
+
+    params = {key: value for key, value in (("concurrency", concurrency), ("max_retries", max_retries)) if value is not None}
+    with requests.post(
+        f"{url.rstrip('/')}/api/chat/batch",
+        params=params,
+        data="\n".join(lines).encode("utf-8"),
+        headers={"Content-Type": "application/x-ndjson"},
+        stream=True,
+        timeout=(10, None),
+    ) as r:
+        if r.status_code != 200:
+            raise SystemExit(f"エラー ({r.status_code}): {r.text}")
+        for line in r.iter_lines(decode_unicode=True):
+            if line:
+                yield json.loads(line)
+
+
+def run_local(lines, concurrency, max_retries):
+    """index.py の処理をこのプロセスで直接実行する"""
+    try:
+        import index
+    except ModuleNotFoundError:
+        from api import index
+    if not index.get_genai_client():
+        raise SystemExit("Geminiクライアントが初期化されていません。GOOGLE_API_KEY を確認してください。")
+    items = index.parse_chat_batch(lines)
+    return index.run_chat_batch(items, concurrency=concurrency, max_retries=max_retries)
+
+
+def print_summary(summary):
+    latency = summary.get("latency_ms", {})
+
+    def fmt(value):
+        return "-" if value is None else f"{value:.0f}ms"
+
+    print(
+        f"{summary['total']} 件 (ok {summary['ok']} / error {summary['error']} / cached {summary['cached']}, "
+        f"再試行 {summary['retries']} 回) を {summary['wall_s']:.2f} 秒で実行 "
+        f"-> {summary['throughput_per_s']} 件/秒 (同時実行数 {summary['concurrency']})",
+        file=sys.stderr,
+    )
+    print(
+        f"latency: mean={fmt(latency.get('mean'))} p50={fmt(latency.get('p50'))} "
+        f"p95={fmt(latency.get('p95'))} p99={fmt(latency.get('p99'))} max={fmt(latency.get('max'))}",
+        file=sys.stderr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="プロンプトの JSONL ファイル (- で標準入力)")
+    parser.add_argument("-o", "--output", help="結果の出力先 (省略時は標準出力)")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="サーバーのURL")
+    parser.add_argument("--local", action="store_true", help="サーバーを使わずにこのプロセスで実行する")
+    parser.add_argument("--concurrency", type=int, help="同時実行数")
+    parser.add_argument("--max-retries", type=int, help="Gemini のエラー時の再試行回数")
+    args = parser.parse_args()
+
+    if args.input == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+    if args.local:
+        results = run_local(lines, args.concurrency, args.max_retries)
+    else:
+        results = run_remote(args.url, lines, args.concurrency, args.max_retries)
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    summary = None
+    try:
+        for result in results:
+            if "summary" in result:
+                summary = result["summary"]
+                continue
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            status = result["status"] if result["status"] == "ok" else f"error: {result.get('error')}"
+            item_id = "" if result.get("id") is None else result["id"]
+            print(f"[{result['index']}] {item_id} {status} ({result['latency_ms']:.0f}ms)", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if summary:
+        print_summary(summary)
+    sys.exit(0 if summary and summary["error"] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
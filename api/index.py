@@ -2,22 +2,58 @@ import os
 import json
 import re
 import io
-import requests
-import markdown
-try:
-    import vercel_blob # vercel_blobライブラリは環境変数からトークンを自動で読み込む
-except Exception:
-    vercel_blob = None
-from docx import Document
-from PyPDF2 import PdfReader
+import html
+import time
+import uuid
+import hashlib
+import math
+import random
+import tempfile
+import unicodedata
+from collections import OrderedDict
+import threading
+import logging
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import codecs
 import csv
-from dotenv import load_dotenv
-from flask import Flask, request, jsonify, send_file, render_template
+from urllib.parse import quote
+from flask import Flask, request, jsonify, send_file, render_template, Response, stream_with_context, g
 from flask_cors import CORS
-import google.genai as genai
+from werkzeug.http import parse_accept_header
+try:
+    import upstream # 外部API呼び出しの共通処理 (api/upstream.py)
+    import speech_input # 音声入力の発話区間検出と文字起こし (api/speech_input.py)
+    import markdown_render # 応答の Markdown の変換とサニタイズ (api/markdown_render.py)
+    import singleflight # 同じ処理の同時実行をまとめる (api/singleflight.py)
+except ModuleNotFoundError:
+    from api import upstream, speech_input, markdown_render, singleflight
+# サーバーレス環境のコールドスタートを短くするため、google.genai / requests / markdown / docx / PyPDF2 /
+# vercel_blob / charset_normalizer は使用する関数の中で初めて import する
 
-# ローカルで実行する場合に .env ファイルを読み込む
-load_dotenv()
+# ローカルで実行する場合に .env ファイルを読み込む (Vercel上では環境変数が設定済みのため読み込まない)
+if not os.environ.get('VERCEL'):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# ログ設定 (LOG_LEVEL=DEBUG で処理ごとの詳細も出力する)
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger("ada")
+# リクエストごとに1行のJSONを出力するロガー (REQUEST_LOG=false で無効)
+request_logger = logging.getLogger("ada.request")
+request_logger.propagate = False
+if os.environ.get('REQUEST_LOG', 'true').lower() in ('1', 'true', 'yes'):
+    _request_log_handler = logging.StreamHandler()
+    _request_log_handler.setFormatter(logging.Formatter("%(message)s"))
+    request_logger.addHandler(_request_log_handler)
+    request_logger.setLevel(logging.INFO)
+else:
+    request_logger.disabled = True
 
 # Flaskアプリケーションのインスタンス化
 # template_folder と static_folder を api フォルダ内に指定
@@ -35,25 +71,291 @@ try:
     BLOB_READ_WRITE_TOKEN = os.environ.get('BLOB_READ_WRITE_TOKEN')
     VERCEL_PROJECT_ID = os.environ.get('VERCEL_PROJECT_ID')
     GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-3.5-flash')
+    # 外部APIの接続先 (ローカルのモックなどに向ける場合のみ変更する)
+    GEMINI_BASE_URL = os.environ.get('GEMINI_BASE_URL')
+    FISH_AUDIO_API_URL = os.environ.get('FISH_AUDIO_API_URL', 'https://api.fish.audio/v1/tts')
+    # Blob上のペルソナ一覧を再確認する間隔 (秒)
+    PERSONA_BLOB_TTL = float(os.environ.get('PERSONA_BLOB_TTL', '30'))
+    # Blobからペルソナを並列ダウンロードする際の最大同時接続数
+    BLOB_FETCH_CONCURRENCY = int(os.environ.get('BLOB_FETCH_CONCURRENCY', '8'))
+    # 文単位の音声合成を並列に行う際の最大同時リクエスト数
+    TTS_CONCURRENCY = int(os.environ.get('TTS_CONCURRENCY', '3'))
+    # 音声キャッシュ: メモリ上限 (バイト)、ディスク保存先と上限、Blobにも保存するかどうか
+    TTS_CACHE_MAX_BYTES = int(os.environ.get('TTS_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+    TTS_CACHE_DIR = os.environ.get('TTS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ada_tts_cache'))
+    TTS_CACHE_DISK_MAX_BYTES = int(os.environ.get('TTS_CACHE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))
+    TTS_CACHE_BLOB = os.environ.get('TTS_CACHE_BLOB', 'false').lower() in ('1', 'true', 'yes')
+    # キャッシュした音声をブラウザにキャッシュさせる秒数
+    TTS_AUDIO_MAX_AGE = int(os.environ.get('TTS_AUDIO_MAX_AGE', str(7 * 24 * 3600)))
+    # 会話セッション: 保持するセッション数・有効期限 (秒)・履歴の上限文字数・保存先ディレクトリ (未設定ならメモリのみ)
+    CHAT_SESSION_MAX = int(os.environ.get('CHAT_SESSION_MAX', '1000'))
+    CHAT_SESSION_TTL = float(os.environ.get('CHAT_SESSION_TTL', '3600'))
+    CHAT_HISTORY_MAX_CHARS = int(os.environ.get('CHAT_HISTORY_MAX_CHARS', '8000'))
+    CHAT_SESSION_DIR = os.environ.get('CHAT_SESSION_DIR')
+    # この文字数以上のペルソナは Gemini のコンテキストキャッシュに載せる
+    PERSONA_CONTEXT_CACHE_MIN_CHARS = int(os.environ.get('PERSONA_CONTEXT_CACHE_MIN_CHARS', '8000'))
+    PERSONA_CONTEXT_CACHE_TTL = int(os.environ.get('PERSONA_CONTEXT_CACHE_TTL', '3600'))
+    # 覚えておくコンテキストキャッシュの件数 (超えたら最も使われていないものから忘れる)
+    PERSONA_CONTEXT_CACHE_MAX = int(os.environ.get('PERSONA_CONTEXT_CACHE_MAX', '64'))
+    # 応答キャッシュ: 同じペルソナへの同じプロンプト (会話の最初の発言のみ) の応答を再利用する (既定では無効)
+    CHAT_RESPONSE_CACHE = os.environ.get('CHAT_RESPONSE_CACHE', 'false').lower() in ('1', 'true', 'yes')
+    CHAT_RESPONSE_CACHE_MAX = int(os.environ.get('CHAT_RESPONSE_CACHE_MAX', '512'))
+    CHAT_RESPONSE_CACHE_TTL = float(os.environ.get('CHAT_RESPONSE_CACHE_TTL', '3600'))
+    # 背景資料の検索: この文字数以上のペルソナは、基本指示と背景資料の断片に分けて関連する断片だけを渡す
+    PERSONA_RETRIEVAL_MIN_CHARS = int(os.environ.get('PERSONA_RETRIEVAL_MIN_CHARS', '4000')) # 0 で無効
+    PERSONA_CORE_MAX_CHARS = int(os.environ.get('PERSONA_CORE_MAX_CHARS', '1500'))
+    PERSONA_PASSAGE_CHARS = int(os.environ.get('PERSONA_PASSAGE_CHARS', '400'))
+    PERSONA_RETRIEVAL_TOP_K = int(os.environ.get('PERSONA_RETRIEVAL_TOP_K', '4'))
+    # アップロードされたファイルの上限サイズ (バイト) と PDF の上限ページ数
+    INGEST_MAX_BYTES = int(os.environ.get('INGEST_MAX_BYTES', str(20 * 1024 * 1024)))
+    INGEST_MAX_PAGES = int(os.environ.get('INGEST_MAX_PAGES', '1000'))
+    # PDF のページを並列に抽出するプロセス数と、並列化するページ数の下限
+    INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', str(os.cpu_count() or 1)))
+    INGEST_PARALLEL_MIN_PAGES = int(os.environ.get('INGEST_PARALLEL_MIN_PAGES', '32'))
+    # バッチ実行 (/api/chat/batch): 既定と上限の同時実行数、1回に受け付ける件数、Geminiの再試行回数
+    CHAT_BATCH_CONCURRENCY = int(os.environ.get('CHAT_BATCH_CONCURRENCY', '4'))
+    CHAT_BATCH_MAX_CONCURRENCY = int(os.environ.get('CHAT_BATCH_MAX_CONCURRENCY', '16'))
+    CHAT_BATCH_MAX_ITEMS = int(os.environ.get('CHAT_BATCH_MAX_ITEMS', '1000'))
+    CHAT_BATCH_MAX_RETRIES = int(os.environ.get('CHAT_BATCH_MAX_RETRIES', '4'))
+    # 外部APIの呼び出し: 1回の試行のタイムアウト (秒)・再試行回数・リクエスト全体の期限 (秒)
+    GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', '60'))
+    GEMINI_MAX_RETRIES = int(os.environ.get('GEMINI_MAX_RETRIES', '1'))
+    CHAT_DEADLINE = float(os.environ.get('CHAT_DEADLINE', '90'))
+    FISH_AUDIO_TIMEOUT = float(os.environ.get('FISH_AUDIO_TIMEOUT', '15'))
+    FISH_AUDIO_MAX_RETRIES = int(os.environ.get('FISH_AUDIO_MAX_RETRIES', '1'))
+    TTS_DEADLINE = float(os.environ.get('TTS_DEADLINE', '20'))
+    BLOB_TIMEOUT = float(os.environ.get('BLOB_TIMEOUT', '10'))
+    # サーキットブレーカー: 連続してこの回数失敗したら、UPSTREAM_RESET_TIMEOUT 秒間は呼び出さずにすぐ失敗させる
+    UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', '5'))
+    UPSTREAM_RESET_TIMEOUT = float(os.environ.get('UPSTREAM_RESET_TIMEOUT', '30'))
+    # 名前なしで追加されたペルソナは仮の名前ですぐに保存し、名前の生成はバックグラウンドで行う
+    # (サーバーレス環境では応答後にスレッドが止まるため、Vercel上では既定で無効)
+    PERSONA_NAMING_ASYNC = os.environ.get('PERSONA_NAMING_ASYNC', 'false' if os.environ.get('VERCEL') else 'true').lower() in ('1', 'true', 'yes')
+    PERSONA_NAMING_WORKERS = int(os.environ.get('PERSONA_NAMING_WORKERS', '4'))
+    # ローカルのペルソナの保存先: json (personalities/ に1ペルソナ1ファイル) または sqlite (1つのファイルにまとめる)
+    PERSONA_STORE = os.environ.get('PERSONA_STORE', 'json').lower()
+    PERSONA_STORE_PATH = os.environ.get('PERSONA_STORE_PATH', os.path.join('personalities', 'personas.db'))
+    # 音声入力 (/api/stt/stream): 文字起こしのバックエンド、既定のサンプリングレート、
+    # 発話の終わりとみなす無音の長さ (ミリ秒)、1回の発話の上限 (秒)
+    STT_BACKEND = os.environ.get('STT_BACKEND', 'gemini')
+    STT_SAMPLE_RATE = int(os.environ.get('STT_SAMPLE_RATE', '16000'))
+    STT_END_SILENCE_MS = int(os.environ.get('STT_END_SILENCE_MS', '600'))
+    STT_MAX_UTTERANCE_S = float(os.environ.get('STT_MAX_UTTERANCE_S', '30'))
+    # 音声合成の形式: ブラウザが受け付ける形式のうち、ペルソナの "voice" の format の次にこの順で選ぶ
+    TTS_FORMAT_PREFERENCE = [f.strip() for f in os.environ.get('TTS_FORMAT_PREFERENCE', 'opus,mp3').split(',') if f.strip()]
+    # 起動時に開いておく Fish Audio への接続数 (サーバーレス環境では起動を遅らせないよう既定で 0)
+    TTS_WARM_CONNECTIONS = int(os.environ.get('TTS_WARM_CONNECTIONS', '0' if os.environ.get('VERCEL') else str(TTS_CONCURRENCY)))
+    # Markdown の変換結果のキャッシュ: 保持する件数と合計文字数の上限
+    MARKDOWN_CACHE_MAX_ENTRIES = int(os.environ.get('MARKDOWN_CACHE_MAX_ENTRIES', '512'))
+    MARKDOWN_CACHE_MAX_CHARS = int(os.environ.get('MARKDOWN_CACHE_MAX_CHARS', str(4 * 1024 * 1024)))
 
-    print("---------------------------------")
-    print(f"BLOB_READ_WRITE_TOKEN が設定されています: {bool(BLOB_READ_WRITE_TOKEN)}")
-    print(f"VERCEL_PROJECT_ID が設定されています: {bool(VERCEL_PROJECT_ID)}")
-    print(f"GOOGLE_API_KEY が設定されています: {bool(GOOGLE_API_KEY)}")
-    print(f"GEMINI_MODEL: {GEMINI_MODEL}")
-    print("---------------------------------")
-
-    # genai.Client 初期化 (APIキーがある場合のみ)
-    genai_client = None
-    if GOOGLE_API_KEY:
-        genai_client = genai.Client(api_key=GOOGLE_API_KEY)
-        print("Geminiクライアントを初期化しました。")
-    else:
-        print("警告: GOOGLE_API_KEY が設定されていません。Gemini機能は利用できません。")
+    logger.info("---------------------------------")
+    logger.info(f"BLOB_READ_WRITE_TOKEN が設定されています: {bool(BLOB_READ_WRITE_TOKEN)}")
+    logger.info(f"VERCEL_PROJECT_ID が設定されています: {bool(VERCEL_PROJECT_ID)}")
+    logger.info(f"GOOGLE_API_KEY が設定されています: {bool(GOOGLE_API_KEY)}")
+    logger.info(f"GEMINI_MODEL: {GEMINI_MODEL}")
+    logger.info("---------------------------------")
+
+    # genai.Client は初めて使うときに get_genai_client() で作成する (APIキーがある場合のみ)
+    if not GOOGLE_API_KEY:
+        logger.warning("警告: GOOGLE_API_KEY が設定されていません。Gemini機能は利用できません。")
 
 except Exception as e:
-    print(f"APIキー取得/クライアント初期化エラー: {e}")
-    genai_client = None
+    logger.error(f"APIキー取得エラー: {e}")
+    GOOGLE_API_KEY = None
+
+# フォームの項目の分だけ余裕を持たせ、上限を大きく超えるリクエストは読み込む前に拒否する
+app.config['MAX_CONTENT_LENGTH'] = INGEST_MAX_BYTES + 1024 * 1024
+
+# Geminiクライアント (get_genai_client() で初めて使うときに作成し、以降は使い回す)
+genai_client = None
+_genai_client_lock = threading.Lock()
+
+def get_genai_client():
+    """Geminiクライアントを返す (APIキーがない場合や初期化に失敗した場合は None)"""
+    global genai_client
+    if genai_client is None and GOOGLE_API_KEY:
+        with _genai_client_lock:
+            if genai_client is None:
+                try:
+                    import google.genai as genai
+                    from google.genai import types as genai_types
+                    # タイムアウトはミリ秒で指定する (呼び出しごとの期限は generate_gemini_content() で上書きする)
+                    http_options = genai_types.HttpOptions(base_url=GEMINI_BASE_URL, timeout=int(GEMINI_TIMEOUT * 1000))
+                    genai_client = genai.Client(api_key=GOOGLE_API_KEY, http_options=http_options)
+                    logger.info("Geminiクライアントを初期化しました。")
+                except Exception as e:
+                    logger.error(f"Geminiクライアント初期化エラー: {e}")
+    return genai_client
+
+# 外部APIごとの接続プール・期限・再試行・サーキットブレーカー (統計は /api/upstreams/health)
+gemini_upstream = upstream.get_upstream(
+    "gemini", timeout=GEMINI_TIMEOUT, max_retries=GEMINI_MAX_RETRIES,
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD, reset_timeout=UPSTREAM_RESET_TIMEOUT,
+)
+fish_audio_upstream = upstream.get_upstream(
+    "fish_audio", timeout=FISH_AUDIO_TIMEOUT, max_retries=FISH_AUDIO_MAX_RETRIES, pool_maxsize=max(TTS_CONCURRENCY, 10),
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD, reset_timeout=UPSTREAM_RESET_TIMEOUT,
+)
+blob_upstream = upstream.get_upstream(
+    "blob", timeout=BLOB_TIMEOUT, pool_maxsize=BLOB_FETCH_CONCURRENCY,
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD, reset_timeout=UPSTREAM_RESET_TIMEOUT,
+)
+
+def generate_gemini_content(deadline=None, max_retries=None, **kwargs):
+    """models.generate_content を期限・再試行・サーキットブレーカー付きで呼ぶ
+
+    各試行のタイムアウトは GEMINI_TIMEOUT と deadline の残り時間の短い方になる。
+    """
+    from google.genai import types as genai_types
+    client = get_genai_client()
+    config = kwargs.pop("config", None) or genai_types.GenerateContentConfig()
+
+    def send(timeout):
+        http_options = genai_types.HttpOptions(timeout=int(timeout * 1000))
+        return client.models.generate_content(config=config.model_copy(update={"http_options": http_options}), **kwargs)
+
+    return gemini_upstream.call(send, deadline=deadline, max_retries=max_retries)
+
+# --------------------------
+# 計測 (レイテンシのメトリクス)
+# --------------------------
+
+# ヒストグラムのバケット (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class LatencyHistogram:
+    """Prometheus 形式で出力できる累積ヒストグラム"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, le=f"{bound:g}")} {cumulative}')
+        lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {self.count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {self.sum:.6f}')
+        lines.append(f'{name}_count{_format_labels(labels)} {self.count}')
+        return lines
+
+def _format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in items) + "}"
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricsRegistry:
+    """ラベルごとのヒストグラムを保持し、/api/metrics 用のテキストを作る"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # {name: {labels(tuple): LatencyHistogram}}
+        self._help = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = LatencyHistogram()
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    lines.extend(histogram.render(name, labels))
+        return lines
+
+metrics = MetricsRegistry()
+metrics.describe("ada_request_duration_seconds", "リクエストの処理時間 (レスポンスの送信完了まで)")
+metrics.describe("ada_stage_duration_seconds", "処理段階ごとの所要時間")
+
+# 処理中のリクエストの段階ごとの所要時間 {stage: 秒} (リクエストのログに出力する)
+_request_spans = contextvars.ContextVar("ada_request_spans", default=None)
+
+def record_span(stage, elapsed):
+    """処理段階の所要時間をヒストグラムと処理中のリクエストに記録する"""
+    metrics.observe("ada_stage_duration_seconds", elapsed, stage=stage)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans[stage] = spans.get(stage, 0.0) + elapsed
+
+@contextmanager
+def span(stage):
+    """with span("llm"): ... のように処理段階の所要時間を計測する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start)
+
+def begin_request_metrics():
+    """リクエストの計測を開始する ((開始時刻, 段階ごとの所要時間) を返す)"""
+    spans = {}
+    _request_spans.set(spans)
+    return time.perf_counter(), spans
+
+def finish_request_metrics(start, spans, method, path, route, status, request_bytes=0):
+    """リクエストの処理時間を記録し、1行のJSONでログに出力する (request_bytes はリクエスト本文のサイズ)
+
+    ログには到着時刻 (started_at、UNIX時刻) も含める (benchmarks/bench_replay.py で再生するトレースの作成に使う)。
+    """
+    elapsed = time.perf_counter() - start
+    metrics.observe("ada_request_duration_seconds", elapsed, route=route, method=method, status=str(status))
+    if request_logger.isEnabledFor(logging.INFO):
+        request_logger.info(json.dumps({
+            "started_at": round(time.time() - elapsed, 3),
+            "method": method,
+            "path": path,
+            "route": route,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 1),
+            "request_bytes": request_bytes,
+            "spans": {stage: round(value * 1000, 1) for stage, value in spans.items()}
+        }, ensure_ascii=False))
+
+@app.before_request
+def start_request_metrics():
+    g.request_metrics = begin_request_metrics()
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_metrics" not in g:
+        return response
+    start, spans = g.request_metrics
+    method, path = request.method, request.path
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    status = response.status_code
+    request_bytes = request.content_length or 0
+    # ストリーミング応答も含め、送信し終えた時点の時間を記録する
+    response.call_on_close(lambda: finish_request_metrics(start, spans, method, path, route, status, request_bytes))
+    return response
 
 # --------------------------
 # ユーティリティ関数
@@ -67,77 +369,354 @@ def convert_single_time(match):
     h, m = match.groups()
     return f"{int(h)}時{m}分"
 
+# 例: "10:30-11:00" -> "10時30分から11時00分"
+_TIME_RANGE_PATTERN = r"(\d{1,2}):(\d{2})\s*[-–〜~]\s*(\d{1,2}):(\d{2})"
+# 例: "14:00" -> "14時00分"
+_SINGLE_TIME_PATTERN = r"(?<!\d)(\d{1,2}):(\d{2})(?!\d)"
+_TIME_RANGE_RE = re.compile(_TIME_RANGE_PATTERN)
+_SINGLE_TIME_RE = re.compile(_SINGLE_TIME_PATTERN)
+
 def convert_times_for_speech(text: str) -> str:
     """音声合成用に時刻表記を変換する"""
-    # 例: "10:30-11:00" -> "10時30分から11時00分"
-    text = re.sub(r"(\d{1,2}):(\d{2})\s*[-–〜~]\s*(\d{1,2}):(\d{2})", lambda m: convert_time_range(m), text)
-    # 例: "14:00" -> "14時00分"
-    text = re.sub(r"(?<!\d)(\d{1,2}):(\d{2})(?!\d)", lambda m: convert_single_time(m), text)
+    text = _TIME_RANGE_RE.sub(convert_time_range, text)
+    text = _SINGLE_TIME_RE.sub(convert_single_time, text)
     return text
 
+# 数値の後ろに付く単位の読み
+SPEECH_UNITS = {
+    "km": "キロメートル", "cm": "センチメートル", "mm": "ミリメートル", "m": "メートル",
+    "kg": "キログラム", "mg": "ミリグラム", "g": "グラム",
+    "TB": "テラバイト", "GB": "ギガバイト", "MB": "メガバイト", "KB": "キロバイト",
+    "ms": "ミリ秒", "%": "パーセント", "℃": "度", "°C": "度",
+}
+
+# 音声用の変換規則を1つの正規表現にまとめ、1回の走査で処理する
+# (先に書いたものが優先される。コードブロックはインラインコードより先に判定する)
+# 先頭の先読みで各規則の1文字目になりうる文字に絞り込み、それ以外の位置では分岐を試さない
+_SPEECH_EMOJI_CHARS = "\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D\u20E3"
+_SPEECH_RE = re.compile(
+    r"(?=[`<\[h#*+\-_ \t\d" + _SPEECH_EMOJI_CHARS + r"])(?:"
+    r"(?P<fence>```[\s\S]*?(?:```|\Z))"                       # コードブロック (削除)
+    r"|`(?P<code>[^`]*)`"                                     # インラインコード (中身のみ)
+    r"|(?P<tag><[^>\n]+>)"                                    # HTMLタグ (削除)
+    r"|\[(?P<link>[^\]\n]*)\]\([^)\n]*\)"                     # リンク (テキストのみ)
+    r"|(?P<url>https?://[^\s<>()\[\]]+)"                       # URL (削除)
+    r"|(?P<block>^[ \t]*(?:#+|[*+-](?=[ \t]))[ \t]*)"           # 見出し・リスト記号 (削除)
+    r"|\*\*(?P<bold>.+?)\*\*"                                  # 太字
+    r"|__[ \t]*(?P<underline>.+?)[ \t]*__"                     # 下線付き太字
+    r"|\*(?P<italic>[^*\n]+?)\*"                                # 斜体
+    r"|(?<!\d)(?P<date>(?P<year>\d{4})[-/年](?P<month>\d{1,2})[-/月](?P<day>\d{1,2})日?)(?!\d)"  # 日付
+    r"|(?P<range>(?P<sh>\d{1,2}):(?P<sm>\d{2})\s*[-–〜~]\s*(?P<eh>\d{1,2}):(?P<em>\d{2}))"  # 時刻の範囲
+    r"|(?<!\d)(?P<time>(?P<h>\d{1,2}):(?P<m>\d{2}))(?!\d)"    # 時刻
+    # 英数字の直後の数字 (型番など) は対象外。かな・漢字の直後 (「距離は5km」) は対象にする
+    r"|(?<![A-Za-z0-9_.])(?P<number>\d+(?:\.\d+)?)[ \t]*(?P<unit>" + "|".join(
+        re.escape(unit) for unit in sorted(SPEECH_UNITS, key=len, reverse=True)
+    ) + r")(?![A-Za-z])"                                       # 単位付きの数値
+    r"|(?P<emoji>[" + _SPEECH_EMOJI_CHARS + r"]+))",           # 絵文字 (削除)
+    re.MULTILINE
+)
+
+def _speech_replace(match):
+    kind = match.lastgroup
+    if kind in ("fence", "tag", "url", "block", "emoji"):
+        return ""
+    if kind == "code":
+        return match.group("code")
+    if kind in ("link", "bold", "underline", "italic"):
+        # 太字の中のリンクや時刻なども変換する
+        return _SPEECH_RE.sub(_speech_replace, match.group(kind))
+    if kind == "date":
+        return f"{int(match.group('year'))}年{int(match.group('month'))}月{int(match.group('day'))}日"
+    if kind == "range":
+        return f"{int(match.group('sh'))}時{match.group('sm')}分から{int(match.group('eh'))}時{match.group('em')}分"
+    if kind == "time":
+        return f"{int(match.group('h'))}時{match.group('m')}分"
+    if kind == "unit":
+        return match.group("number") + SPEECH_UNITS[match.group("unit")]
+    return match.group(0)
+
 def markdown_to_plaintext(md_text: str) -> str:
-    """Markdownテキストをプレーンテキストに変換し、音声合成に適した形にする"""
+    """Markdownテキストをプレーンテキストに変換し、音声合成に適した形にする
+
+    コードブロック・リスト・太字・斜体・リンク・見出し・HTMLタグ・URL・絵文字を取り除き、
+    時刻・日付・単位付きの数値を読み上げやすい表記に変換する。
+    行 (段落・見出し・リストの項目) の区切りは改行1つにまとめて残す。
+    """
     if not md_text:
         return ""
-    
-    # Markdownの基本的な要素を削除 (コードブロック、リスト、太字、斜体など)
-    text = re.sub(r'`(.*?)`', r'\1', md_text, flags=re.DOTALL) # インラインコード
-    text = re.sub(r'```.*?```', '', md_text, flags=re.DOTALL) # コードブロック
-    text = re.sub(r'^[*-+]\s+', '', text, flags=re.MULTILINE) # リスト項目
-    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text) # 太字
-    text = re.sub(r'\*(.*?)\*', r'\1', text) # 斜体
-    text = re.sub(r'__\s*(.*?)\s*__', r'\1', text) # 下線付き太字
-    text = re.sub(r'\[(.*?)\]\((.*?)\)', r'\1', text) # リンク (テキストのみ)
-    text = re.sub(r'^[#]+\s*', '', text, flags=re.MULTILINE) # 見出し
-    text = re.sub(r'<[^>]+>', '', text) # HTMLタグ
-    
-    # 時刻表記を音声合成用に変換
-    text = convert_times_for_speech(text)
-    
-    # 連続する空白文字を1つにまとめる
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+    text = _SPEECH_RE.sub(_speech_replace, md_text)
+    # 行内の連続する空白文字を1つにまとめ、空行は取り除く
+    # (見出しやリストの項目が次の文とつながらないよう、改行は文の区切りとして残す)
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+# 文の終わり (閉じかっこを含む)。閉じかっこが続く場合があるため、次の文字が届いてから文の終わりとみなす
+# (半角の !? は URL などと区別するため、後ろに空白が届いてから)
+_SPEECH_SENTENCE_END_RE = re.compile(r'[。！？]+[」』）]*(?=[^。！？」』）])|[!?]+[」』）]*(?=\s)')
+
+def _inline_markup_closed(text):
+    """インラインの記法 (コード・太字・斜体・リンク・HTMLタグ) がすべて閉じているか"""
+    return (
+        text.count("`") % 2 == 0 and text.count("**") % 2 == 0 and text.replace("**", "").count("*") % 2 == 0
+        and text.count("__") % 2 == 0
+        and text.count("[") == text.count("]") and text.count("(") == text.count(")")
+        and text.count("<") == text.count(">")
+    )
+
+class SpeechNormalizer:
+    """ストリーミング中のMarkdownを逐次プレーンテキストに変換する
+
+    改行まで届いた行に加えて、行の途中でも文が終わった (。！？!?) 部分までを変換する。
+    書きかけの文と、閉じていないコードブロック・インラインの記法は届くまで保留する。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._scanned = 0  # 行として確認済みの位置
+        self._boundary = 0  # 変換してよい位置 (コードブロックの外にある行末)
+        self._checked = 0  # 文の終わりを確認済みの位置
+        self._in_fence = False
+
+    def feed(self, chunk: str) -> str:
+        """チャンクを追加し、確定した行のプレーンテキストを返す"""
+        self._buffer += chunk
+        while True:
+            newline = self._buffer.find("\n", self._scanned)
+            if newline == -1:
+                break # 行がまだ完結していない
+            line = self._buffer[self._scanned:newline]
+            self._scanned = newline + 1
+            # コードブロックの区切りは行の途中にあっても markdown_to_plaintext と同じく数える
+            if line.count("```") % 2:
+                self._in_fence = not self._in_fence
+            if not self._in_fence:
+                self._boundary = self._scanned
+        if not self._in_fence:
+            # 1つの段落が長い応答でも、文ができた時点で読み上げを始められるようにする
+            self._boundary = max(self._boundary, self._sentence_boundary())
+        if self._boundary == 0:
+            return ""
+        ready, self._buffer = self._buffer[:self._boundary], self._buffer[self._boundary:]
+        self._scanned = max(0, self._scanned - self._boundary)
+        self._checked = max(0, self._checked - self._boundary)
+        self._boundary = 0
+        return markdown_to_plaintext(ready)
+
+    def _sentence_boundary(self) -> int:
+        """書きかけの行のうち、最後に文が終わった位置 (インラインの記法が閉じている位置に限る)"""
+        line_start = self._scanned
+        # 確認済みの文の終わりは記法が閉じていなかったもの (その後に届いたテキストでは変わらない) のため、
+        # 新しく届いた部分だけを調べる (後ろの空白を待っている半角の !? と閉じかっこの分は少し戻る)
+        start = max(line_start, self._checked - 8)
+        self._checked = len(self._buffer)
+        for match in reversed(list(_SPEECH_SENTENCE_END_RE.finditer(self._buffer, start))):
+            if _inline_markup_closed(self._buffer[line_start:match.end()]):
+                return match.end()
+        return 0
+
+    def finish(self) -> str:
+        """残りのテキストをすべて変換して返す"""
+        ready = self._buffer
+        self.__init__()
+        return markdown_to_plaintext(ready)
+
+def split_speech_sentences(text: str) -> list:
+    """音声合成用に文単位 (。！？ と改行) で分割する (文の終わりに続く閉じかっこはその文に含める)"""
+    if not text:
+        return []
+    sentences = re.findall(r'[^。！？!?\n]+[。！？!?]*[」』）]*|[。！？!?]+[」』）]*', text)
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+# nl2br拡張で改行を<br>に変換する (インスタンスはスレッドごとに使い回し、結果は本文のハッシュでキャッシュする)
+markdown_renderer = markdown_render.MarkdownRenderer(
+    extensions=['nl2br'],
+    cache_max_entries=MARKDOWN_CACHE_MAX_ENTRIES,
+    cache_max_chars=MARKDOWN_CACHE_MAX_CHARS,
+)
 
 def markdown_to_html(md_text: str) -> str:
-    """MarkdownテキストをHTMLに変換する"""
-    if not md_text:
-        return ""
+    """MarkdownテキストをHTMLに変換する (許可したタグ・属性以外は取り除く)"""
+    return markdown_renderer.render(md_text)
+
+# 空行の後にこの形の行が続く場合は、前のブロックの続き (リストの項目・字下げ・引用) になりうるため区切らない
+_MARKDOWN_CONTINUATION_RE = re.compile(r'[ \t]|[*+-][ \t]|\d+[.)][ \t]|>')
+
+class MarkdownStream:
+    """ストリーミング中のMarkdownを段落単位で逐次HTMLに変換する
+
+    空行で区切られた段落が確定するたびに、その部分だけを render (既定: markdown_to_html) で変換して返す。
+    コードブロック (```) の途中や、次の行がリストの項目・字下げの場合は区切らない。
+    未確定の末尾はエスケープしたテキストとして返す。
+    html() は確定済みの断片を使い回すため、応答の最後に全体を変換し直す必要がない
+    (文書の後ろで定義した参照リンクが前の段落に効かない点だけが、全体を変換した場合と異なる)。
+    """
+
+    def __init__(self, render=None):
+        self.text = ""  # 受信したMarkdown全体
+        self.render = render or markdown_to_html
+        self._committed = 0  # HTML変換済みの位置
+        self._fragments = []  # 確定した部分のHTML
+
+    def feed(self, chunk: str):
+        """チャンクを追加し、(新たに確定したHTML断片, 未確定部分のHTML) を返す"""
+        self.text += chunk
+        boundary = self._last_block_boundary()
+        fragment = ""
+        if boundary > self._committed:
+            fragment = self.render(self.text[self._committed:boundary])
+            self._fragments.append(fragment)
+            self._committed = boundary
+        return fragment, self.pending_html()
+
+    def html(self) -> str:
+        """全体のHTML (確定済みの断片と、未確定の末尾を変換したもの)"""
+        tail = self.text[self._committed:]
+        parts = self._fragments + ([self.render(tail)] if tail.strip() else [])
+        return "\n".join(part for part in parts if part)
+
+    def pending_html(self) -> str:
+        """未確定部分をHTMLエスケープして返す"""
+        return html.escape(self.text[self._committed:]).replace("\n", "<br />")
+
+    def _last_block_boundary(self) -> int:
+        """コードブロック外にある空行のうち、次の行で新しいブロックが始まる最後のものの直後の位置を返す"""
+        boundary = self._committed
+        candidate = None # 空行の直後の位置 (次の行を見るまで確定しない)
+        in_fence = False
+        pos = self._committed
+        for line in self.text[self._committed:].splitlines(keepends=True):
+            if not line.endswith("\n"):
+                break # 行がまだ完結していない
+            start, pos = pos, pos + len(line)
+            if in_fence:
+                in_fence = not line.lstrip().startswith("```")
+                continue
+            if not line.strip():
+                candidate = pos
+                continue
+            if candidate is not None and not _MARKDOWN_CONTINUATION_RE.match(line):
+                boundary = start
+            candidate = None
+            in_fence = line.lstrip().startswith("```")
+        return boundary
+
+def save_upload_to_temp(file_storage, suffix):
+    """アップロードされたファイルをチャンク単位で一意な一時ファイルに書き出し、そのパスを返す"""
+    fd, temp_path = tempfile.mkstemp(prefix="ada_upload_", suffix=suffix)
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = file_storage.stream.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > INGEST_MAX_BYTES:
+                    raise ValueError(f"ファイルサイズが上限 ({INGEST_MAX_BYTES // (1024 * 1024)}MB) を超えています。")
+                f.write(chunk)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+def detect_text_encoding(file_path):
+    """テキストファイルの先頭を読んで文字コードを推定する (UTF-8 → 自動判定 → cp932 の順)"""
+    with open(file_path, 'rb') as f:
+        sample = f.read(64 * 1024)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # 末尾で文字が途中まで切れていてもエラーにならないようにインクリメンタルに判定する
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
     try:
-        # nl2br拡張で改行を<br>に変換
-        return markdown.markdown(md_text, extensions=['nl2br'])
+        import charset_normalizer # requests の依存として入っていることが多い
     except Exception:
-        # エラー時はプレーンテキストとして表示
-        return f"<pre>{md_text or ''}</pre>"
+        charset_normalizer = None
+    if charset_normalizer is not None:
+        best = charset_normalizer.from_bytes(sample).best()
+        if best is not None:
+            return best.encoding
+    return 'cp932'
+
+def _extract_pdf_pages(file_path, start, end):
+    """PDFの start〜end-1 ページのテキストをリストで返す (プロセスプールからも呼ばれる)"""
+    from PyPDF2 import PdfReader
+    with open(file_path, 'rb') as f:
+        reader = PdfReader(f)
+        return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+_ingest_pool = None
+_ingest_pool_lock = threading.Lock()
+
+def _get_ingest_pool():
+    """PDF抽出用のプロセスプールを初回だけ作成して使い回す"""
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is None:
+            _ingest_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+        return _ingest_pool
+
+def extract_pdf_text(file_path):
+    """PDFのテキストをページ単位で抽出する (ページ数が多い場合はプロセスプールで並列に処理する)"""
+    global _ingest_pool
+    from PyPDF2 import PdfReader
+    with open(file_path, 'rb') as f:
+        page_count = len(PdfReader(f).pages)
+    if page_count > INGEST_MAX_PAGES:
+        raise ValueError(f"PDFのページ数が上限 ({INGEST_MAX_PAGES}ページ) を超えています: {page_count}ページ")
+
+    if INGEST_WORKERS <= 1 or page_count < INGEST_PARALLEL_MIN_PAGES:
+        return "".join(_extract_pdf_pages(file_path, 0, page_count))
+
+    # 各ワーカーがPDFを開き直すコストを抑えるため、ワーカー数と同じ数の範囲に分割する
+    step = max(1, -(-page_count // INGEST_WORKERS))
+    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    try:
+        pool = _get_ingest_pool()
+        futures = [pool.submit(_extract_pdf_pages, file_path, start, end) for start, end in ranges]
+        pages = [text for future in futures for text in future.result()]
+    except (OSError, NotImplementedError, BrokenProcessPool) as e:
+        # サーバーレス環境などでプロセスを作れない場合は逐次処理にする
+        logger.warning(f"⚠️ PDFの並列抽出に失敗したため逐次処理します: {e}")
+        _ingest_pool = None
+        pages = _extract_pdf_pages(file_path, 0, page_count)
+    return "".join(pages)
 
 def extract_text_from_file(file_path, file_extension):
     """ファイルの拡張子に応じてテキストを抽出する"""
-    print(f"📄 ファイルからテキストを抽出中: {file_extension}")
+    logger.debug(f"📄 ファイルからテキストを抽出中: {file_extension}")
+    file_extension = file_extension.lower()
     text_content = ""
     if file_extension == ".txt":
-        with open(file_path, 'r', encoding='utf-8') as f:
+        with open(file_path, 'r', encoding=detect_text_encoding(file_path), errors='replace') as f:
             text_content = f.read()
     elif file_extension == ".docx":
+        from docx import Document
         doc = Document(file_path)
         text_content = "\n".join([paragraph.text for paragraph in doc.paragraphs])
     elif file_extension == ".pdf":
-        with open(file_path, 'rb') as f:
-            reader = PdfReader(f)
-            for page in reader.pages:
-                text_content += page.extract_text() or ""
+        text_content = extract_pdf_text(file_path)
     elif file_extension == ".csv":
-        with open(file_path, 'r', encoding='utf-8') as f:
+        with open(file_path, 'r', encoding=detect_text_encoding(file_path), errors='replace', newline='') as f:
             reader = csv.reader(f)
             text_content = "\n".join([",".join(row) for row in reader])
     else:
         raise ValueError(f"サポートされていないファイル形式です: {file_extension}")
-    print("✅ テキスト抽出完了")
+    logger.debug("✅ テキスト抽出完了")
     return text_content
 
+# 同じ先頭部分のペルソナが同時に追加された場合は、名前の生成を1回にまとめる
+persona_name_flight = singleflight.get_group("persona_name")
+
 def generate_personality_name(text_content):
     """Gemini API を使ってテキスト内容から人格名を生成する"""
-    print("🤖 Geminiでペルソナ名を生成中...")
+    logger.debug("🤖 Geminiでペルソナ名を生成中...")
+    genai_client = get_genai_client()
     if not genai_client:
-        print("Geminiクライアントがないため、デフォルト名を使用します。")
+        logger.debug("Geminiクライアントがないため、デフォルト名を使用します。")
         return "新しいペルソナ"
 
     prompt_text = f"""
@@ -149,32 +728,168 @@ def generate_personality_name(text_content):
 「{text_content[:200]}...」
 """
     try:
-        response = genai_client.models.generate_content(
-            model=GEMINI_MODEL, # または他の適切なモデル
-            contents=prompt_text
-        )
+        def generate():
+            with span("llm_name"):
+                return generate_gemini_content(
+                    model=GEMINI_MODEL, # または他の適切なモデル
+                    contents=prompt_text
+                )
+
+        # プロンプトに使うのは先頭の200文字だけのため、プロンプトが同じなら生成結果を共有する
+        response = persona_name_flight.do(hashlib.sha256(prompt_text.encode("utf-8")).hexdigest(), generate)
         # response.text が存在しない場合のフォールバック
         name = getattr(response, 'text', '').strip().replace('"', '')
         if not name: # response.text が空の場合
-             print("Geminiからの応答が空でした。デフォルト名を使用します。")
+             logger.debug("Geminiからの応答が空でした。デフォルト名を使用します。")
              return "新しいペルソナ"
 
-        print(f"✅ ペルソナ名生成完了: {name}")
+        logger.debug(f"✅ ペルソナ名生成完了: {name}")
         return name
     except Exception as e:
-        print(f"❌ 人格名生成エラー: {e}")
+        logger.error(f"❌ 人格名生成エラー: {e}")
         return "新しいペルソナ"
 
 # --------------------------
 # Blob操作関数 (vercel_blob版)
 # --------------------------
 
-def save_personality_to_blob(text_content, user_defined_name=None):
-    """人格設定をBlobにJSONとして保存する"""
-    print("📤 Blobにデータをアップロード中...")
+_vercel_blob = False # 未読み込み (インストールされていない場合は None)
+
+def get_vercel_blob():
+    """vercel_blob モジュールを初回だけ import して返す (インストールされていない場合は None)"""
+    global _vercel_blob
+    if _vercel_blob is False:
+        try:
+            import vercel_blob # vercel_blobライブラリは環境変数からトークンを自動で読み込む
+        except Exception:
+            vercel_blob = None
+        _vercel_blob = vercel_blob
+    return _vercel_blob
+
+# Blob上のペルソナの配置
+# - personas/manifest.json      : { ペルソナ名: 本文のBlob } の対応表 (これだけを上書きで更新する)
+# - personas/objects/<sha256>.json: 本文 (system_instruction と voice) のJSON。内容のハッシュを名前にするため変更されない
+# 以前の形式 (ルート直下の <名前>_<ランダムなサフィックス>.json) は、最初の保存時にマニフェストへ移行する
+PERSONA_MANIFEST_PATHNAME = "personas/manifest.json"
+PERSONA_OBJECT_PREFIX = "personas/objects/"
+# マニフェストの読み込み・書き戻しを1件ずつ行う (同じプロセス内での更新の取りこぼしを防ぐ)
+_persona_manifest_lock = threading.RLock()
+# 取得済みのマニフェスト (uploadedAt, manifest)
+_persona_manifest_cache = None
+
+def blob_personas_enabled():
+    """ペルソナをBlobに保存する設定かどうか"""
+    return bool(BLOB_READ_WRITE_TOKEN and VERCEL_PROJECT_ID and get_vercel_blob())
+
+def _list_all_blobs(prefix=None):
+    """prefix で始まるBlobを、ページをたどってすべて返す"""
+    vercel_blob = get_vercel_blob()
+    blobs = []
+    options = {"prefix": prefix} if prefix else {}
+    while True:
+        page = blob_upstream.call(lambda timeout: vercel_blob.list(dict(options)))
+        blobs.extend(page.get('blobs', []))
+        if not page.get('hasMore') or not page.get('cursor'):
+            return blobs
+        options["cursor"] = page['cursor']
+
+def _list_legacy_personality_blobs():
+    """以前の形式 (ルート直下の <名前>_<サフィックス>.json) のBlobの一覧"""
+    return [
+        file for file in _list_all_blobs()
+        if file.get('pathname', '').endswith('.json') and '/' not in file.get('pathname', '')
+    ]
+
+def _find_manifest_blob():
+    """マニフェストのBlobを返す (まだない場合は None)"""
+    options = {"prefix": PERSONA_MANIFEST_PATHNAME, "limit": "1"}
+    blobs = blob_upstream.call(lambda timeout: get_vercel_blob().list(options)).get('blobs', [])
+    return next((blob for blob in blobs if blob.get('pathname') == PERSONA_MANIFEST_PATHNAME), None)
+
+def read_persona_manifest(file=None):
+    """マニフェストを返す (まだない場合は None)。file を渡した場合は一覧を取得しない"""
+    global _persona_manifest_cache
+    file = file or _find_manifest_blob()
+    if file is None:
+        return None
+    cached = _persona_manifest_cache
+    if cached is not None and cached[0] == file.get('uploadedAt'):
+        return cached[1]
+    # 上書きしたBlobはCDNに古い内容が残る場合があるため、更新時刻をクエリに付けて最新を取得する
+    url = f"{file['url']}?v={quote(str(file.get('uploadedAt', '')))}"
+    manifest = blob_upstream.request("GET", url).json()
+    _persona_manifest_cache = (file.get('uploadedAt'), manifest)
+    return manifest
+
+def _put_persona_object(text_content, voice=None):
+    """本文を内容のハッシュを名前にしたBlobに保存し、マニフェストに書く項目を返す"""
+    data = {"system_instruction": text_content}
+    if voice:
+        data["voice"] = voice
+    body = json.dumps(data, ensure_ascii=False, indent=4).encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()
+    pathname = f"{PERSONA_OBJECT_PREFIX}{digest}.json"
+    vercel_blob = get_vercel_blob()
+    # 同じ名前には常に同じ内容を書くため、再試行しても安全
+    response = blob_upstream.call(
+        lambda timeout: vercel_blob.put(pathname, body, {"addRandomSuffix": "false", "allowOverwrite": "true"})
+    )
+    return {"url": response['url'], "pathname": pathname, "hash": digest, "size": len(body), "updated_at": time.time()}
+
+def _manifest_from_legacy_blobs():
+    """以前の形式のBlobからマニフェストを作る (同名のBlobが複数ある場合は最後にアップロードしたものを使う)"""
+    files = sorted(_list_legacy_personality_blobs(), key=lambda file: file.get('uploadedAt') or '')
+    workers = max(1, min(BLOB_FETCH_CONCURRENCY, len(files)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        instructions = list(executor.map(_fetch_personality_blob, files))
+        # 読み込めなかったBlobがあるまま移行すると、compaction でそのペルソナが消えてしまう
+        failed = [file['pathname'] for file, instruction in zip(files, instructions) if instruction is None]
+        if failed:
+            raise Exception(f"以前の形式のBlobを {len(failed)} 件読み込めなかったため、マニフェストへの移行を中止しました: {failed[:5]}")
+        latest = {}
+        for file, instruction in zip(files, instructions):
+            if instruction is not None:
+                latest[_clean_blob_name(file['pathname'])] = (instruction, _cached_blob_voice(file))
+        entries = executor.map(lambda item: _put_persona_object(*item), latest.values())
+        personas = dict(zip(latest, entries))
+    if personas:
+        logger.info(f"📦 以前の形式のBlobから {len(personas)} 件のペルソナをマニフェストに移行しました。")
+    return {"revision": 0, "personas": personas}
+
+def update_persona_manifest(change):
+    """マニフェストを読み込み、change(personas) で変更して書き戻す
+
+    change は { ペルソナ名: 項目 } の辞書を直接変更する。False を返した場合は書き戻さない。
+    マニフェストがまだない場合は、以前の形式のBlobから作ってから変更する。
+    Blob には条件付きの上書きがないため、複数のプロセスから同時に更新した場合は後に書いた方が残る。
+    """
+    global _persona_manifest_cache
+    vercel_blob = get_vercel_blob()
+    with _persona_manifest_lock:
+        manifest = read_persona_manifest()
+        migrated = manifest is None
+        if migrated:
+            manifest = _manifest_from_legacy_blobs()
+        personas = dict(manifest.get("personas", {}))
+        # 移行した場合は、変更がなくてもマニフェストを書いておく
+        if change(personas) is False and not migrated:
+            return manifest
+        manifest = {"version": 1, "revision": manifest.get("revision", 0) + 1, "updated_at": time.time(), "personas": personas}
+        body = json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+        options = {"addRandomSuffix": "false", "allowOverwrite": "true", "cacheControlMaxAge": "60"}
+        # 同じ内容の書き戻しは何度行っても結果が変わらないため再試行する
+        blob_upstream.call(lambda timeout: vercel_blob.put(PERSONA_MANIFEST_PATHNAME, body, options))
+        _persona_manifest_cache = None
+    persona_registry.invalidate() # 次回参照時にBlobから再読み込みさせる
+    return manifest
+
+def save_personality_to_blob(text_content, user_defined_name=None, voice=None):
+    """人格設定をBlobに保存する (本文のBlobを保存してからマニフェストを差し替える)"""
+    logger.debug("📤 Blobにデータをアップロード中...")
     if not BLOB_READ_WRITE_TOKEN or not VERCEL_PROJECT_ID:
         raise Exception("Vercel BlobトークンまたはプロジェクトIDが設定されていません。")
 
+    vercel_blob = get_vercel_blob()
     if vercel_blob is None:
         raise Exception("vercel_blob ライブラリがインストールされていません。pip install vercel-blob を検討してください。")
 
@@ -183,107 +898,304 @@ def save_personality_to_blob(text_content, user_defined_name=None):
         name = user_defined_name.replace(" ", "_").replace("/", "_")
     else:
         name = generate_personality_name(text_content).replace(" ", "_").replace("/", "_")
-    
-    # ファイル名をユニークにするために addRandomSuffix を使用
-    options = {"addRandomSuffix": "true"}
-    
-    # データを辞書として定義 (system_instruction キーを使用)
-    data = {"system_instruction": text_content}
-    
-    # JSONデータをUTF-8バイトにエンコード
-    json_data_bytes = json.dumps(data, ensure_ascii=False, indent=4).encode('utf-8')
 
     try:
-        # vercel_blob.put() を使用してアップロード
-        # 第一引数: ファイルパス (例: "personality_name.json")
-        # 第二引数: ファイルデータ (バイト列)
-        # options: アップロードオプション
-        response = vercel_blob.put(f"{name}.json", json_data_bytes, options)
-        
-        uploaded_url = response.get('url')
-        print(f"✅ ペルソナ '{name}' をBlobに保存しました。URL: {uploaded_url}")
+        entry = _put_persona_object(text_content, voice)
+        update_persona_manifest(lambda personas: personas.__setitem__(name, entry))
+        logger.debug(f"✅ ペルソナ '{name}' をBlobに保存しました。URL: {entry['url']}")
         return name
-        
     except Exception as e:
-        print(f"❌ Blobへの保存中にエラーが発生しました: {e}")
+        logger.error(f"❌ Blobへの保存中にエラーが発生しました: {e}")
         raise Exception(f"Blobへの保存中にエラーが発生しました: {e}")
 
-def load_personalities_from_blob():
-    """Blobからすべての人格を読み込む"""
-    print("📥 Blobからデータをダウンロード中...")
+def update_personality_blob(name, text_content, voice=None):
+    """Blobのペルソナを更新する (Blobにない場合は None を返す)
+
+    voice が None なら音声の設定はそのまま、空の辞書なら削除する。
+    """
+    manifest = read_persona_manifest()
+    if manifest is None:
+        # 以前の形式のままなら、先にマニフェストへ移行する
+        manifest = update_persona_manifest(lambda personas: None)
+    current = manifest.get("personas", {}).get(name)
+    if current is None:
+        return None
+    if voice is None:
+        # マニフェストには音声の設定がないため、今の本文のBlobから引き継ぐ。
+        # 取得できないまま書くと音声の設定が消えるので、更新を中止する
+        if _fetch_personality_blob(_manifest_entry_file(current)) is None:
+            raise Exception(f"ペルソナ '{name}' の現在の内容をBlobから取得できなかったため、音声の設定を引き継げません。")
+        voice = _cached_blob_voice(_manifest_entry_file(current))
+    entry = _put_persona_object(text_content, voice or None)
+
+    def change(personas):
+        if name not in personas:
+            raise FileNotFoundError(f"ペルソナ '{name}' が見つかりません。")
+        personas[name] = entry
+
+    update_persona_manifest(change)
+    chat_response_cache.invalidate_persona(name)
+    return name
+
+def compact_blob_personas(grace_seconds=3600.0, dry_run=False):
+    """マニフェストから参照されていないペルソナのBlob (置き換えられた本文と以前の形式のBlob) を削除する
+
+    保存の途中 (本文を置いてからマニフェストを差し替えるまで) のBlobを消さないよう、
+    アップロードから grace_seconds 秒以内のBlobは残す。削除した件数などを返す。
+    dry_run の場合はBlobに一切書き込まない (マニフェストへの移行が必要な場合も移行せずに見積もる)。
+    """
+    from datetime import datetime, timezone
+
+    manifest = read_persona_manifest()
+    migration_required = manifest is None
+    if migration_required and dry_run:
+        # 移行すると以前の形式のBlobはすべて本文のBlobに置き換わり、参照されなくなる
+        # (本文のBlobは移行時に同じ名前で書き直されて参照される可能性があるため、対象に数えない)
+        candidates = _list_legacy_personality_blobs()
+        live = len({_clean_blob_name(file['pathname']) for file in candidates})
+        manifest = {"revision": 0, "personas": {}}
+    else:
+        if migration_required:
+            # 以前の形式のBlobしかない場合は、先にマニフェストへ移行する (移行した本文は参照されるため残る)
+            manifest = update_persona_manifest(lambda personas: None)
+        live_urls = {entry['url'] for entry in manifest.get("personas", {}).values()}
+        live = len(live_urls)
+        candidates = [
+            file for file in _list_all_blobs(PERSONA_OBJECT_PREFIX) + _list_legacy_personality_blobs()
+            if file.get('url') not in live_urls
+        ]
+    now = datetime.now(timezone.utc)
+    garbage, recent = [], 0
+    for file in candidates:
+        uploaded_at = file.get('uploadedAt')
+        try:
+            age = (now - datetime.fromisoformat(str(uploaded_at).replace('Z', '+00:00'))).total_seconds()
+        except ValueError:
+            age = float('inf')
+        if age < grace_seconds:
+            recent += 1
+        else:
+            garbage.append(file)
+
+    if garbage and not dry_run:
+        vercel_blob = get_vercel_blob()
+        for i in range(0, len(garbage), 100):
+            urls = [file['url'] for file in garbage[i:i + 100]]
+            blob_upstream.call(lambda timeout: vercel_blob.delete(urls))
+        logger.info(f"🧹 参照されていないペルソナのBlobを {len(garbage)} 件削除しました。")
+    return {
+        "live": live,
+        "deleted": 0 if dry_run else len(garbage),
+        "garbage": len(garbage),
+        "garbage_bytes": sum(file.get('size') or 0 for file in garbage),
+        "kept_recent": recent,
+        "revision": manifest.get("revision", 0),
+        "migration_required": migration_required and dry_run,
+    }
+
+def list_personality_blobs():
+    """ペルソナの読み込みに使うBlobの一覧を返す
+
+    マニフェストがある場合はマニフェストのBlobだけを返す (一覧の取得は1回で、保存の履歴の件数によらない)。
+    ない場合は以前の形式の人格JSONファイルの一覧を返す。
+    """
+    with span("blob_list"):
+        manifest_file = _find_manifest_blob()
+        if manifest_file is not None:
+            return [manifest_file]
+        return _list_legacy_personality_blobs()
+
+def _manifest_entry_file(entry):
+    """マニフェストの項目を、Blob一覧の項目と同じ形にする (本文は変わらないためハッシュを uploadedAt の代わりに使う)"""
+    return {"url": entry['url'], "pathname": entry['pathname'], "uploadedAt": entry['hash']}
+
+# ダウンロード済みBlobのキャッシュ { url: (uploadedAt, system_instruction, voice) }
+_blob_content_cache = {}
+_blob_content_cache_lock = threading.Lock()
+
+def _clean_blob_name(pathname):
+    """Blobのパス名からペルソナ名を取り出す"""
+    # ファイル名から拡張子を除去し、ランダムサフィックスを削除
+    name_with_suffix = os.path.basename(pathname) # 例: "my_persona_a1b2c3d4.json"
+    name_without_ext = os.path.splitext(name_with_suffix)[0] # 例: "my_persona_a1b2c3d4"
+    # 末尾のランダムサフィックス (例: _a1b2c3d4) を削除
+    return re.sub(r'_[a-f0-9]{8}$', '', name_without_ext)
+
+def _fetch_personality_blob(file):
+    """Blobを1件取得して system_instruction を返す (URLとuploadedAtが同じならキャッシュを返す)"""
+    blob_url = file.get('url')
+    pathname = file.get('pathname', '')
+    if not blob_url:
+        logger.error(f"❌ URLが見つかりません: {pathname}")
+        return None
+
+    uploaded_at = file.get('uploadedAt')
+    with _blob_content_cache_lock:
+        cached = _blob_content_cache.get(blob_url)
+    if cached is not None and cached[0] == uploaded_at:
+        return cached[1]
+
+    import requests
+    # Blob URLから直接データを取得 (共有セッションを使用し、一時的なエラーは再試行する)
+    # Vercel Blob のURLは認証なしでアクセスできる場合が多いが、
+    # セキュリティのためトークンが必要な場合もある (ここではrequestsで試行)
+    try:
+        file_response = blob_upstream.request("GET", blob_url)
+        data = file_response.json()
+        instruction = data.get("system_instruction", "")
+        voice = data.get("voice") or None
+    except (requests.exceptions.RequestException, upstream.UpstreamError) as req_err:
+        logger.error(f"❌ ファイル取得エラー ({blob_url}): {req_err}")
+        return None
+    except json.JSONDecodeError:
+        logger.error(f"❌ JSONデコードエラー: {pathname}")
+        return None
+    except Exception as e:
+        logger.error(f"❌ ファイル処理中に予期せぬエラー: {pathname} - {e}")
+        return None
+
+    with _blob_content_cache_lock:
+        _blob_content_cache[blob_url] = (uploaded_at, instruction, voice)
+    return instruction
+
+def _cached_blob_voice(file):
+    """_fetch_personality_blob() で取得済みのBlobの音声の設定を返す (未設定なら None)"""
+    with _blob_content_cache_lock:
+        cached = _blob_content_cache.get(file.get('url'))
+    return cached[2] if cached else None
+
+def load_personalities_from_blob(files=None, voices=None):
+    """Blobからすべての人格を読み込む (voices に辞書を渡すと音声の設定も入れる)
+
+    files (list_personality_blobs() の結果) にマニフェストがあれば、マニフェストにあるペルソナの本文だけを取得する。
+    本文のBlobは変更されないため、一度取得したものは再取得しない。
+    """
+    logger.debug("📥 Blobからデータをダウンロード中...")
     personalities = {}
     if not BLOB_READ_WRITE_TOKEN:
-        print("Blobトークンがないため、Blobからの読み込みはスキップします。")
+        logger.debug("Blobトークンがないため、Blobからの読み込みはスキップします。")
         return personalities # 空の辞書を返す
 
     try:
-        # vercel_blob.list() でファイル一覧を取得
-        list_response = vercel_blob.list()
-        files = list_response.get('blobs', [])
-
-        for file in files:
-            if file.get('pathname', '').endswith('.json'):
-                blob_url = file.get('url')
-                if not blob_url:
-                    print(f"❌ URLが見つかりません: {file.get('pathname')}")
-                    continue
+        # 一覧が渡されていない場合のみ vercel_blob.list() を呼び出す
+        if files is None:
+            files = list_personality_blobs()
+        manifest_file = next((file for file in files if file.get('pathname') == PERSONA_MANIFEST_PATHNAME), None)
+        if manifest_file is not None:
+            entries = read_persona_manifest(manifest_file).get("personas", {})
+            names = list(entries)
+            files = [_manifest_entry_file(entry) for entry in entries.values()]
+        else:
+            # 以前の形式: 同名のBlobが複数ある場合は、最後にアップロードしたものが残るようにする
+            files = sorted(
+                (file for file in files if file.get('pathname', '').endswith('.json')),
+                key=lambda file: file.get('uploadedAt') or ''
+            )
+            names = [_clean_blob_name(file['pathname']) for file in files]
 
-                # Blob URLから直接データを取得 (requestsを使用)
-                # Vercel Blob のURLは認証なしでアクセスできる場合が多いが、
-                # セキュリティのためトークンが必要な場合もある (ここではrequestsで試行)
-                try:
-                    # Blob URLに直接アクセスしてファイル内容を取得
-                    file_response = requests.get(blob_url, timeout=10) # タイムアウトを設定
-                    file_response.raise_for_status() # エラーチェック
-                    
-                    data = file_response.json()
-                    
-                    # ファイル名から拡張子を除去し、ランダムサフィックスを削除
-                    pathname = file['pathname']
-                    name_with_suffix = os.path.basename(pathname) # 例: "my_persona_a1b2c3d4.json"
-                    name_without_ext = os.path.splitext(name_with_suffix)[0] # 例: "my_persona_a1b2c3d4"
-                    
-                    # 末尾のランダムサフィックス (例: _a1b2c3d4) を削除
-                    clean_name = re.sub(r'_[a-f0-9]{8}$', '', name_without_ext)
-                    
-                    personalities[clean_name] = data.get("system_instruction", "")
-                    
-                except requests.exceptions.RequestException as req_err:
-                    print(f"❌ ファイル取得エラー ({blob_url}): {req_err}")
-                except json.JSONDecodeError:
-                    print(f"❌ JSONデコードエラー: {pathname}")
-                except Exception as e:
-                    print(f"❌ ファイル処理中に予期せぬエラー: {pathname} - {e}")
-                    
-        print(f"✅ Blobから {len(personalities)} 件のペルソナを読み込みました。")
+        # 同時接続数を制限して並列にダウンロードする
+        # (map は入力順を保つため、同名Blobの上書き順序は逐次版と同じ)
+        workers = max(1, min(BLOB_FETCH_CONCURRENCY, len(files)))
+        with span("blob_fetch"), ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_fetch_personality_blob, files))
+
+        for name, file, instruction in zip(names, files, results):
+            if instruction is not None:
+                personalities[name] = instruction
+                voice = _cached_blob_voice(file) if voices is not None else None
+                if voice:
+                    voices[name] = voice
+
+        # 一覧から消えたBlobはキャッシュからも削除する
+        live_urls = {file.get('url') for file in files}
+        with _blob_content_cache_lock:
+            for url in list(_blob_content_cache):
+                if url not in live_urls:
+                    del _blob_content_cache[url]
+
+        logger.debug(f"✅ Blobから {len(personalities)} 件のペルソナを読み込みました。")
     except Exception as e:
-        print(f"❌ Blobからのファイル一覧取得中にエラーが発生しました: {e}")
+        logger.error(f"❌ Blobからのファイル一覧取得中にエラーが発生しました: {e}")
         # エラーが発生しても、ローカルファイルからの読み込みは試行する
     return personalities
 
-def load_personalities():
-    """環境に応じてBlobまたはローカルディレクトリから人格を読み込む"""
-    print("🔄 ペルソナをロード中...")
+# --------------------------
+# ペルソナのストア (PERSONA_STORE=sqlite)
+# --------------------------
+
+_persona_store = None
+_persona_store_lock = threading.Lock()
+
+def get_persona_store():
+    """PERSONA_STORE=sqlite の場合にストアを返す (それ以外は None)
+
+    初めて開いたときにストアが空なら、personalities ディレクトリの JSON を取り込む。
+    """
+    global _persona_store
+    if PERSONA_STORE != 'sqlite':
+        return None
+    with _persona_store_lock:
+        if _persona_store is None:
+            try:
+                import persona_store
+            except ModuleNotFoundError:
+                from api import persona_store
+            store = persona_store.PersonaStore(PERSONA_STORE_PATH)
+            if len(store) == 0 and os.path.isdir('personalities'):
+                count = persona_store.import_json_dir(store, 'personalities')
+                if count:
+                    logger.info(f"📦 {count} 件のペルソナを {PERSONA_STORE_PATH} に取り込みました。")
+            _persona_store = store
+        return _persona_store
+
+def write_persona_json(file_path, text_content, voice=None):
+    """ペルソナのJSONを一時ファイルに書いてから置き換える (書き込み中に読まれても壊れたファイルを返さない)"""
+    data = {"system_instruction": text_content}
+    if voice:
+        data["voice"] = voice
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def load_personalities(blob_files=None, voices=None):
+    """環境に応じてBlobまたはローカルディレクトリから人格を読み込む
+
+    voices に辞書を渡すと、音声の設定 (JSON の "voice") のあるペルソナについて { name: 設定 } を入れる。
+    """
+    logger.debug("🔄 ペルソナをロード中...")
     personalities = {}
     
     # Vercel Blobが利用可能な場合、まずBlobから読み込む
     if BLOB_READ_WRITE_TOKEN and VERCEL_PROJECT_ID:
-        print("Blobからペルソナを読み込みます。")
+        logger.debug("Blobからペルソナを読み込みます。")
         try:
-            personalities = load_personalities_from_blob()
+            personalities = load_personalities_from_blob(blob_files, voices)
             if personalities: # Blobから読み込めた場合
                 return personalities
             else:
-                print("Blobからペルソナが見つかりませんでした。ローカルディレクトリを検索します。")
+                logger.debug("Blobからペルソナが見つかりませんでした。ローカルディレクトリを検索します。")
         except Exception as e:
-            print(f"Blobからの読み込み中にエラーが発生しました: {e}。ローカルディレクトリを検索します。")
+            logger.debug(f"Blobからの読み込み中にエラーが発生しました: {e}。ローカルディレクトリを検索します。")
+
+    store = get_persona_store()
+    if store is not None:
+        logger.debug("ストアからペルソナを読み込みます。")
+        if voices is not None:
+            voices.update(store.voices())
+        return store.get_all()
 
     # Blobから読み込めなかった場合、またはBlobが利用できない場合はローカルディレクトリを検索
-    print("ローカルディレクトリからペルソナを読み込みます。")
+    logger.debug("ローカルディレクトリからペルソナを読み込みます。")
     personalities_dir = 'personalities'
     if not os.path.exists(personalities_dir):
         os.makedirs(personalities_dir) # ディレクトリが存在しない場合は作成
-        print(f"'{personalities_dir}' ディレクトリを作成しました。")
+        logger.debug(f"'{personalities_dir}' ディレクトリを作成しました。")
 
     for filename in os.listdir(personalities_dir):
         if filename.endswith('.json'):
@@ -293,34 +1205,39 @@ def load_personalities():
                     data = json.load(f)
                     name = os.path.splitext(filename)[0] # ファイル名から拡張子を除去
                     personalities[name] = data.get("system_instruction", "")
+                    if voices is not None and data.get("voice"):
+                        voices[name] = data["voice"]
             except Exception as e:
-                print(f"❌ 人格ファイル '{filename}' の読み込みエラー: {e}")
+                logger.error(f"❌ 人格ファイル '{filename}' の読み込みエラー: {e}")
     
     if not personalities:
-        print("ローカルディレクトリにペルソナファイルが見つかりませんでした。")
+        logger.debug("ローカルディレクトリにペルソナファイルが見つかりませんでした。")
 
     return personalities
 
 def save_personality(text_content, user_defined_name=None):
     """環境に応じてBlobまたはローカルディレクトリに人格を保存する"""
-    print("📝 ペルソナを保存中...")
+    logger.debug("📝 ペルソナを保存中...")
     
     # Vercel Blobが利用可能な場合、Blobに保存する
     if BLOB_READ_WRITE_TOKEN and VERCEL_PROJECT_ID:
-        print("Blobにペルソナを保存します。")
+        logger.debug("Blobにペルソナを保存します。")
         try:
-            return save_personality_to_blob(text_content, user_defined_name)
+            name = save_personality_to_blob(text_content, user_defined_name)
+            persona_registry.invalidate() # 次回参照時にBlobから再読み込みさせる
+            chat_response_cache.invalidate_persona(name)
+            return name
         except Exception as e:
-            print(f"Blobへの保存に失敗しました: {e}。ローカルに保存を試みます。")
+            logger.warning(f"Blobへの保存に失敗しました: {e}。ローカルに保存を試みます。")
             # Blob保存失敗時でもローカル保存は試みる
             pass # fallback to local save
 
     # Blobが利用できない、または保存に失敗した場合はローカルディレクトリに保存
-    print("ローカルディレクトリにペルソナを保存します。")
+    logger.debug("ローカルディレクトリにペルソナを保存します。")
     personalities_dir = 'personalities'
     if not os.path.exists(personalities_dir):
         os.makedirs(personalities_dir)
-        print(f"'{personalities_dir}' ディレクトリを作成しました。")
+        logger.debug(f"'{personalities_dir}' ディレクトリを作成しました。")
 
     # ペルソナ名を決定
     if user_defined_name:
@@ -328,249 +1245,2074 @@ def save_personality(text_content, user_defined_name=None):
     else:
         name = generate_personality_name(text_content).replace(" ", "_").replace("/", "_")
     
-    file_path = os.path.join(personalities_dir, f"{name}.json")
-    
-    data = {"system_instruction": text_content}
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        print(f"✅ ペルソナ '{name}' をローカルに保存しました。")
+        store = get_persona_store()
+        if store is not None:
+            store.put(name, text_content)
+        else:
+            write_persona_json(os.path.join(personalities_dir, f"{name}.json"), text_content)
+        # 背景資料を含む長いペルソナは、チャット時に検索する索引も作っておく
+        save_persona_index(name, text_content, personalities_dir)
+        persona_registry.invalidate()
+        chat_response_cache.invalidate_persona(name)
+        logger.debug(f"✅ ペルソナ '{name}' をローカルに保存しました。")
         return name
     except Exception as e:
-        print(f"❌ ローカルへの保存中にエラーが発生しました: {e}")
+        logger.error(f"❌ ローカルへの保存中にエラーが発生しました: {e}")
         raise Exception(f"ローカルへの保存中にエラーが発生しました: {e}")
 
 # --------------------------
-# Fish Audio 呼び出し
+# ペルソナレジストリ (メモリキャッシュ)
 # --------------------------
 
-def get_ada_voice(text: str):
-    """Fish Audio API を使用して音声を生成する"""
-    print("🎤 音声生成を開始します...")
-    if not FISH_AUDIO_TOKEN:
-        print("Fish Audio token が設定されていません。")
-        return None
-    
-    API_URL = "https://api.fish.audio/v1/tts"
-    headers = {
-        "Authorization": f"Bearer {FISH_AUDIO_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    data = {"reference_id": FISH_AUDIO_VOICE_ID, "text": text}
-    
-    try:
-        r = requests.post(API_URL, headers=headers, json=data, timeout=30) # タイムアウトを設定
-        r.raise_for_status() # HTTPエラーチェック
-        print("✅ 音声生成完了")
-        return r.content # 音声データをバイト列で返す
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Fish Audio API エラー: {e}")
-        return None
-    except Exception as e:
-        print(f"❌ 音声生成中に予期せぬエラー: {e}")
-        return None
+class PersonaRegistry:
+    """ペルソナを一度だけ読み込んでメモリに保持し、変更を検知した場合のみ再読み込みする
 
-# --------------------------
-# エンドポイント
-# --------------------------
+    - ローカル: personalities ディレクトリの mtime (ストアを使う場合は revision) を比較する
+    - ストアを使う場合、names() と get() はすべてを読み込まずにストアを直接引く
+    - Blob: TTL が切れたら一覧を取得し、(pathname, url, uploadedAt) の組が変わっていれば再読み込みする
+      (マニフェストがある場合、一覧はマニフェストだけなので、比べるのはマニフェストの更新時刻だけになる)
+    - 保存・更新処理からは invalidate() で明示的に無効化する
+    - 読み込み (Blob一覧の確認を含む) は single flight で行い、同時に参照した呼び出し元は同じ結果を受け取る。
+      invalidate() の後の参照は、それより前に始まった読み込みには相乗りしない
+    """
 
-@app.route("/")
-def index():
-    """メインページを表示"""
-    print("🌐 indexページにアクセスされました。")
-    # template_folder="templates" の設定により、templates/index.html をレンダリング
-    return render_template('index.html')
+    def __init__(self, personalities_dir='personalities', blob_ttl=30.0):
+        self.personalities_dir = personalities_dir
+        self.blob_ttl = blob_ttl
+        self._lock = threading.Lock()
+        self._flight = singleflight.get_group("persona_load")
+        self._generation = 0 # invalidate() のたびに増やす
+        self._personalities = None
+        self._voices = {}
+        self._local_mtime = None
+        self._blob_signature = None
+        self._blob_checked_at = 0.0
 
-@app.route("/api/personalities/<name>", methods=['GET'])
-def get_personality(name):
-    """指定されたペルソナのデータを返す"""
-    print(f"👤 /api/personalities/{name} がリクエストされました。")
-    personalities = load_personalities()
-    if name in personalities:
-        return jsonify({"name": name, "system_instruction": personalities[name]})
-    else:
-        return jsonify({"error": f"ペルソナ '{name}' が見つかりません。"}), 404
+    def invalidate(self):
+        """キャッシュを破棄し、次回参照時に再読み込みさせる"""
+        with self._lock:
+            self._personalities = None
+            self._generation += 1
 
+    def get_all(self):
+        """{ name: system_instruction } 形式の辞書を返す (呼び出し側で変更しないこと)"""
+        with self._lock:
+            personalities = self._personalities
+            generation = self._generation
+            blob_due = blob_personas_enabled() and time.monotonic() - self._blob_checked_at >= self.blob_ttl
+            if personalities is not None and not blob_due and self._local_mtime == self._local_version():
+                return personalities
+        return self._flight.do(generation, self._reload, generation)
 
-@app.route("/api/personalities", methods=['GET'])
-def list_personalities():
-    """登録されているペルソナ名の一覧を返すエンドポイント。
-    フロントエンドはこのエンドポイントを呼んでセレクトボックスを構築します。
-    """
-    try:
-        personalities = load_personalities()
-        # personalities は { name: system_instruction } 形式の辞書
-        names = list(personalities.keys())
-        return jsonify({"personalities": names})
-    except Exception as e:
-        print(f"❌ ペルソナ一覧取得エラー: {e}")
-        return jsonify({"personalities": []}), 500
+    def _reload(self, generation):
+        """変更があれば読み込み直す (single flight の中で実行する)"""
+        with self._lock:
+            personalities = self._personalities
+        blob_files = None
+        if personalities is not None:
+            blob_files, changed = self._check_blob()
+            if not changed and self._local_mtime == self._local_version():
+                return personalities
+            logger.debug("🔄 ペルソナの変更を検知しました。再読み込みします。")
+        elif blob_personas_enabled():
+            blob_files = self._list_blob_files()
 
-def update_personality_local(name, text_content):
-    personalities_dir = 'personalities'
-    if not os.path.exists(personalities_dir):
-        os.makedirs(personalities_dir)
+        # 読み込み中に変更された場合に次回の参照で検知できるよう、版は読み込む前に取得する
+        local_version = self._local_version()
+        # 一覧取得済みの場合は再度 list() しないように渡す
+        voices = {}
+        with span("persona_load"):
+            personalities = load_personalities(blob_files, voices)
+        with self._lock:
+            # 読み込み中に invalidate() された場合は、古いかもしれない結果をキャッシュしない
+            if self._generation == generation:
+                self._personalities = personalities
+                self._voices = voices
+                self._local_mtime = local_version
+                if blob_files is not None:
+                    self._blob_signature = self._signature(blob_files)
+            self._blob_checked_at = time.monotonic()
+        return personalities
 
-    file_path = os.path.join(personalities_dir, f"{name}.json")
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"ペルソナ '{name}' が見つかりません。")
+    def names(self):
+        """ペルソナ名の一覧を返す"""
+        store = self._store()
+        return store.names() if store is not None else list(self.get_all())
 
-    data = {"system_instruction": text_content}
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    def get(self, name, default=None):
+        store = self._store()
+        personalities = store if store is not None else self.get_all()
+        if name not in personalities:
+            # 名前の生成が終わる前の仮の名前でも参照できるようにする
+            name = persona_naming.resolve(name)
+        return personalities.get(name, default)
 
-    return name
-    
-@app.route("/api/personalities/update", methods=['POST'])
-def update_personality():
-    """既存のペルソナを更新する"""
-    print("🔄 /api/personalities/update がリクエストされました。")
+    def voice(self, name):
+        """ペルソナの音声の設定 (JSON の "voice") を返す (未設定なら None)"""
+        store = self._store()
+        if store is None:
+            self.get_all() # 変更があれば再読み込みする
+            voices = self._voices
+            return voices.get(name) or voices.get(persona_naming.resolve(name))
+        voice = store.get_voice(name)
+        if voice is None and persona_naming.resolve(name) != name:
+            voice = store.get_voice(persona_naming.resolve(name))
+        return voice
 
-    d = request.get_json(force=True, silent=True) or {}
-    name = d.get("name", "").strip()
-    text_content = d.get("text_content", "").strip()
+    def _store(self):
+        """Blobを使わずにストアを使う場合はストアを返す"""
+        return None if blob_personas_enabled() else get_persona_store()
 
-    if not name:
-        return jsonify({"error": "name が空です。"}), 400
+    def _local_version(self):
+        store = get_persona_store()
+        if store is not None:
+            return store.revision()
+        try:
+            return os.stat(self.personalities_dir).st_mtime_ns
+        except OSError:
+            return None
 
-    if not text_content:
-        return jsonify({"error": "text_content が空です。"}), 400
+    def _list_blob_files(self):
+        try:
+            return list_personality_blobs()
+        except Exception as e:
+            logger.error(f"❌ Blob一覧の取得に失敗しました: {e}")
+            return None
 
-    personalities = load_personalities()
-    if name not in personalities:
-        return jsonify({"error": f"ペルソナ '{name}' が見つかりません。"}), 404
+    @staticmethod
+    def _signature(files):
+        return frozenset((f.get('pathname'), f.get('url'), f.get('uploadedAt')) for f in files)
 
-    try:
-        update_personality_local(name, text_content)
-        return jsonify({
-            "message": f"ペルソナ '{name}' を更新しました。",
-            "name": name
-        }), 200
-    except FileNotFoundError as e:
-        return jsonify({"error": str(e)}), 404
-    except Exception as e:
-        print(f"❌ ペルソナ更新エラー: {e}")
-        return jsonify({"error": f"更新中にエラーが発生しました: {e}"}), 500    
+    def _check_blob(self):
+        """TTLが切れていればBlob一覧を取得し、(一覧, 変更有無) を返す"""
+        if not blob_personas_enabled():
+            return None, False
+        if time.monotonic() - self._blob_checked_at < self.blob_ttl:
+            return None, False
+        files = self._list_blob_files()
+        self._blob_checked_at = time.monotonic()
+        if files is None:
+            # 一覧取得に失敗した場合は手持ちのキャッシュを使い続ける
+            return None, False
+        return files, self._signature(files) != self._blob_signature
 
-@app.route("/api/chat", methods=['POST'])
-def api_chat():
-    """ユーザーのプロンプトに対するGeminiの応答を生成する"""
-    print("💬 /api/chat がリクエストされました。")
-    if not genai_client:
-        return jsonify({"error": "Geminiクライアントが初期化されていません。APIキーを確認してください。"}), 500
+persona_registry = PersonaRegistry(blob_ttl=PERSONA_BLOB_TTL)
 
-    # JSONリクエストボディを取得、失敗した場合は空の辞書を返す
-    d = request.get_json(force=True, silent=True) or {}
-    prompt = d.get("prompt", "").strip()
-    personality_name = d.get("personality", "Default Assistant") # デフォルト値
+# --------------------------
+# ペルソナ名のバックグラウンド生成
+# --------------------------
 
-    if not prompt:
-        return jsonify({"error": "プロンプトが空です。"}), 400
+PROVISIONAL_NAME_PREFIX = "persona_"
+# 同名のペルソナがある場合に連番を付けるため、名前の確定は1件ずつ行う
+_persona_rename_lock = threading.Lock()
 
-    print(f"🤖 ペルソナ '{personality_name}' でチャットを生成中...")
-    
-    # 選択されたペルソナのシステム命令を読み込む
-    personalities = load_personalities()
-    system_instruction = personalities.get(personality_name, "あなたは親切なアシスタントです。") # デフォルトの指示
+def provisional_persona_name():
+    """名前を生成するまでの仮の名前 (例: persona_1a2b3c4d5e6f)"""
+    return f"{PROVISIONAL_NAME_PREFIX}{uuid.uuid4().hex[:12]}"
 
-    # システム命令とユーザープロンプトを結合
-    full_prompt = f"{system_instruction}\n\nユーザー入力: {prompt}"
+def _unique_persona_name(name, existing):
+    """existing と重複しない名前を返す (重複する場合は _2, _3 ... を付ける)"""
+    candidate, n = name, 1
+    while candidate in existing:
+        n += 1
+        candidate = f"{name}_{n}"
+    return candidate
 
-    try:
-        # Gemini API にリクエストを送信
-        response = genai_client.models.generate_content(
-            model= GEMINI_MODEL, # 使用するモデルを指定
-            contents=full_prompt
+def rename_personality_in_blob(old_name, new_name):
+    """Blobのマニフェスト上で名前を変更する (本文のBlobはそのまま使う)。Blobにない場合は False を返す"""
+    renamed = False
+
+    def change(personas):
+        nonlocal renamed
+        if old_name not in personas:
+            return False
+        personas[new_name] = personas.pop(old_name)
+        renamed = True
+
+    update_persona_manifest(change)
+    return renamed
+
+def _move_persona_file(src, dst):
+    """src を dst に移す。dst が既にある場合は上書きせずに FileExistsError を送出する
+
+    os.replace は移動先を黙って上書きするため、ハードリンクを張ってから元の名前を消す。
+    どの時点で参照されても、ファイルは古い名前か新しい名前のどちらかで読み込める。
+    """
+    os.link(src, dst)
+    os.unlink(src)
+
+def rename_personality(old_name, new_name, personalities_dir='personalities'):
+    """ペルソナの名前を変更し、実際に付けた名前を返す
+
+    ローカルはファイルの移動 (既存のファイルは上書きしない) またはストアの更新で、Blobはマニフェストの差し替えで行う。
+    どちらの場合も、途中で参照されても古い名前か新しい名前のどちらかで必ず読み込める。
+    """
+    base_name = new_name.replace(" ", "_").replace("/", "_")
+    with _persona_rename_lock:
+        taken = set(persona_registry.names()) - {old_name}
+        new_name = _unique_persona_name(base_name, taken)
+        if new_name == old_name:
+            return old_name
+        store = get_persona_store()
+        if not (blob_personas_enabled() and rename_personality_in_blob(old_name, new_name)):
+            old_path = os.path.join(personalities_dir, f"{old_name}.json")
+            if store is None and not os.path.exists(old_path):
+                raise FileNotFoundError(f"ペルソナ '{old_name}' が見つかりません。")
+            # save_personality はこのロックを取らずに保存するため、一覧を読んだ後に同名のペルソナが
+            # 作られることがある。その場合は上書きせず、次の連番の名前で付け直す
+            while True:
+                try:
+                    if store is not None:
+                        store.rename(old_name, new_name)
+                    else:
+                        _move_persona_file(old_path, os.path.join(personalities_dir, f"{new_name}.json"))
+                    break
+                except FileExistsError:
+                    taken.add(new_name)
+                    new_name = _unique_persona_name(base_name, taken)
+            old_index = persona_index_path(old_name, personalities_dir)
+            if os.path.exists(old_index):
+                try:
+                    _move_persona_file(old_index, persona_index_path(new_name, personalities_dir))
+                except FileExistsError:
+                    # 移動先の索引は別のペルソナのもの。古い索引は捨て、次のチャット時に作り直す
+                    os.remove(old_index)
+        persona_registry.invalidate()
+        chat_response_cache.invalidate_persona(old_name)
+    logger.debug(f"✅ ペルソナ '{old_name}' の名前を '{new_name}' に変更しました。")
+    return new_name
+
+class PersonaNamingQueue:
+    """仮の名前で保存したペルソナの名前をバックグラウンドのワーカーで生成し、付け替える
+
+    ジョブの状態: pending (待機中) -> running (生成中) -> done (名前を変更済み) / failed (仮の名前のまま)
+    名前を変更した後も、仮の名前は resolve() で新しい名前に読み替える。
+    """
+
+    def __init__(self, workers=4, max_jobs=1000):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict() # { job_id: ジョブの状態 }
+        self._aliases = {} # { 仮の名前: 確定した名前 }
+
+    def submit(self, provisional_name, text_content):
+        """名前の生成を登録し、ジョブの状態を返す"""
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": "pending",
+            "provisional_name": provisional_name,
+            "name": provisional_name,
+            "error": None,
+        }
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+            # 古い完了済みのジョブから削除する
+            for job_id in [k for k, v in self._jobs.items() if v["status"] in ("done", "failed")]:
+                if len(self._jobs) <= self.max_jobs:
+                    break
+                del self._jobs[job_id]
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix="persona-naming")
+            executor = self._executor
+        executor.submit(self._run, job["job_id"], provisional_name, text_content)
+        return dict(job)
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def snapshot(self):
+        """状態ごとのジョブ数と、完了していないジョブの一覧を返す"""
+        with self._lock:
+            jobs = [dict(job) for job in self._jobs.values()]
+        counts = {state: 0 for state in ("pending", "running", "done", "failed")}
+        for job in jobs:
+            counts[job["status"]] += 1
+        return {"counts": counts, "active": [job for job in jobs if job["status"] in ("pending", "running")]}
+
+    def resolve(self, name):
+        """仮の名前なら確定した名前を、それ以外はそのまま返す"""
+        with self._lock:
+            return self._aliases.get(name, name)
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _run(self, job_id, provisional_name, text_content):
+        self._update(job_id, status="running")
+        try:
+            name = rename_personality(provisional_name, generate_personality_name(text_content))
+        except Exception as e:
+            logger.error(f"❌ ペルソナ名の付け替えに失敗しました ({provisional_name}): {e}")
+            self._update(job_id, status="failed", error=str(e))
+            return
+        with self._lock:
+            self._aliases[provisional_name] = name
+        self._update(job_id, status="done", name=name)
+
+persona_naming = PersonaNamingQueue(workers=PERSONA_NAMING_WORKERS)
+
+def add_personality_with_provisional_name(text_content):
+    """仮の名前ですぐに保存し、名前の生成をバックグラウンドに登録する ((仮の名前, ジョブの状態) を返す)"""
+    name = save_personality(text_content, provisional_persona_name())
+    return name, persona_naming.submit(name, text_content)
+
+# --------------------------
+# ペルソナごとの音声の設定
+# --------------------------
+
+# 音声の形式 (Fish Audio の format) ごとの Content-Type と、Accept にあれば再生できるとみなす MIME タイプ
+TTS_FORMAT_MIMETYPES = {
+    "opus": ("audio/ogg", "audio/opus"),
+    "mp3": ("audio/mpeg", "audio/mp3"),
+    "wav": ("audio/wav", "audio/x-wav", "audio/wave"),
+}
+# 形式ごとに指定できるビットレート (kbps、wav は指定できない)
+TTS_FORMAT_BITRATES = {"mp3": (64, 128, 192), "opus": (24, 32, 48, 64)}
+
+class VoiceSettings:
+    """ペルソナの音声の設定 (ペルソナのJSONの "voice")
+
+    {"reference_id": "...", "speed": 1.1, "format": "opus", "bitrate": 32}
+    - reference_id: Fish Audio のボイスID (未指定なら FISH_AUDIO_VOICE_ID)
+    - speed: 話速 (0.5〜2.0、未指定なら 1.0)
+    - format: 優先する形式 (ブラウザが再生できない場合は negotiate_tts_format() で選び直す)
+    - bitrate: その形式のビットレート (kbps)
+    """
+
+    __slots__ = ("reference_id", "speed", "format", "bitrate")
+
+    def __init__(self, reference_id=None, speed=None, format=None, bitrate=None):
+        self.reference_id = reference_id
+        self.speed = speed
+        self.format = format
+        self.bitrate = bitrate
+
+    @classmethod
+    def from_dict(cls, data):
+        """JSON の "voice" から作る (不正な値は ValueError)"""
+        if not isinstance(data, dict):
+            raise ValueError("voice はオブジェクトで指定してください。")
+        unknown = set(data) - set(cls.__slots__)
+        if unknown:
+            raise ValueError(f"voice に不明な項目があります: {', '.join(sorted(unknown))}")
+        reference_id = data.get("reference_id") or None
+        if reference_id is not None and not isinstance(reference_id, str):
+            raise ValueError("reference_id は文字列で指定してください。")
+        speed = data.get("speed")
+        if speed is not None:
+            if isinstance(speed, bool) or not isinstance(speed, (int, float)) or not 0.5 <= speed <= 2.0:
+                raise ValueError("speed は 0.5 から 2.0 の間で指定してください。")
+            speed = float(speed)
+        voice_format = data.get("format")
+        if voice_format is not None and voice_format not in TTS_FORMAT_MIMETYPES:
+            raise ValueError(f"format は {' / '.join(TTS_FORMAT_MIMETYPES)} のいずれかで指定してください。")
+        bitrate = data.get("bitrate")
+        if bitrate is not None:
+            allowed = TTS_FORMAT_BITRATES.get(voice_format or "mp3", ())
+            if bitrate not in allowed:
+                raise ValueError(f"bitrate は {voice_format or 'mp3'} の場合 {allowed} のいずれかで指定してください。")
+        return cls(reference_id, speed, voice_format, bitrate)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+    def with_format(self, voice_format):
+        """形式を変えた設定を返す (ビットレートは形式が同じ場合のみ引き継ぐ)"""
+        bitrate = self.bitrate if voice_format == (self.format or "mp3") else None
+        return VoiceSettings(self.reference_id, self.speed, voice_format, bitrate)
+
+    def request_body(self, text):
+        """Fish Audio の /v1/tts に送るデータ"""
+        data = {"reference_id": self.reference_id or FISH_AUDIO_VOICE_ID, "text": text, "format": self.format or "mp3"}
+        if self.bitrate:
+            data[f"{self.format or 'mp3'}_bitrate"] = self.bitrate
+        if self.speed and self.speed != 1.0:
+            data["prosody"] = {"speed": self.speed}
+        return data
+
+    def cache_id(self):
+        """音声キャッシュのキーに含める文字列
+
+        既定の設定 (mp3・標準の話速) の場合はボイスIDだけにして、以前のキャッシュをそのまま使えるようにする。
+        """
+        reference_id = self.reference_id or FISH_AUDIO_VOICE_ID or ''
+        voice_format = self.format or "mp3"
+        if voice_format == "mp3" and not self.bitrate and self.speed in (None, 1.0):
+            return reference_id
+        return f"{reference_id}|{voice_format}|{self.bitrate or ''}|{self.speed or ''}"
+
+def persona_voice(personality_name=None):
+    """ペルソナの音声の設定を返す (ペルソナや設定がない場合は既定のボイス)"""
+    data = persona_registry.voice(personality_name) if personality_name else None
+    if not data:
+        return VoiceSettings()
+    try:
+        return VoiceSettings.from_dict(data)
+    except ValueError as e:
+        logger.warning(f"⚠️ ペルソナ '{personality_name}' の音声の設定が不正なため、既定のボイスを使います: {e}")
+        return VoiceSettings()
+
+def negotiate_tts_format(voice, accept_header):
+    """ブラウザが再生できる形式を選び、その形式にした設定を返す
+
+    ペルソナの format、TTS_FORMAT_PREFERENCE (既定: opus → mp3) の順に、Accept に含まれる最初の形式を選ぶ。
+    Accept に audio/ の形式がない (以前のクライアントや */*) 場合と、どれも受け付けない場合は mp3 にする。
+    """
+    accepted = set()
+    for value, quality in parse_accept_header(accept_header or ""):
+        if quality > 0:
+            accepted.add(value.split(";")[0].strip().lower())
+    if not any(mimetype.startswith("audio/") for mimetype in accepted):
+        return voice.with_format(voice.format or "mp3")
+    for voice_format in [voice.format, *TTS_FORMAT_PREFERENCE, "mp3"]:
+        mimetypes = TTS_FORMAT_MIMETYPES.get(voice_format)
+        if mimetypes and ("audio/*" in accepted or accepted.intersection(mimetypes)):
+            return voice.with_format(voice_format)
+    return voice.with_format("mp3")
+
+def audio_mimetype(audio):
+    """音声データの先頭のバイト列から Content-Type を決める (キャッシュには形式を保存していないため)"""
+    if audio[:4] == b"OggS":
+        return "audio/ogg"
+    if audio[:4] == b"\x1aE\xdf\xa3":
+        return "audio/webm"
+    if audio[:4] == b"RIFF":
+        return "audio/wav"
+    return "audio/mpeg"
+
+# --------------------------
+# 音声キャッシュ
+# --------------------------
+
+def tts_cache_key(text: str, voice=None) -> str:
+    """音声の設定と正規化したテキストから音声キャッシュのキーを作る"""
+    normalized = re.sub(r'\s+', ' ', text).strip()
+    voice_id = (voice or VoiceSettings()).cache_id()
+    return hashlib.sha256(f"{voice_id}\n{normalized}".encode('utf-8')).hexdigest()
+
+class TTSAudioCache:
+    """合成済み音声のキャッシュ (メモリ上のLRU + ディスク、設定時はBlobにも保存)
+
+    キーは tts_cache_key() によるコンテンツハッシュなので、同じ内容は常に同じ音声を指す。
+    """
+
+    def __init__(self, max_bytes, cache_dir=None, disk_max_bytes=0, use_blob=False):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.use_blob = use_blob
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # { key: audio }
+        self._memory_bytes = 0
+        self._disk_bytes = None  # 初回書き込み時に集計する
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "blob_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+
+    def get(self, key):
+        """キャッシュから音声を取得する (見つからなければ None)"""
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return audio
+
+        audio = self._read_disk(key)
+        if audio is not None:
+            self._count("disk_hits")
+        else:
+            audio = self._read_blob(key)
+            if audio is None:
+                self._count("misses")
+                return None
+            self._count("blob_hits")
+            self._write_disk(key, audio)
+        self._remember(key, audio)
+        return audio
+
+    def put(self, key, audio):
+        """音声をキャッシュに保存する"""
+        self._count("stores")
+        self._remember(key, audio)
+        self._write_disk(key, audio)
+        self._write_blob(key, audio)
+
+    def snapshot(self):
+        """統計情報を返す"""
+        with self._lock:
+            return dict(
+                self.stats,
+                memory_entries=len(self._memory),
+                memory_bytes=self._memory_bytes,
+                memory_max_bytes=self.max_bytes,
+                disk_bytes=self._disk_bytes or 0,
+                disk_max_bytes=self.disk_max_bytes,
+            )
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _remember(self, key, audio):
+        if len(audio) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = audio
+            self._memory_bytes += len(audio)
+            # 上限を超えたら古いものから削除する
+            while self._memory_bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self.stats["memory_evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, audio):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._disk_path(key)
+            # 一時ファイルに書いてから置き換え、読み込み中の破損を防ぐ
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+            with self._lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = self._scan_disk_bytes()
+                else:
+                    self._disk_bytes += len(audio)
+                over_limit = self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes
+            if over_limit:
+                self._trim_disk()
+        except OSError as e:
+            logger.error(f"❌ 音声キャッシュのディスク書き込みエラー: {e}")
+
+    def _scan_disk_bytes(self):
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.mp3'):
+                total += entry.stat().st_size
+        return total
+
+    def _trim_disk(self):
+        """ディスク上の古い音声から削除して上限の8割まで減らす"""
+        entries = [e for e in os.scandir(self.cache_dir) if e.name.endswith('.mp3')]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        with self._lock:
+            total = sum(e.stat().st_size for e in entries)
+            target = self.disk_max_bytes * 0.8
+            for entry in entries:
+                if total <= target:
+                    break
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    total -= size
+                    self.stats["disk_evictions"] += 1
+                except OSError:
+                    pass
+            self._disk_bytes = total
+
+    def _blob_pathname(self, key):
+        return f"tts_cache/{key}.mp3"
+
+    def _read_blob(self, key):
+        vercel_blob = get_vercel_blob() if self.use_blob and BLOB_READ_WRITE_TOKEN else None
+        if not vercel_blob:
+            return None
+        try:
+            options = {"prefix": self._blob_pathname(key), "limit": "1"}
+            blobs = blob_upstream.call(lambda timeout: vercel_blob.list(options)).get('blobs', [])
+            if not blobs:
+                return None
+            return blob_upstream.request("GET", blobs[0]['url']).content
+        except Exception as e:
+            logger.error(f"❌ 音声キャッシュのBlob読み込みエラー: {e}")
+            return None
+
+    def _write_blob(self, key, audio):
+        vercel_blob = get_vercel_blob() if self.use_blob and BLOB_READ_WRITE_TOKEN else None
+        if not vercel_blob:
+            return
+        try:
+            with blob_upstream.guard():
+                vercel_blob.put(self._blob_pathname(key), audio, {"addRandomSuffix": "false", "allowOverwrite": "true"})
+        except Exception as e:
+            logger.error(f"❌ 音声キャッシュのBlob書き込みエラー: {e}")
+
+tts_cache = TTSAudioCache(
+    TTS_CACHE_MAX_BYTES,
+    cache_dir=TTS_CACHE_DIR,
+    disk_max_bytes=TTS_CACHE_DISK_MAX_BYTES,
+    use_blob=TTS_CACHE_BLOB,
+)
+
+# --------------------------
+# Fish Audio 呼び出し
+# --------------------------
+
+# 音声合成をキャッシュのキー (ボイスとテキスト) ごとにまとめる (非同期版と共有する)
+tts_flight = singleflight.get_group("tts")
+
+def get_ada_voice(text: str, voice=None):
+    """Fish Audio API を使用して音声を生成する (voice を省略した場合は既定のボイス・mp3)"""
+    logger.debug("🎤 音声生成を開始します...")
+    if not FISH_AUDIO_TOKEN:
+        logger.warning("Fish Audio token が設定されていません。")
+        return None
+
+    # 同じボイス・同じテキストの音声は再合成しない
+    voice = voice or VoiceSettings()
+    cache_key = tts_cache_key(text, voice)
+    cached = tts_cache.get(cache_key)
+    if cached is not None:
+        logger.debug("✅ 音声キャッシュを使用しました")
+        return cached
+    
+    import requests
+    API_URL = FISH_AUDIO_API_URL
+    headers = {
+        "Authorization": f"Bearer {FISH_AUDIO_TOKEN}",
+        "Content-Type": "application/json"
+    }
+    data = voice.request_body(text)
+
+    def synthesize():
+        # 同じテキストの合成は何度送っても結果が変わらないため、一時的なエラーは TTS_DEADLINE 内で再試行する
+        with span("tts"):
+            r = fish_audio_upstream.request(
+                "POST", API_URL, deadline=upstream.Deadline(TTS_DEADLINE), idempotent=True, headers=headers, json=data
+            )
+        logger.debug("✅ 音声生成完了")
+        tts_cache.put(cache_key, r.content)
+        return r.content
+
+    try:
+        # 同じボイス・同じテキストの合成が実行中なら、その結果 (エラーを含む) を待って受け取る
+        return tts_flight.do(cache_key, synthesize) # 音声データをバイト列で返す
+    except upstream.UpstreamError as e:
+        # サーキットブレーカーが開いている場合や期限切れの場合は、待たずにすぐ失敗を返す
+        logger.warning(f"⚠️ Fish Audio API を呼び出せません: {e}")
+        return None
+    except requests.exceptions.RequestException as e:
+        logger.error(f"❌ Fish Audio API エラー: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"❌ 音声生成中に予期せぬエラー: {e}")
+        return None
+
+def synthesize_sentences(sentences, voice=None):
+    """文ごとの音声を並列に合成し、入力順に音声データを返すジェネレータ
+
+    同時に合成中の文は TTS_CONCURRENCY 件までに制限する。
+    合成に失敗した文はスキップする。
+    """
+    if not sentences:
+        return
+    workers = max(1, min(TTS_CONCURRENCY, len(sentences)))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [executor.submit(get_ada_voice, sentence, voice) for sentence in sentences[:workers]]
+        next_index = workers
+        while futures:
+            audio = futures.pop(0).result()
+            # 1件受け取るごとに次の文を投入する (スライディングウィンドウ)
+            if next_index < len(sentences):
+                futures.append(executor.submit(get_ada_voice, sentences[next_index], voice))
+                next_index += 1
+            if audio:
+                yield audio
+    finally:
+        # クライアント切断時などは未着手の合成をキャンセルする
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def warm_tts_connections(count=None):
+    """Fish Audio への接続を count 本 (既定: TTS_WARM_CONNECTIONS) 開いて接続プールに入れておく
+
+    接続はボイスではなくホストごとに使い回されるため、どのペルソナのボイスの合成でも
+    最初のリクエストで TCP/TLS の接続を待たずに済む。応答の内容は見ない (HEAD に 405 が返ってもよい)。
+    """
+    count = TTS_WARM_CONNECTIONS if count is None else count
+    if not FISH_AUDIO_TOKEN or count <= 0:
+        return 0
+    session = fish_audio_upstream.session
+
+    def connect(_):
+        try:
+            session.head(FISH_AUDIO_API_URL, timeout=fish_audio_upstream.connect_timeout).close()
+            return True
+        except Exception as e:
+            logger.debug(f"Fish Audio への接続を開けませんでした: {e}")
+            return False
+
+    # 同時に送ることで、それぞれ別の接続を開かせる
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        opened = sum(executor.map(connect, range(count)))
+    logger.debug(f"🔌 Fish Audio への接続を {opened} 本開きました。")
+    return opened
+
+# --------------------------
+# 会話セッション
+# --------------------------
+
+DEFAULT_SYSTEM_INSTRUCTION = "あなたは親切なアシスタントです。"
+
+class ChatSessionStore:
+    """セッションごとの会話履歴を保持する (メモリ上のLRU、設定時はディレクトリにも保存)
+
+    履歴は {"role": "user" | "model", "text": ...} のリストで、
+    合計文字数が max_history_chars を超えたら古いやり取りから削除する。
+    """
+
+    def __init__(self, max_sessions=1000, ttl=3600.0, max_history_chars=8000, persist_dir=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_history_chars = max_history_chars
+        self.persist_dir = persist_dir
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # { session_id: {"persona", "history", "updated_at"} }
+
+    def resolve_id(self, session_id):
+        """このサーバーが発行した有効なセッションのIDならそのまま、そうでなければ新しいIDを発行する
+
+        クライアントが決めたIDや期限切れのIDは使わない (新しいセッションとして扱う)。
+        """
+        if isinstance(session_id, str) and re.fullmatch(r'[0-9a-f]{32}', session_id):
+            with self._lock:
+                if self._get(session_id) is not None:
+                    return session_id
+        return uuid.uuid4().hex
+
+    def get_history(self, session_id, persona):
+        """ペルソナが一致するセッションの履歴のコピーを返す (一致しなければ空)"""
+        with self._lock:
+            session = self._get(session_id)
+            if session is None or session["persona"] != persona:
+                return []
+            return list(session["history"])
+
+    def append(self, session_id, persona, user_text, model_text):
+        """1往復分のやり取りを履歴に追加する (ペルソナが変わった場合は履歴を作り直す)"""
+        with self._lock:
+            session = self._get(session_id)
+            if session is None or session["persona"] != persona:
+                session = {"persona": persona, "history": []}
+            session["history"].append({"role": "user", "text": user_text})
+            session["history"].append({"role": "model", "text": model_text})
+            self._trim(session["history"])
+            session["updated_at"] = time.time()
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._save(session_id, session)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self.persist_dir:
+            try:
+                os.remove(self._path(session_id))
+            except OSError:
+                pass
+
+    def _get(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._load(session_id)
+            if session is None:
+                return None
+            self._sessions[session_id] = session
+        if time.time() - session["updated_at"] > self.ttl:
+            del self._sessions[session_id]
+            return None
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _trim(self, history):
+        total = sum(len(turn["text"]) for turn in history)
+        # 直近のやり取りは残したまま、古いやり取りから1往復ずつ削除する
+        while total > self.max_history_chars and len(history) > 2:
+            for turn in history[:2]:
+                total -= len(turn["text"])
+            del history[:2]
+
+    def _path(self, session_id):
+        return os.path.join(self.persist_dir, f"{session_id}.json")
+
+    def _load(self, session_id):
+        if not self.persist_dir:
+            return None
+        try:
+            with open(self._path(session_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _save(self, session_id, session):
+        if not self.persist_dir:
+            return
+        try:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.persist_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(session, f, ensure_ascii=False)
+                os.replace(tmp_path, self._path(session_id))
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        except OSError as e:
+            logger.error(f"❌ セッションの保存中にエラーが発生しました: {e}")
+
+chat_sessions = ChatSessionStore(
+    max_sessions=CHAT_SESSION_MAX,
+    ttl=CHAT_SESSION_TTL,
+    max_history_chars=CHAT_HISTORY_MAX_CHARS,
+    persist_dir=CHAT_SESSION_DIR,
+)
+
+def persona_content_hash(system_instruction):
+    """ペルソナ本文のハッシュ (内容が変わればキャッシュのキーも変わる)"""
+    return hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+
+# Geminiのコンテキストキャッシュ { (ペルソナ名, 本文のハッシュ, モデル): (キャッシュ名 or None, 有効期限) }
+# (最大 PERSONA_CONTEXT_CACHE_MAX 件の LRU。期限切れのものは追加のたびに取り除く)
+_persona_context_caches = OrderedDict()
+_persona_context_caches_lock = threading.Lock()
+
+def get_persona_context_cache(personality_name, system_instruction):
+    """長いペルソナをGeminiのコンテキストキャッシュに載せ、そのキャッシュ名を返す
+
+    短いペルソナや作成に失敗した場合は None を返し、呼び出し側は system_instruction を直接渡す。
+    """
+    if len(system_instruction) < PERSONA_CONTEXT_CACHE_MIN_CHARS:
+        return None
+    key = (personality_name, persona_content_hash(system_instruction), GEMINI_MODEL)
+    now = time.time()
+    with _persona_context_caches_lock:
+        entry = _persona_context_caches.get(key)
+        if entry is not None and entry[1] > now:
+            _persona_context_caches.move_to_end(key)
+            return entry[0]
+
+    from google.genai import types as genai_types
+    try:
+        with span("llm_cache_create"):
+            cache = get_genai_client().caches.create(
+                model=GEMINI_MODEL,
+                config=genai_types.CreateCachedContentConfig(
+                    display_name=f"persona-{key[1][:16]}",
+                    system_instruction=system_instruction,
+                    ttl=f"{PERSONA_CONTEXT_CACHE_TTL}s"
+                )
+            )
+        # 期限切れ直前のキャッシュを使わないよう、少し早めに作り直す
+        entry = (cache.name, now + PERSONA_CONTEXT_CACHE_TTL - 60)
+        logger.debug(f"✅ ペルソナ '{personality_name}' のコンテキストキャッシュを作成しました。")
+    except Exception as e:
+        logger.error(f"❌ コンテキストキャッシュの作成に失敗しました: {e}")
+        # 失敗した場合はしばらく再作成を試みない
+        entry = (None, now + 300)
+    with _persona_context_caches_lock:
+        for expired in [k for k, (_, expires_at) in _persona_context_caches.items() if expires_at <= now]:
+            del _persona_context_caches[expired]
+        _persona_context_caches[key] = entry
+        _persona_context_caches.move_to_end(key)
+        while len(_persona_context_caches) > PERSONA_CONTEXT_CACHE_MAX:
+            _persona_context_caches.popitem(last=False)
+    return entry[0]
+
+# --------------------------
+# ペルソナの背景資料の検索
+# --------------------------
+
+# この見出しより後ろを背景資料として扱う (見出しがない場合は PERSONA_CORE_MAX_CHARS で区切る)
+_BACKGROUND_HEADING_RE = re.compile(r'^\s*(?:#+\s*)?(?:背景|背景資料|参考資料|資料|Background)\s*[:：]?\s*$|^\s*(?:背景|参考資料)[:：]', re.MULTILINE | re.IGNORECASE)
+_PASSAGE_SENTENCE_RE = re.compile(r'[^。！？!?\n]+[。！？!?]*\n?|\n')
+_RETRIEVAL_SPLIT_RE = re.compile(r'[\W_]+')
+
+def split_persona_instruction(system_instruction):
+    """長いペルソナを (基本指示, 背景資料の断片のリスト) に分ける"""
+    match = _BACKGROUND_HEADING_RE.search(system_instruction)
+    if match and match.start() <= PERSONA_CORE_MAX_CHARS:
+        core, background = system_instruction[:match.start()], system_instruction[match.start():]
+    else:
+        # 行単位で PERSONA_CORE_MAX_CHARS まで基本指示に入れ、残りを背景資料とする
+        core_len = 0
+        for line in system_instruction.splitlines(keepends=True):
+            if core_len + len(line) > PERSONA_CORE_MAX_CHARS:
+                break
+            core_len += len(line)
+        core, background = system_instruction[:core_len], system_instruction[core_len:]
+
+    # 背景資料は文の区切りで PERSONA_PASSAGE_CHARS 程度の断片にまとめる
+    passages = []
+    current = ""
+    for sentence in _PASSAGE_SENTENCE_RE.findall(background):
+        if current and len(current) + len(sentence) > PERSONA_PASSAGE_CHARS:
+            passages.append(current.strip())
+            current = ""
+        current += sentence
+    if current.strip():
+        passages.append(current.strip())
+    return core.strip(), [passage for passage in passages if passage]
+
+def retrieval_tokens(text):
+    """検索用のトークン列を返す (日本語は分かち書きせず、文字の2-gramを使う)"""
+    tokens = []
+    for run in _RETRIEVAL_SPLIT_RE.split(unicodedata.normalize('NFKC', text).casefold()):
+        if len(run) <= 2:
+            if run:
+                tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+class PersonaIndex:
+    """ペルソナの背景資料の断片に対する BM25 の索引 (外部サービスは使わない)"""
+
+    VERSION = 1
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, content_hash, core, passages, term_freqs):
+        self.content_hash = content_hash
+        self.core = core
+        self.passages = passages
+        self.term_freqs = term_freqs  # 断片ごとの { token: 出現回数 }
+        self.doc_lens = [sum(tf.values()) for tf in term_freqs]
+        self.avg_doc_len = (sum(self.doc_lens) / len(self.doc_lens)) if self.doc_lens else 0.0
+        doc_freqs = {}
+        for tf in term_freqs:
+            for token in tf:
+                doc_freqs[token] = doc_freqs.get(token, 0) + 1
+        n = len(passages)
+        self.idf = {token: math.log((n - df + 0.5) / (df + 0.5) + 1) for token, df in doc_freqs.items()}
+
+    @classmethod
+    def build(cls, system_instruction):
+        core, passages = split_persona_instruction(system_instruction)
+        term_freqs = []
+        for passage in passages:
+            tf = {}
+            for token in retrieval_tokens(passage):
+                tf[token] = tf.get(token, 0) + 1
+            term_freqs.append(tf)
+        return cls(persona_content_hash(system_instruction), core, passages, term_freqs)
+
+    def search(self, query, k):
+        """クエリに関連する断片を最大 k 件、元の順序で返す"""
+        query_tokens = set(retrieval_tokens(query))
+        scores = []
+        for i, tf in enumerate(self.term_freqs):
+            norm = self.K1 * (1 - self.B + self.B * self.doc_lens[i] / (self.avg_doc_len or 1))
+            score = 0.0
+            for token in query_tokens:
+                freq = tf.get(token)
+                if freq:
+                    score += self.idf[token] * freq * (self.K1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((score, i))
+        top = sorted(scores, reverse=True)[:k]
+        return [self.passages[i] for _, i in sorted(top, key=lambda item: item[1])]
+
+    def to_dict(self):
+        return {
+            "version": self.VERSION,
+            "content_hash": self.content_hash,
+            "core": self.core,
+            "passages": self.passages,
+            "term_freqs": self.term_freqs,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != cls.VERSION:
+            raise ValueError(f"索引のバージョンが異なります: {data.get('version')}")
+        return cls(data["content_hash"], data["core"], data["passages"], data["term_freqs"])
+
+# 読み込み済みの索引 { name: PersonaIndex }
+_persona_indexes = {}
+_persona_indexes_lock = threading.Lock()
+
+def uses_persona_retrieval(system_instruction):
+    """背景資料の検索を使う長さのペルソナかどうか"""
+    return 0 < PERSONA_RETRIEVAL_MIN_CHARS <= len(system_instruction)
+
+def persona_index_path(name, personalities_dir='personalities'):
+    """索引の保存先 (ペルソナのJSONと同じディレクトリの <name>.index)"""
+    return os.path.join(personalities_dir, f"{name}.index")
+
+def save_persona_index(name, system_instruction, personalities_dir='personalities'):
+    """ペルソナの索引を作成してJSONの隣に保存する (短いペルソナの場合は古い索引を削除して None を返す)"""
+    path = persona_index_path(name, personalities_dir)
+    if not uses_persona_retrieval(system_instruction):
+        with _persona_indexes_lock:
+            _persona_indexes.pop(name, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    with span("persona_index_build"):
+        persona_index = PersonaIndex.build(system_instruction)
+    with _persona_indexes_lock:
+        _persona_indexes[name] = persona_index
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=personalities_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(persona_index.to_dict(), f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except BaseException:
+            # 書き込みに失敗した一時ファイルを残さない
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.debug(f"✅ ペルソナ '{name}' の索引を保存しました ({len(persona_index.passages)} 件の断片)。")
+    except OSError as e:
+        # 読み取り専用の環境 (Vercel など) ではメモリ上の索引だけを使う
+        logger.warning(f"⚠️ ペルソナ '{name}' の索引を保存できませんでした: {e}")
+    return persona_index
+
+def get_persona_index(name, system_instruction):
+    """ペルソナの索引を返す (メモリ → 保存済みファイル → 作成の順、短いペルソナは None)"""
+    if not uses_persona_retrieval(system_instruction):
+        return None
+    content_hash = persona_content_hash(system_instruction)
+    with _persona_indexes_lock:
+        persona_index = _persona_indexes.get(name)
+    if persona_index is not None and persona_index.content_hash == content_hash:
+        return persona_index
+
+    try:
+        with open(persona_index_path(name), 'r', encoding='utf-8') as f:
+            persona_index = PersonaIndex.from_dict(json.load(f))
+        if persona_index.content_hash == content_hash:
+            with _persona_indexes_lock:
+                _persona_indexes[name] = persona_index
+            return persona_index
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug(f"ペルソナ '{name}' の保存済みの索引を使えません: {e}")
+
+    # 索引がない・内容が変わった場合は作り直す (Blob のペルソナもここで作成する)
+    if os.path.exists(os.path.join('personalities', f"{name}.json")):
+        return save_persona_index(name, system_instruction)
+    persona_index = PersonaIndex.build(system_instruction)
+    with _persona_indexes_lock:
+        _persona_indexes[name] = persona_index
+    return persona_index
+
+def build_persona_instruction(personality_name, system_instruction, query):
+    """長いペルソナは基本指示とクエリに関連する背景資料の断片だけにした system_instruction を返す"""
+    persona_index = get_persona_index(personality_name, system_instruction)
+    if persona_index is None:
+        return system_instruction
+    with span("retrieval"):
+        passages = persona_index.search(query, PERSONA_RETRIEVAL_TOP_K)
+    if not passages:
+        return persona_index.core
+    background = "\n\n".join(passages)
+    return f"{persona_index.core}\n\n以下はこの質問に関連する背景資料の抜粋です。\n\n{background}"
+
+# --------------------------
+# 応答キャッシュ
+# --------------------------
+
+class ChatResponseCache:
+    """同じペルソナへの同じプロンプトに対する応答を保持する (TTL付きのLRU)
+
+    キーは (ペルソナ名, ペルソナ本文のハッシュ, モデル, 正規化したプロンプト) で、
+    Markdown の変換結果 (html / plain) も保存し、ヒットした場合は変換も省略する。
+    """
+
+    # 末尾の句読点・空白は区別しない ("自己紹介して。" と "自己紹介して" を同じキーにする)
+    _TRAILING_PUNCTUATION_RE = re.compile(r'[\s。．.！!？?]+$')
+
+    def __init__(self, max_entries=512, ttl=3600.0, enabled=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # { key: (expires_at, {"text", "html", "plain"}) }
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @classmethod
+    def normalize_prompt(cls, prompt):
+        """全角・半角や大文字・小文字、空白の違いを吸収したプロンプトを返す"""
+        text = unicodedata.normalize('NFKC', prompt).casefold()
+        text = " ".join(text.split())
+        return cls._TRAILING_PUNCTUATION_RE.sub('', text)
+
+    def make_key(self, personality_name, system_instruction, model, prompt):
+        return (personality_name, persona_content_hash(system_instruction), model, self.normalize_prompt(prompt))
+
+    def get(self, key):
+        """キャッシュした応答を返す (見つからない・期限切れの場合は None)"""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, text, html_content, plain_text):
+        if key is None or not text:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, {"text": text, "html": html_content, "plain": plain_text})
+            self._entries.move_to_end(key)
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate_persona(self, personality_name):
+        """指定したペルソナの応答をすべて削除する (ペルソナの更新時に呼ぶ)"""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == personality_name]
+            for key in keys:
+                del self._entries[key]
+            self.stats["invalidations"] += len(keys)
+        return len(keys)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), max_entries=self.max_entries, enabled=self.enabled)
+
+chat_response_cache = ChatResponseCache(
+    max_entries=CHAT_RESPONSE_CACHE_MAX,
+    ttl=CHAT_RESPONSE_CACHE_TTL,
+    enabled=CHAT_RESPONSE_CACHE,
+)
+
+def chat_response_cache_key(personality_name, prompt, history=()):
+    """応答キャッシュのキーを返す (キャッシュが無効な場合や、会話の途中で履歴がある場合は None)"""
+    if not chat_response_cache.enabled or history:
+        return None
+    system_instruction = persona_registry.get(personality_name, DEFAULT_SYSTEM_INSTRUCTION)
+    return chat_response_cache.make_key(personality_name, system_instruction, GEMINI_MODEL, prompt)
+
+def build_chat_request(personality_name, prompt, history=()):
+    """Geminiに渡す contents と config を作る
+
+    ペルソナはプロンプトに連結せず system_instruction として渡し、会話履歴を contents の前に並べる。
+    背景資料を含む長いペルソナは、基本指示とプロンプト (と直前の発言) に関連する断片だけを渡す。
+    索引を使わない長いペルソナはコンテキストキャッシュに載せる。
+    """
+    from google.genai import types as genai_types
+    system_instruction = persona_registry.get(personality_name, DEFAULT_SYSTEM_INSTRUCTION)
+    last_user_text = next((turn["text"] for turn in reversed(history) if turn["role"] == "user"), "")
+    system_instruction = build_persona_instruction(personality_name, system_instruction, f"{last_user_text}\n{prompt}")
+    contents = [
+        genai_types.Content(role=turn["role"], parts=[genai_types.Part(text=turn["text"])])
+        for turn in history
+    ]
+    contents.append(genai_types.Content(role="user", parts=[genai_types.Part(text=prompt)]))
+
+    cache_name = get_persona_context_cache(personality_name, system_instruction)
+    if cache_name:
+        config = genai_types.GenerateContentConfig(cached_content=cache_name)
+    else:
+        config = genai_types.GenerateContentConfig(system_instruction=system_instruction)
+    return contents, config
+
+# --------------------------
+# バッチ実行
+# --------------------------
+
+# 429 のエラーに含まれる再試行までの待ち時間 (例: 'retryDelay': '30s')
+_RETRY_DELAY_RE = re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s")
+
+def parse_chat_batch(lines):
+    """JSONL の各行を {"index", "id", "prompt", "personality"} に変換する (不正な行は "error" を付ける)"""
+    items = []
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        item = {"index": line_no, "id": None}
+        try:
+            d = json.loads(line)
+            if not isinstance(d, dict):
+                raise ValueError("JSONオブジェクトではありません")
+            item["id"] = d.get("id")
+            item["prompt"] = str(d.get("prompt", "")).strip()
+            item["personality"] = d.get("persona") or d.get("personality") or "Default Assistant"
+            if not item["prompt"]:
+                item["error"] = "プロンプトが空です。"
+        except ValueError as e:
+            item["error"] = f"JSONの解析に失敗しました: {e}"
+        items.append(item)
+    return items
+
+def gemini_retry_delay(error):
+    """再試行できるエラーなら待ち時間の下限 (秒、指定がなければ 0) を、できなければ None を返す"""
+    if isinstance(error, upstream.CircuitOpenError):
+        # Gemini が落ちているとみなされている間は、ブレーカーが試行を再開するまで待つ
+        return gemini_upstream.breaker.reset_timeout
+    if not upstream.default_is_retryable(error):
+        return None
+    match = _RETRY_DELAY_RE.search(str(error))
+    return float(match.group(1)) if match else 0.0
+
+class RateLimitGate:
+    """429 を受けたら、すべてのワーカーの次の呼び出しを一定時間止める"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def pause(self, seconds):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    def wait(self):
+        while True:
+            with self._lock:
+                remaining = self._resume_at - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+def generate_chat_response(personality_name, prompt):
+    """会話履歴なしで1件の応答を生成する ({"text", "html", "plain", "cached"} を返す)"""
+    cache_key = chat_response_cache_key(personality_name, prompt)
+    cached = chat_response_cache.get(cache_key)
+    if cached is not None:
+        return dict(cached, cached=True)
+    contents, config = build_chat_request(personality_name, prompt)
+    with span("llm"):
+        # 再試行は run_chat_batch_item() がレート制限の待ち時間と合わせて行う
+        response = generate_gemini_content(model=GEMINI_MODEL, contents=contents, config=config, max_retries=0)
+    md_text = getattr(response, "text", None) or ""
+    with span("markdown_render"):
+        html_content = markdown_to_html(md_text)
+        plain_text = markdown_to_plaintext(md_text)
+    chat_response_cache.put(cache_key, md_text, html_content, plain_text)
+    return {"text": md_text, "html": html_content, "plain": plain_text, "cached": False}
+
+def run_chat_batch_item(item, gate, max_retries, base_delay=1.0, max_delay=60.0):
+    """1件分を実行し、結果の辞書を返す (再試行できるエラーは指数バックオフ + ジッターで再試行する)"""
+    result = {"index": item["index"], "id": item["id"], "personality": item.get("personality")}
+    if "error" in item:
+        return dict(result, status="error", error=item["error"], attempts=0, latency_ms=0.0)
+
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        gate.wait()
+        try:
+            output = generate_chat_response(item["personality"], item["prompt"])
+            result.update(output, status="ok")
+            break
+        except Exception as e:
+            retry_after = gemini_retry_delay(e)
+            if retry_after is None or attempt > max_retries:
+                logger.error(f"❌ バッチ {item['index']} 行目の生成に失敗しました: {e}")
+                result.update(status="error", error=f"Gemini API エラー: {e}")
+                break
+            delay = max(retry_after, min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            if getattr(e, "code", None) == 429:
+                gate.pause(delay) # レート制限中は他のワーカーも待たせる
+            logger.warning(f"⚠️ バッチ {item['index']} 行目を {delay:.1f} 秒後に再試行します ({attempt}/{max_retries}): {e}")
+            time.sleep(delay)
+    result["attempts"] = attempt
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+def percentile(values, p):
+    """値のリストの p パーセンタイル (最近傍順位)"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+def run_chat_batch(items, concurrency=None, max_retries=None):
+    """items を同時に concurrency 件まで実行し、完了した順に結果を返すジェネレーター
+
+    最後に {"summary": {...}} (件数・所要時間・スループット・レイテンシの分布) を返す。
+    """
+    concurrency = max(1, min(concurrency or CHAT_BATCH_CONCURRENCY, CHAT_BATCH_MAX_CONCURRENCY))
+    max_retries = CHAT_BATCH_MAX_RETRIES if max_retries is None else max(0, max_retries)
+    gate = RateLimitGate()
+    latencies = []
+    counts = {"ok": 0, "error": 0, "cached": 0, "retries": 0}
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        # 計測中のリクエストのコンテキストを引き継ぎ、各段階の所要時間をまとめて記録する
+        futures = [
+            executor.submit(contextvars.copy_context().run, run_chat_batch_item, item, gate, max_retries)
+            for item in items
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            counts[result["status"]] += 1
+            counts["cached"] += bool(result.get("cached"))
+            counts["retries"] += max(0, result["attempts"] - 1)
+            if result["status"] == "ok":
+                latencies.append(result["latency_ms"])
+            yield result
+    finally:
+        # クライアントが切断した場合などは未実行の項目を取り消す
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    wall = time.perf_counter() - start
+    yield {"summary": dict(
+        counts,
+        total=len(items),
+        concurrency=concurrency,
+        wall_s=round(wall, 3),
+        throughput_per_s=round(len(items) / wall, 2) if wall > 0 else None,
+        latency_ms={
+            "mean": round(sum(latencies) / len(latencies), 1) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+    )}
+
+# --------------------------
+# 音声入力
+# --------------------------
+
+STT_PROMPT = "この音声を日本語で文字起こししてください。話された内容の文字列だけを答え、説明は含めないでください。"
+
+class GeminiTranscriber:
+    """Gemini に WAV を渡して文字起こしする"""
+
+    def transcribe(self, pcm, sample_rate):
+        from google.genai import types as genai_types
+        audio = genai_types.Part.from_bytes(data=speech_input.pcm_to_wav(pcm, sample_rate), mime_type="audio/wav")
+        response = generate_gemini_content(
+            model=GEMINI_MODEL, contents=[STT_PROMPT, audio], deadline=upstream.Deadline(CHAT_DEADLINE)
         )
+        return (getattr(response, "text", None) or "").strip()
+
+speech_input.register_transcriber("gemini", GeminiTranscriber)
+
+def create_vad(sample_rate):
+    return speech_input.EnergyVAD(
+        sample_rate=sample_rate, end_silence_ms=STT_END_SILENCE_MS, max_utterance_s=STT_MAX_UTTERANCE_S
+    )
+
+def utterance_events(pcm, sample_rate, personality_name, session_id, chat=True):
+    """発話の音声を文字起こしし、続けてチャットの応答を (イベント名, データ) の組で返す
+
+    イベント: transcript {"text", "duration", "latency_ms"} の後、chat が真なら /api/chat/stream と同じ
+    delta / done / error。文字起こしに失敗した場合や結果が空の場合は error を返す。
+    """
+    speech_ended = time.perf_counter()
+    try:
+        with span("stt"):
+            text = speech_input.get_transcriber(STT_BACKEND).transcribe(pcm, sample_rate)
+    except Exception as e:
+        logger.error(f"❌ 文字起こしエラー: {e}")
+        yield "error", {"error": f"文字起こしエラー: {e}"}
+        return
+    yield "transcript", {
+        "text": text,
+        "duration": round(len(pcm) / speech_input.SAMPLE_WIDTH / sample_rate, 3),
+        "latency_ms": round((time.perf_counter() - speech_ended) * 1000, 1),
+    }
+    if not text:
+        yield "error", {"error": "音声を認識できませんでした。"}
+        return
+    if not chat:
+        return
+
+    genai_client = get_genai_client()
+    if not genai_client:
+        yield "error", {"error": "Geminiクライアントが初期化されていません。APIキーを確認してください。"}
+        return
+    history = chat_sessions.get_history(session_id, personality_name)
+    first_token = True
+    for event, data in chat_stream_events(genai_client, personality_name, text, session_id, history):
+        if first_token and event in ("delta", "done"):
+            # 発話の終わりから応答の最初の断片までの時間 (音声入力の体感の待ち時間)
+            record_span("stt_first_token", time.perf_counter() - speech_ended)
+            first_token = False
+        yield event, data
+
+# --------------------------
+# エンドポイント
+# --------------------------
+
+@app.route("/")
+def index():
+    """メインページを表示"""
+    logger.debug("🌐 indexページにアクセスされました。")
+    # template_folder="templates" の設定により、templates/index.html をレンダリング
+    return render_template('index.html')
+
+@app.route("/api/personalities/<name>", methods=['GET'])
+def get_personality(name):
+    """指定されたペルソナのデータを返す"""
+    logger.debug(f"👤 /api/personalities/{name} がリクエストされました。")
+    system_instruction = persona_registry.get(name)
+    if system_instruction is not None:
+        return jsonify({
+            "name": persona_naming.resolve(name),
+            "system_instruction": system_instruction,
+            "voice": persona_registry.voice(name),
+        })
+    else:
+        return jsonify({"error": f"ペルソナ '{name}' が見つかりません。"}), 404
+
+
+@app.route("/api/personalities", methods=['GET'])
+def list_personalities():
+    """登録されているペルソナ名の一覧を返すエンドポイント。
+    フロントエンドはこのエンドポイントを呼んでセレクトボックスを構築します。
+    """
+    try:
+        # ストアを使う場合は本文を読まずに名前だけを取得する
+        return jsonify({"personalities": persona_registry.names()})
+    except Exception as e:
+        logger.error(f"❌ ペルソナ一覧取得エラー: {e}")
+        return jsonify({"personalities": []}), 500
+
+def update_personality_local(name, text_content, voice=None):
+    """ローカルのペルソナを更新する (voice が None なら音声の設定はそのまま、空の辞書なら削除する)"""
+    personalities_dir = 'personalities'
+    if not os.path.exists(personalities_dir):
+        os.makedirs(personalities_dir)
+
+    store = get_persona_store()
+    if store is not None:
+        store.update(name, text_content) # 存在しない場合は FileNotFoundError
+        if voice is not None:
+            store.set_voice(name, voice or None)
+    else:
+        file_path = os.path.join(personalities_dir, f"{name}.json")
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"ペルソナ '{name}' が見つかりません。")
+        if voice is None:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                voice = json.load(f).get("voice")
+        write_persona_json(file_path, text_content, voice)
+    save_persona_index(name, text_content, personalities_dir)
+
+    # 上書きではディレクトリのmtimeが変わらないため明示的に無効化する
+    persona_registry.invalidate()
+    chat_response_cache.invalidate_persona(name)
+    return name
+    
+@app.route("/api/personalities/update", methods=['POST'])
+def update_personality():
+    """既存のペルソナを更新する"""
+    logger.debug("🔄 /api/personalities/update がリクエストされました。")
+
+    d = request.get_json(force=True, silent=True) or {}
+    name = d.get("name", "").strip()
+    text_content = d.get("text_content", "").strip()
+
+    if not name:
+        return jsonify({"error": "name が空です。"}), 400
+
+    if not text_content:
+        return jsonify({"error": "text_content が空です。"}), 400
+
+    # 音声の設定は指定した場合のみ変更する ({} で削除)
+    voice = d.get("voice")
+    if voice is not None:
+        try:
+            voice = VoiceSettings.from_dict(voice).to_dict()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    if persona_registry.get(name) is None:
+        return jsonify({"error": f"ペルソナ '{name}' が見つかりません。"}), 404
+
+    try:
+        # Blobを使う場合はBlobのペルソナを更新する (Blobにない場合はローカルを更新する)
+        if not (blob_personas_enabled() and update_personality_blob(name, text_content, voice)):
+            update_personality_local(name, text_content, voice)
+        return jsonify({
+            "message": f"ペルソナ '{name}' を更新しました。",
+            "name": name
+        }), 200
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        logger.error(f"❌ ペルソナ更新エラー: {e}")
+        return jsonify({"error": f"更新中にエラーが発生しました: {e}"}), 500    
+
+@app.route("/api/chat", methods=['POST'])
+def api_chat():
+    """ユーザーのプロンプトに対するGeminiの応答を生成する"""
+    logger.debug("💬 /api/chat がリクエストされました。")
+    genai_client = get_genai_client()
+    if not genai_client:
+        return jsonify({"error": "Geminiクライアントが初期化されていません。APIキーを確認してください。"}), 500
+
+    # JSONリクエストボディを取得、失敗した場合は空の辞書を返す
+    d = request.get_json(force=True, silent=True) or {}
+    prompt = d.get("prompt", "").strip()
+    personality_name = d.get("personality", "Default Assistant") # デフォルト値
+
+    if not prompt:
+        return jsonify({"error": "プロンプトが空です。"}), 400
+
+    logger.debug(f"🤖 ペルソナ '{personality_name}' でチャットを生成中...")
+    session_id = chat_sessions.resolve_id(d.get("session_id"))
+    history = chat_sessions.get_history(session_id, personality_name)
+
+    # 同じペルソナへの同じプロンプトなら、Geminiを呼ばずにキャッシュした応答を返す
+    cache_key = chat_response_cache_key(personality_name, prompt, history)
+    cached = chat_response_cache.get(cache_key)
+    if cached is not None:
+        chat_sessions.append(session_id, personality_name, prompt, cached["text"])
+        logger.debug("✅ 応答キャッシュを使用しました。")
+        return jsonify({"html": cached["html"], "plain": cached["plain"], "session_id": session_id, "cached": True})
+
+    try:
+        # ペルソナの読み込み・コンテキストキャッシュ・背景資料の検索で失敗しても JSON のエラーを返す
+        contents, config = build_chat_request(personality_name, prompt, history)
+        # Gemini API にリクエストを送信
+        with span("llm"):
+            response = generate_gemini_content(
+                model= GEMINI_MODEL, # 使用するモデルを指定
+                contents=contents,
+                config=config,
+                deadline=upstream.Deadline(CHAT_DEADLINE)
+            )
         # 応答テキストを取得 (response.text が存在しない場合のフォールバック)
         md_text = getattr(response, "text", str(response))
         
         # MarkdownをHTMLとプレーンテキストに変換
-        html_content = markdown_to_html(md_text)
-        plain_text = markdown_to_plaintext(md_text)
+        with span("markdown_render"):
+            html_content = markdown_to_html(md_text)
+            plain_text = markdown_to_plaintext(md_text)
         
-        print("✅ チャット応答生成完了。")
-        return jsonify({"html": html_content, "plain": plain_text})
+        chat_sessions.append(session_id, personality_name, prompt, md_text)
+        chat_response_cache.put(cache_key, md_text, html_content, plain_text)
+        logger.debug("✅ チャット応答生成完了。")
+        return jsonify({"html": html_content, "plain": plain_text, "session_id": session_id})
         
     except Exception as e:
-        print(f"❌ Gemini API エラー: {e}")
+        logger.error(f"❌ Gemini API エラー: {e}")
         return jsonify({"error": f"Gemini API エラー: {e}"}), 500
 
+@app.route("/api/chat/batch", methods=['POST'])
+def api_chat_batch():
+    """JSONL で受け取った複数のプロンプトを並列に実行し、完了した順に JSONL で返す
+
+    入力の各行: {"prompt": ..., "persona": ペルソナ名 (personality も可), "id": 任意の識別子}
+    出力の各行: {"index": 入力の行番号, "id", "personality", "status": "ok" | "error",
+                 "text", "html", "plain", "cached", "attempts", "latency_ms"} (エラー時は "error")
+    最後の行: {"summary": {件数, 所要時間, スループット, レイテンシの分布}}
+    クエリパラメータ concurrency (同時実行数) と max_retries (再試行回数) で動作を変えられる。
+    """
+    logger.debug("📦 /api/chat/batch がリクエストされました。")
+    if not get_genai_client():
+        return jsonify({"error": "Geminiクライアントが初期化されていません。APIキーを確認してください。"}), 500
+
+    items = parse_chat_batch(request.get_data(as_text=True).splitlines())
+    if not items:
+        return jsonify({"error": "プロンプトがありません。"}), 400
+    if len(items) > CHAT_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"1回に実行できるのは {CHAT_BATCH_MAX_ITEMS} 件までです。"}), 413
+
+    # 実行中にペルソナを読み込み直さないよう、先に読み込んでおく
+    persona_registry.get_all()
+    results = run_chat_batch(
+        items,
+        concurrency=request.args.get('concurrency', type=int),
+        max_retries=request.args.get('max_retries', type=int),
+    )
+
+    def generate():
+        try:
+            for result in results:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            results.close() # 切断された場合は未実行の項目を取り消す
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+@app.route("/api/chat/sessions/<session_id>", methods=['DELETE'])
+def delete_chat_session(session_id):
+    """会話セッションの履歴を削除する"""
+    chat_sessions.delete(chat_sessions.resolve_id(session_id))
+    return jsonify({"message": "セッションを削除しました。"})
+
+def sse_event(event, data):
+    """Server-Sent Events の1イベント分の文字列を作る"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def chat_stream_events(genai_client, personality_name, prompt, session_id, history):
+    """チャットの応答を (イベント名, データ) の組で順に返す (/api/chat/stream と音声入力で共通)
+
+    応答キャッシュにヒットした場合は delta を返さず、"cached": true を付けた done だけを返す。
+    """
+    cache_key = chat_response_cache_key(personality_name, prompt, history)
+    cached = chat_response_cache.get(cache_key)
+    if cached is not None:
+        chat_sessions.append(session_id, personality_name, prompt, cached["text"])
+        logger.debug("✅ 応答キャッシュを使用しました。")
+        yield "done", cached_chat_done(cached, session_id)
+        return
+
+    md_stream = MarkdownStream()
+    speech_normalizer = SpeechNormalizer()
+    first_token = True
+    try:
+        contents, config = build_chat_request(personality_name, prompt, history)
+        started = time.perf_counter()
+        # 途中まで送った応答は再試行できないため、ブレーカーと統計だけを適用する
+        with gemini_upstream.guard():
+            for chunk in genai_client.models.generate_content_stream(
+                model=GEMINI_MODEL,
+                contents=contents,
+                config=config
+            ):
+                text = getattr(chunk, "text", None)
+                if not text:
+                    continue
+                if first_token:
+                    record_span("llm_first_token", time.perf_counter() - started)
+                    first_token = False
+                fragment, pending = md_stream.feed(text)
+                # 確定した行は音声合成用の文として先に送り、生成中に読み上げを始められるようにする
+                speech = split_speech_sentences(speech_normalizer.feed(text))
+                yield "delta", {"text": text, "html": fragment, "pending": pending, "speech": speech}
+        record_span("llm", time.perf_counter() - started)
+
+        md_text = md_stream.text
+        chat_sessions.append(session_id, personality_name, prompt, md_text)
+        with span("markdown_render"):
+            html_content = md_stream.html()
+            plain_text = markdown_to_plaintext(md_text)
+        chat_response_cache.put(cache_key, md_text, html_content, plain_text)
+        yield "done", {
+            "html": html_content,
+            "plain": plain_text,
+            "speech": split_speech_sentences(speech_normalizer.finish()),
+            "session_id": session_id
+        }
+        logger.debug("✅ チャット応答のストリーミング完了。")
+    except Exception as e:
+        logger.error(f"❌ Gemini API エラー: {e}")
+        yield "error", {"error": f"Gemini API エラー: {e}"}
+
+def cached_chat_done(cached, session_id):
+    """応答キャッシュにヒットした場合の done イベントのデータ (読み上げ用の文もまとめて送る)"""
+    return {
+        "html": cached["html"],
+        "plain": cached["plain"],
+        "speech": split_speech_sentences(cached["plain"]),
+        "session_id": session_id,
+        "cached": True
+    }
+
+@app.route("/api/chat/stream", methods=['POST'])
+def api_chat_stream():
+    """Geminiの応答を生成しながら Server-Sent Events で逐次返す
+
+    イベント:
+      delta: {"text": 受信したチャンク, "html": 新たに確定したHTML断片, "pending": 未確定部分のHTML,
+              "speech": 新たに確定した読み上げ用の文のリスト}
+      done:  {"html": 応答全体のHTML, "plain": 音声合成用のプレーンテキスト, "speech": 残りの読み上げ用の文のリスト,
+              "session_id": 次のリクエストで送る会話セッションID}
+      error: {"error": エラーメッセージ}
+
+    応答キャッシュにヒットした場合は delta を送らず、"cached": true を付けた done だけを返す。
+    """
+    logger.debug("💬 /api/chat/stream がリクエストされました。")
+    genai_client = get_genai_client()
+    if not genai_client:
+        return jsonify({"error": "Geminiクライアントが初期化されていません。APIキーを確認してください。"}), 500
+
+    d = request.get_json(force=True, silent=True) or {}
+    prompt = d.get("prompt", "").strip()
+    personality_name = d.get("personality", "Default Assistant") # デフォルト値
+
+    if not prompt:
+        return jsonify({"error": "プロンプトが空です。"}), 400
+
+    logger.debug(f"🤖 ペルソナ '{personality_name}' でチャットをストリーミング生成中...")
+    session_id = chat_sessions.resolve_id(d.get("session_id"))
+    history = chat_sessions.get_history(session_id, personality_name)
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    def generate():
+        for event, data in chat_stream_events(genai_client, personality_name, prompt, session_id, history):
+            yield sse_event(event, data)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers=sse_headers
+    )
+
 @app.route("/api/tts", methods=['POST'])
 def api_tts():
     """テキストを音声に変換して返す"""
-    print("🔊 /api/tts がリクエストされました。")
+    logger.debug("🔊 /api/tts がリクエストされました。")
     d = request.get_json(force=True, silent=True) or {}
     text = d.get("text", "")
     
     if not text:
         return jsonify({"error": "テキストが空です。"}), 400
-        
-    audio_content = get_ada_voice(text)
+
+    # ペルソナのボイスで、ブラウザが再生できる形式 (opus を優先し、再生できなければ mp3) を選ぶ
+    voice = negotiate_tts_format(persona_voice(d.get("personality")), request.headers.get("Accept"))
+    # キーは内容から決まるため、ブラウザが同じETagを持っていれば合成せずに304を返す
+    cache_key = tts_cache_key(text, voice)
+    if cache_key in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{cache_key}"'})
+
+    audio_content = get_ada_voice(text, voice)
     
     if audio_content:
         # 音声データをストリームとして返す
-        return send_file(io.BytesIO(audio_content), mimetype="audio/mpeg")
+        return send_tts_audio(audio_content, cache_key)
     else:
         return jsonify({"error": "音声生成に失敗しました。"}), 500
 
+def send_tts_audio(audio_content, cache_key):
+    """ETag と Range に対応した形で音声データを返す"""
+    response = send_file(
+        io.BytesIO(audio_content),
+        mimetype=audio_mimetype(audio_content),
+        conditional=True,
+        etag=cache_key,
+        max_age=TTS_AUDIO_MAX_AGE
+    )
+    response.headers["X-TTS-Cache-Key"] = cache_key
+    response.headers["Cache-Control"] = f"public, max-age={TTS_AUDIO_MAX_AGE}, immutable"
+    return response
+
+@app.route("/api/tts/audio/<cache_key>", methods=['GET'])
+def api_tts_audio(cache_key):
+    """キャッシュ済みの音声をキーで返す (GETなのでブラウザのHTTPキャッシュやシークが効く)"""
+    if not re.fullmatch(r'[0-9a-f]{64}', cache_key):
+        return jsonify({"error": "不正なキーです。"}), 400
+    audio_content = tts_cache.get(cache_key)
+    if audio_content is None:
+        return jsonify({"error": "音声が見つかりません。"}), 404
+    return send_tts_audio(audio_content, cache_key)
+
+@app.route("/api/tts/cache/stats", methods=['GET'])
+def api_tts_cache_stats():
+    """音声キャッシュのヒット・ミス・削除件数を返す"""
+    return jsonify(tts_cache.snapshot())
+
+@app.route("/api/metrics", methods=['GET'])
+def api_metrics():
+    """リクエスト・処理段階ごとのレイテンシ、音声・応答・Markdown のキャッシュと single flight の統計を Prometheus のテキスト形式で返す"""
+    lines = metrics.render()
+    stats = tts_cache.snapshot()
+    lines.append("# TYPE ada_tts_cache_events_total counter")
+    for event in ("memory_hits", "disk_hits", "blob_hits", "misses", "stores", "memory_evictions", "disk_evictions"):
+        lines.append(f'ada_tts_cache_events_total{{event="{event}"}} {stats.get(event, 0)}')
+    lines.append("# TYPE ada_tts_cache_bytes gauge")
+    for tier in ("memory", "disk"):
+        lines.append(f'ada_tts_cache_bytes{{tier="{tier}"}} {stats.get(f"{tier}_bytes", 0)}')
+    response_stats = chat_response_cache.snapshot()
+    lines.append("# TYPE ada_chat_response_cache_events_total counter")
+    for event in ("hits", "misses", "stores", "evictions", "expirations", "invalidations"):
+        lines.append(f'ada_chat_response_cache_events_total{{event="{event}"}} {response_stats[event]}')
+    lines.append("# TYPE ada_chat_response_cache_entries gauge")
+    lines.append(f"ada_chat_response_cache_entries {response_stats['entries']}")
+    markdown_stats = markdown_renderer.snapshot()
+    lines.append("# TYPE ada_markdown_cache_events_total counter")
+    for event in ("hits", "misses", "evictions", "errors"):
+        lines.append(f'ada_markdown_cache_events_total{{event="{event}"}} {markdown_stats[event]}')
+    lines.append("# TYPE ada_markdown_cache_entries gauge")
+    lines.append(f"ada_markdown_cache_entries {markdown_stats['entries']}")
+    flight_stats = singleflight.stats()
+    lines.append("# TYPE ada_singleflight_events_total counter")
+    for name, stats in flight_stats.items():
+        for event in ("calls", "executions", "coalesced", "errors", "abandoned"):
+            lines.append(f'ada_singleflight_events_total{{group="{name}",event="{event}"}} {stats[event]}')
+    lines.append("# TYPE ada_singleflight_in_flight gauge")
+    for name, stats in flight_stats.items():
+        lines.append(f'ada_singleflight_in_flight{{group="{name}"}} {stats["in_flight"]}')
+    upstream_stats = upstream.health()
+    lines.append("# TYPE ada_upstream_events_total counter")
+    for name, stats in upstream_stats.items():
+        for event in ("calls", "successes", "failures", "retries", "short_circuits", "deadline_exceeded", "circuit_opened"):
+            lines.append(f'ada_upstream_events_total{{upstream="{name}",event="{event}"}} {stats[event]}')
+    lines.append("# TYPE ada_upstream_circuit_open gauge")
+    for name, stats in upstream_stats.items():
+        lines.append(f'ada_upstream_circuit_open{{upstream="{name}"}} {int(stats["state"] == "open")}')
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/singleflight/stats", methods=['GET'])
+def api_singleflight_stats():
+    """処理の種類 (tts / persona_load / persona_name) ごとの呼び出し回数と、同時実行をまとめた割合を返す"""
+    return jsonify(singleflight.stats())
+
+@app.route("/api/upstreams/health", methods=['GET'])
+def api_upstreams_health():
+    """外部API (Gemini / Fish Audio / Blob) ごとの呼び出し回数・失敗回数・レイテンシ・ブレーカーの状態を返す"""
+    return jsonify(upstream.health())
+
+@app.route("/api/tts/stream", methods=['POST'])
+def api_tts_stream():
+    """テキストを文単位に分割して並列に音声合成し、順番どおりのMP3をチャンク転送で返す"""
+    logger.debug("🔊 /api/tts/stream がリクエストされました。")
+    d = request.get_json(force=True, silent=True) or {}
+    sentences = split_speech_sentences(d.get("text", ""))
+
+    if not sentences:
+        return jsonify({"error": "テキストが空です。"}), 400
+
+    # 文ごとの音声をそのまま連結するため、形式はペルソナの設定にかかわらず mp3 にする
+    voice = persona_voice(d.get("personality")).with_format("mp3")
+    audio_chunks = synthesize_sentences(sentences, voice)
+    # 最初の文だけは先に合成し、全件失敗した場合はエラーを返せるようにする
+    first_chunk = next(audio_chunks, None)
+    if first_chunk is None:
+        return jsonify({"error": "音声生成に失敗しました。"}), 500
+
+    def generate():
+        yield first_chunk
+        yield from audio_chunks
+
+    # MP3はフレーム単位で連結できるため、文ごとの音声をそのまま続けて送る
+    return Response(stream_with_context(generate()), mimetype="audio/mpeg")
+
+def extract_uploaded_text(file):
+    """アップロードされたファイルを一時ファイルに保存してテキストを抽出する (不正なファイルは ValueError)"""
+    if file.filename == '':
+        raise ValueError("ファイルが選択されていません。")
+    filename, file_extension = os.path.splitext(file.filename)
+
+    # 同時にアップロードされても衝突しないよう、一意な一時ファイルにチャンク単位で保存する
+    temp_path = None
+    try:
+        temp_path = save_upload_to_temp(file, file_extension)
+        logger.debug(f"一時ファイル '{temp_path}' に保存しました。")
+        # ファイルからテキストを抽出
+        with span("file_extract"):
+            return extract_text_from_file(temp_path, file_extension)
+    finally:
+        # 一時ファイルを削除
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+            logger.debug(f"一時ファイル '{temp_path}' を削除しました。")
+
+@app.route("/api/personalities/import", methods=['POST'])
+def import_personalities():
+    """複数のファイルをまとめてペルソナとして追加する (名前はすべてバックグラウンドで生成する)
+
+    フォームの files に複数のファイルを指定する。ファイルごとの結果を imported / errors に返す。
+    """
+    logger.debug("📦 /api/personalities/import がリクエストされました。")
+    files = request.files.getlist('files')
+    if not files:
+        return jsonify({"error": "ファイルが選択されていません。"}), 400
+
+    imported, errors = [], []
+    for file in files:
+        try:
+            text_content = extract_uploaded_text(file)
+            if not text_content.strip():
+                raise ValueError("テキストが空です。")
+            if PERSONA_NAMING_ASYNC:
+                name, job = add_personality_with_provisional_name(text_content)
+            else:
+                name, job = save_personality(text_content), None
+            imported.append({"file": file.filename, "name": name, "naming_job": job})
+        except Exception as e:
+            logger.error(f"❌ ペルソナの取り込みに失敗しました ({file.filename}): {e}")
+            errors.append({"file": file.filename, "error": str(e)})
+    status = 202 if imported and PERSONA_NAMING_ASYNC else (200 if imported else 400)
+    return jsonify({"imported": imported, "errors": errors}), status
+
+@app.route("/api/personalities/naming", methods=['GET'])
+def personality_naming_status():
+    """名前の生成ジョブの件数と、完了していないジョブの一覧を返す"""
+    return jsonify(persona_naming.snapshot())
+
+@app.route("/api/personalities/naming/<job_id>", methods=['GET'])
+def personality_naming_job(job_id):
+    """名前の生成ジョブの状態を返す (UIは status が done / failed になるまでポーリングする)"""
+    job = persona_naming.status(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません。"}), 404
+    return jsonify(job)
+
+@app.route("/api/stt/stream", methods=['POST'])
+def api_stt_stream():
+    """チャンク転送で送られる音声から発話の終わりを検出し、文字起こしと応答を Server-Sent Events で返す
+
+    本文: 16bit リニアPCM・モノラル・リトルエンディアン (録音しながら送る)
+    クエリ: sample_rate (既定: STT_SAMPLE_RATE), personality, session_id, chat (0 で文字起こしのみ)
+
+    イベント:
+      vad:        {"state": "speech_start" / "speech_end", "at": 音声の先頭からの秒数}
+      transcript: {"text": 文字起こし, "duration": 発話の秒数, "latency_ms": 発話の終わりから文字起こしまで}
+      以降は /api/chat/stream と同じ delta / done / error
+
+    発話の終わりを検出した時点で残りの音声は読まずに文字起こしを始める。
+    音声が途中で終わった場合は、そこまでを1つの発話として扱う。
+    """
+    logger.debug("🎙️ /api/stt/stream がリクエストされました。")
+    sample_rate = request.args.get('sample_rate', STT_SAMPLE_RATE, type=int)
+    if not 8000 <= sample_rate <= 48000:
+        return jsonify({"error": "sample_rate は 8000 から 48000 の間で指定してください。"}), 400
+    personality_name = request.args.get('personality', 'Default Assistant')
+    session_id = chat_sessions.resolve_id(request.args.get('session_id'))
+    chat = request.args.get('chat', '1') not in ('0', 'false')
+    stream = request.stream
+
+    def generate():
+        vad = create_vad(sample_rate)
+        # 1フレームずつ読み、受信しながら発話区間を検出する
+        while not vad.done:
+            chunk = stream.read(vad.frame_bytes)
+            if not chunk:
+                break
+            for event in vad.feed(chunk):
+                yield sse_event("vad", event)
+        end_event = vad.flush()
+        if end_event:
+            yield sse_event("vad", end_event)
+        if vad.utterance is None:
+            yield sse_event("error", {"error": "発話が検出されませんでした。"})
+            return
+        for event, data in utterance_events(vad.utterance, sample_rate, personality_name, session_id, chat):
+            yield sse_event(event, data)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    """MAX_CONTENT_LENGTH を超えたリクエスト"""
+    return jsonify({"error": f"ファイルサイズが上限 ({INGEST_MAX_BYTES // (1024 * 1024)}MB) を超えています。"}), 413
+
 @app.route("/api/personalities/add", methods=['POST'])
 def add_personality():
     """新しいペルソナを追加する"""
-    print("➕ /api/personalities/add がリクエストされました。")
+    logger.debug("➕ /api/personalities/add がリクエストされました。")
     
     text_content = request.form.get('text_content', '')
     user_defined_name = request.form.get('name', None)
 
     # ファイルがアップロードされた場合
     if 'file' in request.files:
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"error": "ファイルが選択されていません。"}), 400
-            
-        filename, file_extension = os.path.splitext(file.filename)
-        
-        # ファイルを一時的に保存
-        # ファイル名に安全でない文字が含まれる可能性があるので、一時ファイル名にはUUIDなどを利用する方がより安全ですが、ここでは簡略化します。
-        temp_file_base = "temp_upload_file"
-        temp_path = os.path.join(app.root_path, temp_file_base + file_extension)
-        
         try:
-            file.save(temp_path)
-            print(f"一時ファイル '{temp_path}' に保存しました。")
-            # ファイルからテキストを抽出
-            text_content = extract_text_from_file(temp_path, file_extension)
-        except ValueError as e: # extract_text_from_file で発生したエラー
+            text_content = extract_uploaded_text(request.files['file'])
+        except ValueError as e: # ファイル未選択・サイズ超過や extract_text_from_file で発生したエラー
             return jsonify({"error": str(e)}), 400
         except Exception as e:
             return jsonify({"error": f"ファイルの処理中にエラーが発生しました: {e}"}), 500
-        finally:
-            # 一時ファイルを削除
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                print(f"一時ファイル '{temp_path}' を削除しました。")
 
     # テキストコンテンツが空の場合
     if not text_content:
         return jsonify({"error": "ペルソナ設定テキストが提供されていません。"}), 400
 
-    # ペルソナを保存
+    # ペルソナを保存 (名前の指定がなければ仮の名前で保存し、名前はバックグラウンドで生成する)
     try:
-        new_name = save_personality(text_content, user_defined_name)
-        print("✅ ペルソナ追加処理完了。")
-        return jsonify({"message": f"新しいペルソナ '{new_name}' を追加しました。"})
+        if user_defined_name or not PERSONA_NAMING_ASYNC:
+            new_name = save_personality(text_content, user_defined_name)
+            logger.debug("✅ ペルソナ追加処理完了。")
+            return jsonify({"message": f"新しいペルソナ '{new_name}' を追加しました。", "name": new_name})
+        new_name, job = add_personality_with_provisional_name(text_content)
+        logger.debug("✅ ペルソナ追加処理完了 (名前は生成中)。")
+        return jsonify({
+            "message": f"新しいペルソナ '{new_name}' を追加しました。名前を生成しています。",
+            "name": new_name,
+            "naming_job": job,
+        }), 202
     except Exception as e:
-        print(f"❌ ペルソナ追加処理中にエラーが発生しました: {e}")
+        logger.error(f"❌ ペルソナ追加処理中にエラーが発生しました: {e}")
         return jsonify({"error": f"ペルソナの保存中にエラーが発生しました: {e}"}), 500
 
 # --------------------------
 # アプリケーションの実行
 # --------------------------
 if __name__ == '__main__':
+    import sys
+    if '--build-persona-indexes' in sys.argv:
+        # デプロイ前に personalities ディレクトリの索引をまとめて作成する (読み取り専用の環境向け)
+        for persona_name, instruction in load_personalities().items():
+            built = save_persona_index(persona_name, instruction)
+            print(f"{persona_name}: {len(built.passages) if built else 0} passages")
+        sys.exit(0)
+    if '--compact-blob-personas' in sys.argv:
+        # マニフェストから参照されていないペルソナのBlobを削除する (--dry-run で件数の確認のみ)
+        if not blob_personas_enabled():
+            print("BLOB_READ_WRITE_TOKEN・VERCEL_PROJECT_ID と vercel_blob が必要です。")
+            sys.exit(1)
+        grace = float(sys.argv[sys.argv.index('--grace') + 1]) if '--grace' in sys.argv else 3600.0
+        result = compact_blob_personas(grace_seconds=grace, dry_run='--dry-run' in sys.argv)
+        print(json.dumps(result, ensure_ascii=False))
+        sys.exit(0)
+    if '--import-personas' in sys.argv:
+        # personalities ディレクトリの JSON と Blob のペルソナを PERSONA_STORE_PATH のストアに取り込む
+        try:
+            import persona_store
+        except ModuleNotFoundError:
+            from api import persona_store
+        store = persona_store.PersonaStore(PERSONA_STORE_PATH)
+        overwrite = '--overwrite' in sys.argv
+        if os.path.isdir('personalities'):
+            print(f"JSON: {persona_store.import_json_dir(store, 'personalities', overwrite=overwrite)} 件")
+        if BLOB_READ_WRITE_TOKEN and get_vercel_blob():
+            blob_voices = {}
+            blob_personas = load_personalities_from_blob(voices=blob_voices)
+            print(f"Blob: {store.import_items(blob_personas.items(), overwrite=overwrite, voices=blob_voices)} 件")
+        print(f"{PERSONA_STORE_PATH}: 合計 {len(store)} 件")
+        sys.exit(0)
+
     # デバッグモードで実行する場合
     # app.run(debug=True, host='0.0.0.0', port=5000)
     
     # 本番環境など、デバッグなしで実行する場合
     # VercelではunicornなどのWSGIサーバーが使われることが多いです。
     # ローカル実行の場合は以下でも可
+    get_genai_client() # 常駐する場合は最初のチャットを待たせないよう起動時に作成しておく
+    # 最初の音声合成で接続を待たないよう、Fish Audio への接続もバックグラウンドで開いておく
+    threading.Thread(target=warm_tts_connections, daemon=True).start()
     app.run(host='0.0.0.0', port=5000)
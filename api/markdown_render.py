@@ -0,0 +1,178 @@
+"""応答の Markdown を HTML に変換するレンダラー
+
+- markdown.Markdown のインスタンスはスレッドごとに1つ作って使い回す (変換のたびに reset() する)。
+  markdown.markdown() は呼ぶたびにインスタンスを作り、拡張機能を読み込み直すため遅い。
+- 変換した HTML は許可したタグ・属性だけを残す (LLM の応答に含まれる生の HTML をそのまま返さない)。
+  python-markdown が出力する形のタグだけであれば正規表現の確認だけで済ませ、
+  それ以外のタグや属性がある場合のみ HTMLParser で組み立て直す。
+- 変換結果は本文のハッシュをキーにして LRU でキャッシュする。
+"""
+import hashlib
+import html
+import re
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+
+# 残すタグと、タグごとに残す属性
+ALLOWED_TAGS = frozenset({
+    "p", "br", "hr", "strong", "em", "b", "i", "del", "sup", "sub", "code", "pre", "blockquote",
+    "ul", "ol", "li", "h1", "h2", "h3", "h4", "h5", "h6", "a",
+    "table", "thead", "tbody", "tr", "th", "td",
+})
+ALLOWED_ATTRIBUTES = {"a": frozenset({"href", "title"}), "ol": frozenset({"start"})}
+# リンク先として許可するスキーム (スキームのない相対URL・#アンカーも許可する)
+ALLOWED_URL_SCHEMES = frozenset({"http", "https", "mailto"})
+# 中身ごと削除するタグ
+DROP_CONTENT_TAGS = frozenset({"script", "style", "iframe", "object", "embed", "template", "noscript", "textarea", "title"})
+VOID_TAGS = frozenset({"br", "hr"})
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>|<[!?]")
+# python-markdown が出力する形の属性の並び (例: ' href="..." title="..."'、末尾の ' /')
+_ATTRIBUTES_RE = re.compile(r'(?:\s+[a-z]+="[^"<>]*")*\s*/?')
+_ATTRIBUTE_RE = re.compile(r'([a-z]+)="([^"]*)"')
+_URL_SCHEME_RE = re.compile(r"^([a-zA-Z][a-zA-Z0-9+.-]*):")
+# ブラウザがURLの解釈で無視する制御文字・空白
+_URL_IGNORED_RE = re.compile(r"[\x00-\x20\x7f]+")
+
+
+def is_safe_url(url):
+    url = _URL_IGNORED_RE.sub("", html.unescape(url))
+    match = _URL_SCHEME_RE.match(url)
+    return match is None or match.group(1).lower() in ALLOWED_URL_SCHEMES
+
+
+def _allowed_attributes(tag, attrs):
+    """許可する属性だけを (名前, 値) のリストで返す"""
+    allowed = ALLOWED_ATTRIBUTES.get(tag, ())
+    return [
+        (name, value) for name, value in attrs
+        if name in allowed and value is not None and (name != "href" or is_safe_url(value))
+    ]
+
+
+def _is_clean(fragment):
+    """許可したタグ・属性だけで、python-markdown が出力する形になっているかどうか (sanitize の高速判定)"""
+    for match in _TAG_RE.finditer(fragment):
+        tag = match.group(2)
+        if tag is None or tag.lower() != tag or tag not in ALLOWED_TAGS:
+            return False
+        attributes = match.group(3)
+        if not attributes or attributes == " /":
+            continue
+        if match.group(1) or not _ATTRIBUTES_RE.fullmatch(attributes):
+            return False
+        attrs = _ATTRIBUTE_RE.findall(attributes)
+        if len(_allowed_attributes(tag, attrs)) != len(attrs):
+            return False
+    return True
+
+
+class _Sanitizer(HTMLParser):
+    """許可したタグ・属性だけを残して HTML を組み立て直す"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self._dropping = 0 # 中身ごと削除しているタグの深さ
+
+    def _start(self, tag, attrs):
+        parts = [tag] + [f'{name}="{html.escape(value)}"' for name, value in _allowed_attributes(tag, attrs)]
+        return "<" + " ".join(parts) + (" />" if tag in VOID_TAGS else "") + ">"
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self._dropping += 1
+        elif not self._dropping and tag in ALLOWED_TAGS:
+            self.out.append(self._start(tag, attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        if not self._dropping and tag in ALLOWED_TAGS:
+            self.out.append(self._start(tag, attrs))
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            self._dropping = max(0, self._dropping - 1)
+        elif not self._dropping and tag in ALLOWED_TAGS and tag not in VOID_TAGS:
+            self.out.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        if not self._dropping:
+            self.out.append(html.escape(data, quote=False))
+
+
+def sanitize_html(fragment):
+    """許可したタグ・属性 (ALLOWED_TAGS / ALLOWED_ATTRIBUTES) 以外を取り除いた HTML を返す"""
+    if _is_clean(fragment):
+        return fragment
+    sanitizer = _Sanitizer()
+    sanitizer.feed(fragment)
+    sanitizer.close()
+    return "".join(sanitizer.out)
+
+
+class MarkdownRenderer:
+    """Markdown を安全な HTML に変換する (スレッドごとのインスタンス・サニタイズ・変換結果のキャッシュ)"""
+
+    def __init__(self, extensions=("nl2br",), cache_max_entries=512, cache_max_chars=4 * 1024 * 1024):
+        self.extensions = list(extensions)
+        self.cache_max_entries = cache_max_entries
+        self.cache_max_chars = cache_max_chars
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict() # { 本文のハッシュ: HTML }
+        self._cache_chars = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "instances": 0, "errors": 0}
+
+    def _markdown(self):
+        """このスレッドの markdown.Markdown (初回だけ作成する)"""
+        md = getattr(self._local, "md", None)
+        if md is None:
+            import markdown
+            md = self._local.md = markdown.Markdown(extensions=self.extensions)
+            self._count("instances")
+        return md
+
+    def render(self, md_text):
+        if not md_text:
+            return ""
+        key = hashlib.sha256(md_text.encode("utf-8")).digest()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return cached
+            self.stats["misses"] += 1
+
+        try:
+            # 前の文書の参照リンクなどが残らないよう、使うたびに reset() する
+            rendered = sanitize_html(self._markdown().reset().convert(md_text))
+        except Exception:
+            # エラー時はプレーンテキストとして表示する (インスタンスは作り直す)
+            self._local.md = None
+            self._count("errors")
+            return f"<pre>{html.escape(md_text)}</pre>"
+        self._remember(key, rendered)
+        return rendered
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._cache), chars=self._cache_chars)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _remember(self, key, rendered):
+        if len(rendered) > self.cache_max_chars:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = rendered
+            self._cache_chars += len(rendered)
+            while len(self._cache) > self.cache_max_entries or self._cache_chars > self.cache_max_chars:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_chars -= len(evicted)
+                self.stats["evictions"] += 1
@@ -0,0 +1,286 @@
+"""ペルソナを1つの SQLite ファイルに保存するストア
+
+personalities/ に1ペルソナ1ファイルの JSON を置く代わりに、以下を1行ずつ保持する。
+
+- name (主キー)・本文のハッシュ・本文の文字数・作成/更新時刻 (一覧はこれらのメタデータだけを読む)
+- zlib で圧縮した本文 (名前を指定した取得のときだけ展開する)
+- 音声の設定 (JSON の "voice" と同じ内容を JSON 文字列で保持する。未設定なら NULL)
+
+WAL モードで開き、書き込みは BEGIN IMMEDIATE のトランザクションで行うため、
+複数のスレッド・プロセスから同時に更新しても壊れない。書き込みのたびに revision が増えるので、
+メモリ上のキャッシュは revision() を比べるだけで変更を検知できる。
+
+使い方:
+    python api/persona_store.py import-json personalities --db personalities/personas.db
+    python api/persona_store.py list --db personalities/personas.db
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+logger = logging.getLogger("ada.persona_store")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS personas (
+    name         TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    size         INTEGER NOT NULL,
+    created_at   REAL NOT NULL,
+    updated_at   REAL NOT NULL,
+    instruction  BLOB NOT NULL,
+    voice        TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+"""
+
+
+class PersonaStore:
+    """ペルソナの SQLite ストア (スレッドごとに接続を持つ)"""
+
+    def __init__(self, path, busy_timeout=10.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # 各文は冪等なため、同時に初期化されても問題ない
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        # voice 列がない古いファイルには列を追加する
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(personas)")}
+        if "voice" not in columns:
+            try:
+                conn.execute("ALTER TABLE personas ADD COLUMN voice TEXT")
+            except sqlite3.OperationalError:
+                pass # 他のプロセスが先に追加した
+
+    # ---- 接続 ----
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # トランザクションは _transaction() で明示的に開始する
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        # 書き込みロックを先に取り、読み込んでから書き込むまでの間に他の書き込みが入らないようにする
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        """このスレッドの接続を閉じる"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _bump_revision(conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+
+    # ---- 読み込み ----
+
+    def revision(self):
+        """書き込みのたびに増える番号 (変更の検知に使う)"""
+        return self._connect().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def names(self):
+        return [row[0] for row in self._connect().execute("SELECT name FROM personas ORDER BY name")]
+
+    def list_meta(self):
+        """本文を除いたメタデータの一覧を返す"""
+        rows = self._connect().execute(
+            "SELECT name, content_hash, size, created_at, updated_at FROM personas ORDER BY name"
+        )
+        return [
+            {"name": name, "content_hash": digest, "size": size, "created_at": created_at, "updated_at": updated_at}
+            for name, digest, size, created_at, updated_at in rows
+        ]
+
+    def get(self, name, default=None):
+        row = self._connect().execute("SELECT instruction FROM personas WHERE name = ?", (name,)).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8") if row else default
+
+    def get_all(self):
+        """{ name: system_instruction } 形式の辞書を返す (すべての本文を展開する)"""
+        rows = self._connect().execute("SELECT name, instruction FROM personas")
+        return {name: zlib.decompress(blob).decode("utf-8") for name, blob in rows}
+
+    def get_voice(self, name):
+        """音声の設定の辞書を返す (未設定またはペルソナがない場合は None)"""
+        row = self._connect().execute("SELECT voice FROM personas WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def voices(self):
+        """{ name: 音声の設定 } 形式の辞書を返す (設定のあるペルソナのみ)"""
+        rows = self._connect().execute("SELECT name, voice FROM personas WHERE voice IS NOT NULL")
+        return {name: json.loads(voice) for name, voice in rows}
+
+    def __contains__(self, name):
+        return self._connect().execute("SELECT 1 FROM personas WHERE name = ?", (name,)).fetchone() is not None
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM personas").fetchone()[0]
+
+    # ---- 書き込み ----
+
+    def put(self, name, text, overwrite=True, voice=None):
+        """ペルソナを保存する (overwrite=False で同名がある場合は FileExistsError)
+
+        voice を渡さずに上書きした場合は、update() と同じく既存の音声の設定を残す (削除は set_voice(name, None))。
+        """
+        now = time.time()
+        encoded = text.encode("utf-8")
+        with self._transaction() as conn:
+            if not overwrite and conn.execute("SELECT 1 FROM personas WHERE name = ?", (name,)).fetchone():
+                raise FileExistsError(f"ペルソナ '{name}' は既に存在します。")
+            conn.execute(
+                """INSERT INTO personas (name, content_hash, size, created_at, updated_at, instruction, voice)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(name) DO UPDATE SET
+                       content_hash = excluded.content_hash, size = excluded.size,
+                       updated_at = excluded.updated_at, instruction = excluded.instruction,
+                       voice = COALESCE(excluded.voice, personas.voice)""",
+                (name, hashlib.sha256(encoded).hexdigest(), len(text), now, now, zlib.compress(encoded), _dump_voice(voice)),
+            )
+            self._bump_revision(conn)
+
+    def update(self, name, text):
+        """既存のペルソナを更新する (存在しない場合は FileNotFoundError)"""
+        encoded = text.encode("utf-8")
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE personas SET content_hash = ?, size = ?, updated_at = ?, instruction = ? WHERE name = ?",
+                (hashlib.sha256(encoded).hexdigest(), len(text), time.time(), zlib.compress(encoded), name),
+            )
+            if cursor.rowcount == 0:
+                raise FileNotFoundError(f"ペルソナ '{name}' が見つかりません。")
+            self._bump_revision(conn)
+
+    def set_voice(self, name, voice):
+        """音声の設定を変更する (None で削除、ペルソナが存在しない場合は FileNotFoundError)"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE personas SET voice = ?, updated_at = ? WHERE name = ?", (_dump_voice(voice), time.time(), name)
+            )
+            if cursor.rowcount == 0:
+                raise FileNotFoundError(f"ペルソナ '{name}' が見つかりません。")
+            self._bump_revision(conn)
+
+    def rename(self, old_name, new_name):
+        """名前を変更する (新しい名前が既にある場合は FileExistsError)"""
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM personas WHERE name = ?", (new_name,)).fetchone():
+                raise FileExistsError(f"ペルソナ '{new_name}' は既に存在します。")
+            cursor = conn.execute("UPDATE personas SET name = ? WHERE name = ?", (new_name, old_name))
+            if cursor.rowcount == 0:
+                raise FileNotFoundError(f"ペルソナ '{old_name}' が見つかりません。")
+            self._bump_revision(conn)
+
+    def delete(self, name):
+        with self._transaction() as conn:
+            if conn.execute("DELETE FROM personas WHERE name = ?", (name,)).rowcount:
+                self._bump_revision(conn)
+
+    def import_items(self, items, overwrite=False, voices=None):
+        """(name, text) の組をまとめて保存し、保存した件数を返す (1つのトランザクションで行う)
+
+        voices ({ name: 音声の設定 }) を渡した場合は、音声の設定も保存する。
+        """
+        voices = voices or {}
+        now = time.time()
+        count = 0
+        with self._transaction() as conn:
+            for name, text in items:
+                encoded = text.encode("utf-8")
+                row = (
+                    name, hashlib.sha256(encoded).hexdigest(), len(text), now, now, zlib.compress(encoded),
+                    _dump_voice(voices.get(name)),
+                )
+                verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+                count += conn.execute(
+                    f"{verb} INTO personas (name, content_hash, size, created_at, updated_at, instruction, voice) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    row,
+                ).rowcount
+            self._bump_revision(conn)
+        return count
+
+
+def _dump_voice(voice):
+    return json.dumps(voice, ensure_ascii=False, sort_keys=True) if voice else None
+
+
+def iter_json_dir(personalities_dir, voices=None):
+    """personalities ディレクトリの JSON ファイルを (name, system_instruction) の組で返す
+
+    voices に辞書を渡すと、"voice" のあるペルソナの音声の設定をそこに入れる。
+    読み込めないファイル (壊れた JSON など) はログに残して飛ばす。
+    """
+    for filename in sorted(os.listdir(personalities_dir)):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(personalities_dir, filename), encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("JSON の最上位がオブジェクトではありません")
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ 人格ファイル '{filename}' を取り込めませんでした: {e}")
+            continue
+        name = os.path.splitext(filename)[0]
+        if voices is not None and data.get("voice"):
+            voices[name] = data["voice"]
+        yield name, data.get("system_instruction", "")
+
+
+def import_json_dir(store, personalities_dir, overwrite=False):
+    """JSON ファイルのペルソナをストアに取り込み、取り込んだ件数を返す"""
+    # iter_json_dir() は各行を返す前に voices を埋めるため、import_items() の中で参照できる
+    voices = {}
+    return store.import_items(iter_json_dir(personalities_dir, voices), overwrite=overwrite, voices=voices)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["import-json", "list"])
+    parser.add_argument("directory", nargs="?", default="personalities", help="取り込む JSON のディレクトリ")
+    parser.add_argument("--db", default=os.path.join("personalities", "personas.db"), help="ストアのファイル")
+    parser.add_argument("--overwrite", action="store_true", help="同名のペルソナがある場合は上書きする")
+    args = parser.parse_args()
+
+    store = PersonaStore(args.db)
+    if args.command == "import-json":
+        count = import_json_dir(store, args.directory, overwrite=args.overwrite)
+        print(f"{count} 件のペルソナを {args.db} に取り込みました (合計 {len(store)} 件)")
+    else:
+        for meta in store.list_meta():
+            updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(meta["updated_at"]))
+            print(f"{meta['name']}\t{meta['size']}文字\t{updated}\t{meta['content_hash'][:12]}")
+
+
+if __name__ == "__main__":
+    main()
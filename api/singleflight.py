@@ -0,0 +1,183 @@
+"""同じ処理の同時実行をまとめる (single flight)
+
+同じキーの処理が実行中に呼ばれた場合は、新たに実行せずに実行中の処理の結果を待って受け取る。
+- 結果だけでなく例外も、待っていたすべての呼び出し元に返す
+  (同じ例外オブジェクトを複数のスレッドで投げるとトレースバックが混ざるため、待っていた側には複製を投げる)
+- 実行した呼び出し元が処理を中断した場合 (Exception 以外の BaseException) は結果を共有せず、
+  待っていた呼び出し元のうち1つが改めて実行する
+- 非同期版 (ado) は処理を別のタスクで実行し、待っている呼び出し元がすべてキャンセルした場合だけ処理をキャンセルする
+- 処理が終わった時点でキーを削除する (結果を保持するキャッシュではない)
+
+グループ (処理の種類) ごとに、呼び出し回数・実行回数・まとめた回数などを数える (stats())。
+"""
+import asyncio
+import copy
+import threading
+
+# Exception 以外の BaseException (処理の中断) で終わったことを表す
+_ABANDONED = object()
+
+
+class SharedCallError(Exception):
+    """実行した呼び出し元の例外を複製できなかった場合に、待っていた呼び出し元に投げる例外 (__cause__ が元の例外)"""
+
+
+def _waiter_error(error):
+    """待っていた呼び出し元ごとに投げる例外 (元の例外と同じ型・args・属性の複製)
+
+    __init__ の引数が args と異なり copy できない例外は、__init__ を呼ばずに作って属性を写す。
+    """
+    try:
+        return copy.copy(error)
+    except Exception:
+        pass
+    try:
+        clone = type(error).__new__(type(error), *error.args)
+        clone.args = error.args
+        clone.__dict__.update(error.__dict__)
+        return clone
+    except Exception:
+        return SharedCallError(f"{type(error).__name__}: {error}")
+
+
+class _Call:
+    """実行中の処理1件 (同期版)"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """キーごとに同時に1つだけ処理を実行し、結果を同時に呼んだ全員で共有する"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {} # { キー: _Call }
+        self._tasks = {} # { キー: (イベントループ, asyncio.Task, [待っている数]) }
+        self._stats = {"calls": 0, "executions": 0, "coalesced": 0, "errors": 0, "abandoned": 0}
+
+    def do(self, key, func, *args, **kwargs):
+        """キーの処理が実行中ならその結果を待ち、なければ func(*args, **kwargs) を実行して結果を返す"""
+        self._count("calls")
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    self._stats["executions"] += 1
+            if leader:
+                return self._run(key, call, func, args, kwargs)
+            call.done.wait()
+            if call.error is _ABANDONED:
+                continue # 実行した呼び出し元が中断したため、改めて実行する
+            self._count("coalesced")
+            if call.error is not None:
+                raise _waiter_error(call.error) from call.error
+            return call.result
+
+    def _run(self, key, call, func, args, kwargs):
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            self._count("errors")
+            raise
+        except BaseException:
+            call.error = _ABANDONED
+            self._count("abandoned")
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    async def ado(self, key, func, *args, **kwargs):
+        """do() の非同期版 (func(*args, **kwargs) はコルーチンを返す)
+
+        同じイベントループの呼び出しだけをまとめる。
+        """
+        self._count("calls")
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._tasks.get(key)
+            leader = entry is None or entry[0] is not loop
+            if leader:
+                task = loop.create_task(self._arun(key, func, args, kwargs))
+                entry = self._tasks[key] = (loop, task, [0])
+                self._stats["executions"] += 1
+            else:
+                self._stats["coalesced"] += 1
+        _, task, waiters = entry
+        waiters[0] += 1
+        try:
+            # 呼び出し元がキャンセルされても、他に待っている呼び出し元がいれば処理は続ける
+            return await asyncio.shield(task)
+        except Exception as e:
+            if leader:
+                raise
+            raise _waiter_error(e) from e
+        except asyncio.CancelledError:
+            if task.done() or waiters[0] > 1:
+                raise
+            # 最後の呼び出し元がキャンセルされた: 処理もキャンセルし、以降の呼び出しは新たに実行させる
+            with self._lock:
+                if self._tasks.get(key, (None, None))[1] is task:
+                    del self._tasks[key]
+            task.cancel()
+            raise
+        finally:
+            waiters[0] -= 1
+
+    async def _arun(self, key, func, args, kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            self._count("errors")
+            raise
+        except BaseException:
+            self._count("abandoned")
+            raise
+        finally:
+            with self._lock:
+                entry = self._tasks.get(key)
+                if entry is not None and entry[1] is asyncio.current_task():
+                    del self._tasks[key]
+
+    def snapshot(self):
+        """統計 (coalescing_rate は呼び出しのうち、実行せずに他の結果を受け取った割合)"""
+        with self._lock:
+            stats = dict(self._stats, name=self.name, in_flight=len(self._calls) + len(self._tasks))
+        stats["coalescing_rate"] = round(stats["coalesced"] / stats["calls"], 4) if stats["calls"] else 0.0
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+# 処理の種類ごとのインスタンス { name: SingleFlight }
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def get_group(name):
+    """名前ごとに1つの SingleFlight を返す"""
+    with _groups_lock:
+        group = _groups.get(name)
+        if group is None:
+            group = _groups[name] = SingleFlight(name)
+        return group
+
+
+def stats():
+    """すべてのグループの統計を返す"""
+    with _groups_lock:
+        groups = list(_groups.values())
+    return {group.name: group.snapshot() for group in groups}
@@ -0,0 +1,187 @@
+"""音声入力: エネルギーによる発話区間検出 (VAD) と文字起こしのバックエンド
+
+マイクの音声 (16bit リニアPCM・モノラル・リトルエンディアン) を少しずつ EnergyVAD.feed() に渡すと、
+発話の始まりと終わりを検出する。発話が終わったら utterance の音声を文字起こしのバックエンドに渡す。
+
+文字起こしのバックエンドは名前で選ぶ (STT_BACKEND)。
+- stub : 音声の内容にかかわらず決まった文字列を返す (テスト・ベンチマーク用)
+- gemini: index.py で登録する (Gemini に音声を渡して文字起こしする)
+- "パッケージ.モジュール:クラス名" の形式で、任意のクラスを指定することもできる
+  (transcribe(pcm, sample_rate) -> str を持つこと)
+"""
+import importlib
+import io
+import math
+import os
+import sys
+import threading
+import wave
+from array import array
+
+SAMPLE_WIDTH = 2 # 16bit
+
+
+def frame_rms(frame):
+    """16bit PCM のフレームの RMS"""
+    samples = array("h", frame)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    if not samples:
+        return 0.0
+    return math.sqrt(sum(x * x for x in samples) / len(samples))
+
+
+def pcm_to_wav(pcm, sample_rate):
+    """PCM を WAV のバイト列にする"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(SAMPLE_WIDTH)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm)
+    return buffer.getvalue()
+
+
+class EnergyVAD:
+    """フレームごとのエネルギー (RMS) で発話の始まりと終わりを検出する
+
+    - 背景雑音のレベルを発話していないフレームの指数移動平均で追い、その speech_ratio 倍
+      (かつ min_rms 以上) のフレームを音声とみなす
+    - 音声のフレームが start_ms 続いたら発話の開始、その後 end_silence_ms 無音が続いたら発話の終わり
+    - 語頭が切れないよう、発話の開始より pre_roll_ms 前からの音声を utterance に含める
+    - 発話が max_utterance_s を超えた場合は、その時点で発話の終わりとする
+    """
+
+    def __init__(self, sample_rate=16000, frame_ms=20, min_rms=300.0, speech_ratio=3.0,
+                 start_ms=60, end_silence_ms=600, pre_roll_ms=200, max_utterance_s=30.0):
+        self.sample_rate = sample_rate
+        self.frame_bytes = sample_rate * frame_ms // 1000 * SAMPLE_WIDTH
+        self.frame_s = frame_ms / 1000
+        self.min_rms = min_rms
+        self.speech_ratio = speech_ratio
+        self.start_frames = max(1, start_ms // frame_ms)
+        self.end_frames = max(1, end_silence_ms // frame_ms)
+        self.pre_roll_frames = pre_roll_ms // frame_ms
+        self.max_frames = int(max_utterance_s / self.frame_s)
+        self.noise_rms = None
+        self.utterance = None # 発話が終わったら PCM が入る
+        self._pending = b""
+        self._frames = [] # 発話中 (または開始前の pre-roll) のフレーム
+        self._frame_count = 0
+        self._speaking = False
+        self._voiced_run = 0
+        self._silent_run = 0
+
+    @property
+    def done(self):
+        return self.utterance is not None
+
+    def _position(self):
+        return round(self._frame_count * self.frame_s, 3)
+
+    def feed(self, pcm):
+        """PCM を追加し、検出したイベント ({"state": "speech_start" / "speech_end", "at": 秒}) のリストを返す"""
+        if self.done:
+            return []
+        events = []
+        data = self._pending + pcm
+        end = len(data) - len(data) % self.frame_bytes
+        self._pending = data[end:]
+        for offset in range(0, end, self.frame_bytes):
+            event = self._feed_frame(data[offset:offset + self.frame_bytes])
+            if event:
+                events.append(event)
+                if self.done:
+                    break
+        return events
+
+    def flush(self):
+        """入力が終わった時点で発話中なら、そこまでを utterance にして speech_end のイベントを返す (それ以外は None)"""
+        if not self.done and self._speaking:
+            return self._finish()
+        return None
+
+    def _feed_frame(self, frame):
+        self._frame_count += 1
+        rms = frame_rms(frame)
+        threshold = max(self.min_rms, (self.noise_rms or 0.0) * self.speech_ratio)
+        voiced = rms >= threshold
+        self._frames.append(frame)
+
+        if not self._speaking:
+            if voiced:
+                self._voiced_run += 1
+            else:
+                self._voiced_run = 0
+                # 発話していない間だけ背景雑音のレベルを更新する
+                self.noise_rms = rms if self.noise_rms is None else self.noise_rms * 0.95 + rms * 0.05
+            if self._voiced_run >= self.start_frames:
+                self._speaking = True
+                self._silent_run = 0
+                # pre-roll と開始判定に使ったフレームだけを残す
+                self._frames = self._frames[-(self.pre_roll_frames + self._voiced_run):]
+                return {"state": "speech_start", "at": self._position()}
+            del self._frames[:-(self.pre_roll_frames + self.start_frames)]
+            return None
+
+        self._silent_run = 0 if voiced else self._silent_run + 1
+        if self._silent_run >= self.end_frames or len(self._frames) >= self.max_frames:
+            return self._finish()
+        return None
+
+    def _finish(self):
+        # 末尾の無音は文字起こしに不要なため、少しだけ残して削る
+        trailing = max(0, self._silent_run - self.pre_roll_frames)
+        frames = self._frames[:len(self._frames) - trailing] if trailing else self._frames
+        self.utterance = b"".join(frames)
+        self._frames = []
+        self._speaking = False
+        return {
+            "state": "speech_end",
+            "at": self._position(),
+            "duration": round(len(self.utterance) / SAMPLE_WIDTH / self.sample_rate, 3),
+        }
+
+
+# --------------------------
+# 文字起こしのバックエンド
+# --------------------------
+
+class StubTranscriber:
+    """テスト用: 音声の内容にかかわらず STT_STUB_TEXT (未設定なら音声の長さ) を返す"""
+
+    def __init__(self, text=None):
+        self.text = text if text is not None else os.environ.get("STT_STUB_TEXT")
+
+    def transcribe(self, pcm, sample_rate):
+        if self.text is not None:
+            return self.text
+        return f"{len(pcm) / SAMPLE_WIDTH / sample_rate:.1f}秒の音声です"
+
+
+# { 名前: インスタンスを作る関数 }
+_transcriber_factories = {"stub": StubTranscriber}
+_transcribers = {}
+_transcribers_lock = threading.Lock()
+
+
+def register_transcriber(name, factory):
+    """文字起こしのバックエンドを登録する (factory は引数なしでインスタンスを返す)"""
+    with _transcribers_lock:
+        _transcriber_factories[name] = factory
+        _transcribers.pop(name, None)
+
+
+def get_transcriber(name):
+    """名前 (または "モジュール:クラス名") に対応するバックエンドを返す (インスタンスは使い回す)"""
+    with _transcribers_lock:
+        transcriber = _transcribers.get(name)
+        if transcriber is None:
+            factory = _transcriber_factories.get(name)
+            if factory is None:
+                if ":" not in name:
+                    raise ValueError(f"文字起こしのバックエンド '{name}' は登録されていません。")
+                module_name, attr = name.split(":", 1)
+                factory = getattr(importlib.import_module(module_name), attr)
+            transcriber = _transcribers[name] = factory()
+        return transcriber
@@ -5,6 +5,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatBox = document.getElementById('chat-box');
     const userInput = document.getElementById('user-input');
     const sendBtn = document.getElementById('send-btn');
+    const micBtn = document.getElementById('mic-btn');
     const personaSelect = document.getElementById('persona-select');
     const voiceSelect = document.getElementById('voice-select');
     const ttsToggle = document.getElementById('tts-toggle');
@@ -16,6 +17,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatView = document.getElementById('chat-view');
     const editorViewContent = document.getElementById('editor-view-content');
     let currentAudio = null;
+    let speechQueue = []; // 再生待ちの音声 (Blob URL を返す Promise) のキュー
+    let speechPlaying = false;
+    let speechGeneration = 0; // stopSpeech() で古い再生ループを止めるための世代番号
+    let chatSessionId = null; // 会話セッションID (ペルソナを切り替えたらリセットする)
 
     // テーマ切り替え処理
     const applyTheme = (isDark) => {
@@ -112,6 +117,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!prompt) return;
 
         const selectedPersonality = personaSelect.value;
+        stopSpeech(); // 前の応答の読み上げを止める
         addMessage('user', prompt); // ユーザーメッセージを追加
         userInput.value = ''; // 入力フィールドをクリア
         toggleSendButton(false); // 送信ボタンを無効化
@@ -120,26 +126,28 @@ document.addEventListener('DOMContentLoaded', () => {
         const loadingBubble = addMessage('bot', null, true);
 
         try {
-            const response = await fetch('/api/chat', {
+            const response = await fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ prompt, personality: selectedPersonality })
+                body: JSON.stringify({ prompt, personality: selectedPersonality, session_id: chatSessionId })
             });
 
             if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
-            const data = await response.json();
 
-            // ローディング表示を応答に置き換え
-            if (loadingBubble) {
-                loadingBubble.innerHTML = data.html;
-            } else {
-                addMessage('bot', data.html); // メッセージを追加
-            }
+            // 受信した断片を順次描画し、完了イベントで全体を置き換える
+            let committedHtml = '';
+            const data = await readChatStream(response, (delta) => {
+                committedHtml += delta.html;
+                loadingBubble.innerHTML = committedHtml + delta.pending;
+                chatBox.scrollTop = chatBox.scrollHeight;
+                // TTSが有効なら確定した文から順に読み上げを始める
+                if (ttsToggle.checked) enqueueSpeech(delta.speech);
+            });
+            loadingBubble.innerHTML = data.html;
+            chatSessionId = data.session_id; // 次の発言で会話の続きとして扱う
 
-            // TTSが有効なら音声再生
-            if (ttsToggle.checked && data.plain) {
-                await playAudio(data.plain);
-            }
+            // 残りの文を読み上げる
+            if (ttsToggle.checked) enqueueSpeech(data.speech);
         } catch (error) {
             console.error('Error:', error);
             const errorText = `<p class="text-red-400">申し訳ありません、エラーが発生しました。</p>`;
@@ -154,6 +162,168 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // /api/chat/stream の Server-Sent Events を読み取る
+    // delta イベントごとに onDelta を、それ以外のイベント (音声入力の vad / transcript) では onEvent を呼び、
+    // done イベントのデータを返す
+    async function readChatStream(response, onDelta, onEvent = null) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let separatorIndex;
+            while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, separatorIndex);
+                buffer = buffer.slice(separatorIndex + 2);
+                let eventName = 'message';
+                let dataText = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) dataText += line.slice(5).trim();
+                });
+                if (!dataText) continue;
+                const payload = JSON.parse(dataText);
+                if (eventName === 'delta') {
+                    onDelta(payload);
+                } else if (eventName === 'done') {
+                    return payload;
+                } else if (eventName === 'error') {
+                    throw new Error(payload.error);
+                } else if (onEvent) {
+                    onEvent(eventName, payload);
+                }
+            }
+        }
+        throw new Error('Stream ended before completion');
+    }
+
+    // --- 音声入力 ---
+    // マイクの音声を 16kHz・16bit のPCMにして /api/stt/stream に送る。
+    // WebSocket が使える場合 (非同期モード) は録音しながら送り、サーバーが発話の終わりを検出したら録音を止める。
+    // 使えない場合は、もう一度マイクボタンを押して録音を止めたときにまとめて送る。
+    const STT_SAMPLE_RATE = 16000;
+    let recorder = null;
+
+    function sttQuery() {
+        const params = new URLSearchParams({ sample_rate: STT_SAMPLE_RATE, personality: personaSelect.value });
+        if (chatSessionId) params.set('session_id', chatSessionId);
+        return params.toString();
+    }
+
+    // 音声入力のイベントを処理する (WebSocket とチャンク転送で共通)
+    function createVoiceEventHandler() {
+        let bubble = null;
+        let committedHtml = '';
+        return (eventName, payload) => {
+            if (eventName === 'vad' && payload.state === 'speech_end') {
+                stopVoiceInput(false); // 発話が終わったので録音を止める (応答は引き続き受け取る)
+            } else if (eventName === 'transcript' && payload.text) {
+                addMessage('user', payload.text);
+                bubble = addMessage('bot', null, true);
+            } else if (eventName === 'delta' && bubble) {
+                committedHtml += payload.html;
+                bubble.innerHTML = committedHtml + payload.pending;
+                chatBox.scrollTop = chatBox.scrollHeight;
+                if (ttsToggle.checked) enqueueSpeech(payload.speech);
+            } else if (eventName === 'done' && bubble) {
+                bubble.innerHTML = payload.html;
+                chatSessionId = payload.session_id;
+                if (ttsToggle.checked) enqueueSpeech(payload.speech);
+            } else if (eventName === 'error') {
+                console.error('Voice input error:', payload.error);
+                const errorText = `<p class="text-red-400">申し訳ありません、音声を認識できませんでした。</p>`;
+                if (bubble) bubble.innerHTML = errorText;
+                else addMessage('bot', errorText);
+            }
+        };
+    }
+
+    function openSttSocket(onEvent) {
+        return new Promise((resolve, reject) => {
+            const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+            const socket = new WebSocket(`${protocol}//${location.host}/api/stt/stream?${sttQuery()}`);
+            socket.binaryType = 'arraybuffer';
+            socket.onopen = () => resolve(socket);
+            socket.onerror = () => reject(new Error('WebSocket is not available'));
+            socket.onmessage = (message) => {
+                const { event, data } = JSON.parse(message.data);
+                onEvent(event, data);
+            };
+        });
+    }
+
+    async function startVoiceInput() {
+        stopSpeech();
+        const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
+        const context = new AudioContext({ sampleRate: STT_SAMPLE_RATE });
+        const source = context.createMediaStreamSource(stream);
+        const processor = context.createScriptProcessor(2048, 1, 1);
+        const onEvent = createVoiceEventHandler();
+        const socket = await openSttSocket(onEvent).catch(() => null);
+        const chunks = [];
+        processor.onaudioprocess = (e) => {
+            const input = e.inputBuffer.getChannelData(0);
+            const pcm = new Int16Array(input.length);
+            for (let i = 0; i < input.length; i++) {
+                pcm[i] = Math.max(-1, Math.min(1, input[i])) * 0x7fff;
+            }
+            if (socket) {
+                if (socket.readyState === WebSocket.OPEN) socket.send(pcm.buffer);
+            } else {
+                chunks.push(pcm);
+            }
+        };
+        source.connect(processor);
+        processor.connect(context.destination);
+        recorder = { stream, context, processor, socket, chunks, onEvent };
+        micBtn.classList.add('recording');
+    }
+
+    async function stopVoiceInput(upload = true) {
+        if (!recorder) return;
+        const { stream, context, processor, socket, chunks, onEvent } = recorder;
+        recorder = null;
+        micBtn.classList.remove('recording');
+        processor.disconnect();
+        stream.getTracks().forEach(track => track.stop());
+        context.close();
+
+        if (socket) {
+            // 入力の終わりを知らせる (発話の途中で止めた場合は、そこまでを1つの発話として扱う)
+            if (socket.readyState === WebSocket.OPEN) socket.send('end');
+            return;
+        }
+        if (!upload || chunks.length === 0) return;
+        toggleSendButton(false);
+        try {
+            const response = await fetch(`/api/stt/stream?${sttQuery()}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: new Blob(chunks)
+            });
+            if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
+            onEvent('done', await readChatStream(response, (delta) => onEvent('delta', delta), onEvent));
+        } catch (error) {
+            onEvent('error', { error: error.message });
+        } finally {
+            toggleSendButton(true);
+            chatBox.scrollTop = chatBox.scrollHeight;
+        }
+    }
+
+    function toggleVoiceInput() {
+        if (recorder) {
+            stopVoiceInput();
+        } else {
+            startVoiceInput().catch((error) => {
+                console.error('Error starting voice input:', error);
+                alert('マイクを使用できませんでした。');
+            });
+        }
+    }
+
     // メッセージをチャットボックスに追加する関数
     function addMessage(sender, content, isLoading = false) {
         const messageContainer = document.createElement('div');
@@ -192,27 +362,66 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // 音声再生処理
-    async function playAudio(text) {
-        if (currentAudio) {
-            currentAudio.pause(); // 再生中の音声を停止
-        }
+    // opus を再生できるブラウザには opus (mp3 より小さい) を、それ以外には mp3 を返してもらう
+    const SPEECH_ACCEPT = new Audio().canPlayType('audio/ogg; codecs=opus')
+        ? 'audio/ogg; codecs=opus, audio/mpeg;q=0.9'
+        : 'audio/mpeg';
+
+    // 文ごとに /api/tts を呼び、受け取った順ではなく文の順番どおりに再生する
+    // (ボイスは選択中のペルソナの設定で決まる)
+    function fetchSpeechAudio(text) {
         const selectedVoiceId = voiceSelect.value;
-        try {
-            const audioResponse = await fetch('/api/tts', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ text, voice_id: selectedVoiceId })
-            });
-            if (audioResponse.ok) {
-                const audioBlob = await audioResponse.blob();
-                const audioUrl = URL.createObjectURL(audioBlob);
-                currentAudio = new Audio(audioUrl);
-                currentAudio.play();
-            } else {
+        return fetch('/api/tts', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'Accept': SPEECH_ACCEPT },
+            body: JSON.stringify({ text, voice_id: selectedVoiceId, personality: personaSelect.value })
+        }).then(async (audioResponse) => {
+            if (!audioResponse.ok) {
                 console.error('Error generating audio:', await audioResponse.text());
+                return null;
             }
-        } catch (error) {
+            return URL.createObjectURL(await audioResponse.blob());
+        }).catch((error) => {
             console.error('Error playing audio:', error);
+            return null;
+        });
+    }
+
+    // 文のリストを再生キューに追加する (合成リクエストはすぐに開始する)
+    function enqueueSpeech(sentences) {
+        if (!sentences || sentences.length === 0) return;
+        sentences.forEach(sentence => speechQueue.push(fetchSpeechAudio(sentence)));
+        if (!speechPlaying) playSpeechQueue(speechGeneration);
+    }
+
+    async function playSpeechQueue(generation) {
+        speechPlaying = true;
+        while (speechQueue.length > 0 && generation === speechGeneration) {
+            const audioUrl = await speechQueue.shift();
+            if (!audioUrl) continue;
+            if (generation !== speechGeneration) {
+                URL.revokeObjectURL(audioUrl);
+                break;
+            }
+            await new Promise((resolve) => {
+                currentAudio = new Audio(audioUrl);
+                currentAudio.addEventListener('ended', resolve);
+                currentAudio.addEventListener('pause', resolve);
+                currentAudio.addEventListener('error', resolve);
+                currentAudio.play().catch(resolve);
+            });
+            URL.revokeObjectURL(audioUrl);
+        }
+        if (generation === speechGeneration) speechPlaying = false;
+    }
+
+    // 再生中の音声と再生待ちのキューを破棄する
+    function stopSpeech() {
+        speechGeneration++;
+        speechQueue = [];
+        speechPlaying = false;
+        if (currentAudio) {
+            currentAudio.pause(); // 再生中の音声を停止
         }
     }
 
@@ -231,15 +440,41 @@ document.addEventListener('DOMContentLoaded', () => {
                 addPersonaModal.classList.add('hidden'); // モーダルを閉じる
                 addPersonaForm.reset(); // フォームをリセット
                 await loadPersonalities(); // ペルソナリストを再読み込み
+                // 名前を生成中の場合は、完了後にもう一度リストを読み込む
+                if (data.naming_job) waitForPersonaName(data.naming_job.job_id);
             }
         } catch (error) {
             alert('ペルソナの追加中にエラーが発生しました。');
         }
     }
 
+    // バックグラウンドでのペルソナ名の生成が終わるまでポーリングし、終わったらリストを更新する
+    async function waitForPersonaName(jobId, interval = 1000, maxAttempts = 120) {
+        for (let attempt = 0; attempt < maxAttempts; attempt++) {
+            await new Promise((resolve) => setTimeout(resolve, interval));
+            try {
+                const response = await fetch(`/api/personalities/naming/${jobId}`);
+                if (!response.ok) return;
+                const job = await response.json();
+                if (job.status === 'done' || job.status === 'failed') {
+                    const selected = personaSelect.value;
+                    await loadPersonalities();
+                    // 仮の名前を選択していた場合は、確定した名前を選択し直す
+                    if (selected === job.provisional_name) personaSelect.value = job.name;
+                    else if ([...personaSelect.options].some(o => o.value === selected)) personaSelect.value = selected;
+                    return;
+                }
+            } catch (error) {
+                console.error('Error polling persona naming:', error);
+                return;
+            }
+        }
+    }
+
     // --- イベントリスナーの設定 ---
     themeToggleBtn.addEventListener('click', toggleTheme); // テーマ切り替えボタン
     sendBtn.addEventListener('click', sendMessage); // 送信ボタン
+    if (micBtn) micBtn.addEventListener('click', toggleVoiceInput); // 音声入力ボタン
     userInput.addEventListener('keypress', (e) => { // Enterキーで送信
         if (e.key === 'Enter' && !sendBtn.disabled) {
             sendMessage();
@@ -292,6 +527,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // ペルソナ選択の変更イベントハンドラ (修正)
     personaSelect.addEventListener('change', async (e) => {
         const selectedValue = e.target.value;
+        chatSessionId = null; // ペルソナが変わったら新しい会話として始める
         if (selectedValue === 'add_new_persona') {
             // "+ New Persona" が選択されたら、エディタビューを新規作成モードで開く
             await showEditPersonaView('add_new_persona');
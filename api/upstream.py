@@ -0,0 +1,315 @@
+"""外部API (Gemini / Fish Audio / Vercel Blob) の呼び出しを共通化するモジュール
+
+- 接続を使い回す requests.Session (キープアライブ・接続プール)
+- リクエスト全体の期限 (Deadline): 再試行を含めて期限を超えないよう、各試行のタイムアウトを短くする
+- 冪等な呼び出しのみ、ジッター付きの指数バックオフで再試行する
+- サーキットブレーカー: 連続して失敗した外部APIはしばらく呼ばずにすぐ失敗させる
+- 外部APIごとの呼び出し回数・失敗回数・レイテンシなどの統計 (health())
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# 再試行・ブレーカーの対象にするHTTPステータス
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class UpstreamError(Exception):
+    """外部APIの呼び出しに失敗した"""
+
+
+class CircuitOpenError(UpstreamError):
+    """サーキットブレーカーが開いているため呼び出さなかった"""
+
+
+class DeadlineExceeded(UpstreamError):
+    """リクエストの期限までに外部APIの呼び出しが終わらなかった"""
+
+
+class Deadline:
+    """リクエスト全体の期限 (monotonic 時刻で保持する)"""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def timeout(self, cap):
+        """次の試行に使うタイムアウト (cap と残り時間の短い方)。期限切れなら DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("リクエストの期限を超えました")
+        return min(cap, remaining)
+
+
+class CircuitBreaker:
+    """連続 failure_threshold 回失敗したら reset_timeout 秒間呼び出しを止める
+
+    期間が過ぎたら1件だけ試し (half-open)、成功すれば再開、失敗すればまた止める。
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        """呼び出してよいかどうか (half-open の間は1件だけ許可する)"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        """失敗を記録し、ブレーカーが開いた場合は True を返す"""
+        with self._lock:
+            self._failures += 1
+            was_open = self._opened_at is not None
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._probing = False
+                return not was_open
+            return False
+
+    def release(self):
+        """ブレーカーに関係しない結果 (4xx など) で half-open の試行を終える"""
+        with self._lock:
+            self._probing = False
+
+
+def default_is_retryable(error):
+    """通信エラー・タイムアウトと RETRYABLE_STATUS_CODES のHTTPエラーを再試行の対象にする"""
+    import requests
+
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    try:
+        import httpx
+        if isinstance(error, httpx.TransportError):
+            return True
+    except ImportError:
+        pass
+    response = getattr(error, "response", None)
+    code = getattr(error, "code", None) or getattr(response, "status_code", None)
+    return code in RETRYABLE_STATUS_CODES
+
+
+def is_rate_limited(error):
+    response = getattr(error, "response", None)
+    return (getattr(error, "code", None) or getattr(response, "status_code", None)) == 429
+
+
+class Upstream:
+    """1つの外部APIへの呼び出しを管理する (接続プール・期限・再試行・サーキットブレーカー・統計)"""
+
+    def __init__(self, name, timeout=30.0, connect_timeout=5.0, max_retries=2, backoff_base=0.25, backoff_max=5.0,
+                 failure_threshold=5, reset_timeout=30.0, pool_maxsize=10, is_retryable=default_is_retryable):
+        self.name = name
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_maxsize = pool_maxsize
+        self.is_retryable = is_retryable
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._session = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0, "successes": 0, "failures": 0, "retries": 0,
+            "short_circuits": 0, "deadline_exceeded": 0, "circuit_opened": 0,
+        }
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+        self._last_error = None
+        self._last_failure_at = None
+
+    @property
+    def session(self):
+        """接続を使い回す requests.Session (初回に作成する)"""
+        with self._lock:
+            if self._session is None:
+                import requests
+                import requests.adapters
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    # ---- 呼び出し ----
+
+    @contextmanager
+    def guard(self):
+        """1回の呼び出しをブレーカーと統計で囲む (ストリーミングや非同期の呼び出し用、再試行はしない)"""
+        if not self.breaker.allow():
+            self._count("short_circuits")
+            raise CircuitOpenError(f"{self.name} は一時的に利用できません (サーキットブレーカーが開いています)")
+        self._count("calls")
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self._record_failure(e, time.perf_counter() - start)
+            raise
+        except BaseException:
+            # クライアントの切断などで中断された場合は成功とも失敗とも数えない
+            self.breaker.release()
+            raise
+        self._record_success(time.perf_counter() - start)
+
+    def call(self, func, deadline=None, idempotent=True, max_retries=None):
+        """func(timeout) を呼ぶ。冪等な呼び出しは再試行できるエラーの場合に期限内で再試行する
+
+        func には今回の試行に使うタイムアウト (秒) が渡される。
+        """
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout(deadline)
+            try:
+                with self.guard():
+                    return func(timeout)
+            except Exception as e:
+                attempt += 1
+                delay = self._retry_delay(e, attempt, deadline, idempotent, max_retries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def acall(self, func, deadline=None, idempotent=True, max_retries=None):
+        """call() の非同期版 (func(timeout) はコルーチンを返す)"""
+        import asyncio
+
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout(deadline)
+            try:
+                with self.guard():
+                    return await func(timeout)
+            except Exception as e:
+                attempt += 1
+                delay = self._retry_delay(e, attempt, deadline, idempotent, max_retries)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    def _attempt_timeout(self, deadline):
+        try:
+            return deadline.timeout(self.timeout) if deadline else self.timeout
+        except DeadlineExceeded:
+            self._count("deadline_exceeded")
+            raise
+
+    def _retry_delay(self, error, attempt, deadline, idempotent, max_retries):
+        """再試行する場合は待ち時間 (秒) を、しない場合は None を返す"""
+        max_retries = self.max_retries if max_retries is None else max_retries
+        if isinstance(error, CircuitOpenError) or not (idempotent and attempt <= max_retries and self.is_retryable(error)):
+            return None
+        # フルジッター: 0〜(base * 2^n) 秒のランダムな待ち時間 (期限を超える場合は再試行しない)
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if deadline and deadline.remaining() <= delay:
+            return None
+        self._count("retries")
+        return delay
+
+    def request(self, method, url, deadline=None, idempotent=None, raise_for_status=True, **kwargs):
+        """共有セッションでHTTPリクエストを送る (GET/HEAD は冪等として再試行する)"""
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD", "OPTIONS")
+
+        def send(timeout):
+            # 接続できない場合は読み込みのタイムアウトまで待たずに失敗させる
+            response = self.session.request(method, url, timeout=(min(self.connect_timeout, timeout), timeout), **kwargs)
+            if raise_for_status:
+                response.raise_for_status()
+            return response
+
+        return self.call(send, deadline=deadline, idempotent=idempotent)
+
+    # ---- 統計 ----
+
+    def health(self):
+        with self._lock:
+            completed = self._stats["successes"] + self._stats["failures"]
+            return dict(
+                self._stats,
+                name=self.name,
+                state=self.breaker.state,
+                latency_avg_ms=round(self._latency_sum / completed * 1000, 1) if completed else None,
+                latency_max_ms=round(self._latency_max * 1000, 1),
+                last_error=self._last_error,
+                last_failure_age_s=round(time.monotonic() - self._last_failure_at, 1) if self._last_failure_at else None,
+            )
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _observe(self, elapsed):
+        self._latency_sum += elapsed
+        self._latency_max = max(self._latency_max, elapsed)
+
+    def _record_success(self, elapsed):
+        self.breaker.record_success()
+        with self._lock:
+            self._stats["successes"] += 1
+            self._observe(elapsed)
+
+    def _record_failure(self, error, elapsed):
+        # レート制限やリクエスト自体の誤り (4xx) では外部APIが落ちているとはみなさない
+        if self.is_retryable(error) and not is_rate_limited(error):
+            opened = self.breaker.record_failure()
+        else:
+            opened = False
+            self.breaker.release()
+        with self._lock:
+            self._stats["failures"] += 1
+            self._stats["circuit_opened"] += opened
+            self._observe(elapsed)
+            self._last_error = f"{type(error).__name__}: {error}"[:300]
+            self._last_failure_at = time.monotonic()
+
+
+# 外部APIごとのインスタンス { name: Upstream }
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(name, **options):
+    """名前ごとに1つの Upstream を返す (初回のみ options で作成する)"""
+    with _upstreams_lock:
+        upstream = _upstreams.get(name)
+        if upstream is None:
+            upstream = _upstreams[name] = Upstream(name, **options)
+        return upstream
+
+
+def health():
+    """すべての外部APIの統計を返す"""
+    with _upstreams_lock:
+        upstreams = list(_upstreams.values())
+    return {upstream.name: upstream.health() for upstream in upstreams}
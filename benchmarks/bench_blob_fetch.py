@@ -0,0 +1,117 @@
+"""Blobからのペルソナ読み込みのベンチマーク
+
+ローカルに立てたHTTPサーバーをVercel Blobの代わりに使い、
+ペルソナ数ごとに以下の3通りの所要時間を比較する。
+
+- serial : 以前の実装と同じく requests.get を1件ずつ呼ぶ
+- pooled : load_personalities_from_blob() (共有セッション + 並列取得) の初回
+- cached : 同じ一覧で2回目を呼んだ場合 (URL/uploadedAt が同じBlobは再取得しない)
+
+使い方:
+    python benchmarks/bench_blob_fetch.py --counts 10 50 100 --latency 0.02
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# index.py の Blob 経路を有効にするためのダミー値 (実際のBlobには接続しない)
+os.environ.setdefault("BLOB_READ_WRITE_TOKEN", "bench-dummy-token")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import index  # noqa: E402
+
+
+class BlobStandInHandler(BaseHTTPRequestHandler):
+    """Blobの代わりにペルソナJSONを返すハンドラ (応答前に latency 秒待つ)"""
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.02
+    body = b""
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(latency, instruction_size):
+    BlobStandInHandler.latency = latency
+    BlobStandInHandler.body = json.dumps(
+        {"system_instruction": "あ" * instruction_size}, ensure_ascii=False
+    ).encode("utf-8")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BlobStandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_files(base_url, count):
+    return [
+        {
+            "pathname": f"persona{i}_{i:08x}.json",
+            "url": f"{base_url}/persona{i}_{i:08x}.json",
+            "uploadedAt": "2024-01-01T00:00:00.000Z",
+        }
+        for i in range(count)
+    ]
+
+
+def load_serial(files):
+    """以前の実装と同じ逐次ダウンロード"""
+    personalities = {}
+    for file in files:
+        r = requests.get(file["url"], timeout=10)
+        r.raise_for_status()
+        personalities[file["pathname"]] = r.json().get("system_instruction", "")
+    return personalities
+
+
+def timed(func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+    return elapsed, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 10, 25, 50, 100])
+    parser.add_argument("--latency", type=float, default=0.02, help="1リクエストあたりの擬似遅延 (秒)")
+    parser.add_argument("--size", type=int, default=2000, help="system_instruction の文字数")
+    args = parser.parse_args()
+
+    server = start_server(args.latency, args.size)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"latency={args.latency}s size={args.size} concurrency={index.BLOB_FETCH_CONCURRENCY}")
+    print(f"{'count':>6} {'serial[s]':>10} {'pooled[s]':>10} {'cached[s]':>10} {'speedup':>8}")
+    try:
+        for count in args.counts:
+            # 件数ごとに別URLにして、前の件数のキャッシュを使わないようにする
+            files = make_files(f"{base_url}/{count}", count)
+            serial, _ = timed(load_serial, files)
+            pooled, loaded = timed(index.load_personalities_from_blob, files)
+            cached, _ = timed(index.load_personalities_from_blob, files)
+            assert len(loaded) == count, f"{len(loaded)} != {count}"
+            print(f"{count:>6} {serial:>10.3f} {pooled:>10.3f} {cached:>10.4f} {serial / pooled:>7.1f}x")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Blob上のペルソナの配置 (以前の形式とマニフェスト) のベンチマーク
+
+ローカルのHTTPサーバーと、それを使う vercel_blob の代わり (list / put / delete) を立て、
+ペルソナ数 × 保存回数 (履歴) のBlobがある状態で、以下の所要時間とリクエスト数を比較する。
+
+- legacy : 以前の形式 (<名前>_<サフィックス>.json) のまま読み込む (全Blobの一覧 + 全Blobの取得)
+- migrate: マニフェストへの移行 (最新の本文だけを content-hash のBlobに保存する)
+- cold   : マニフェストから読み込む (キャッシュなし)
+- warm   : 変更がない状態で再読み込みする (一覧1回)
+- update : 1件更新した後に再読み込みする (一覧1回 + マニフェスト + 変更した本文)
+- compact: 参照されていないBlobの削除と、その後の読み込み
+
+使い方:
+    python benchmarks/bench_blob_manifest.py --personas 50 --history 20 --latency 0.01
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+# index.py の Blob 経路を有効にするためのダミー値 (実際のBlobには接続しない)
+os.environ.setdefault("BLOB_READ_WRITE_TOKEN", "bench-dummy-token")
+os.environ.setdefault("VERCEL_PROJECT_ID", "bench-dummy-project")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import index  # noqa: E402
+
+
+class BlobStandIn:
+    """vercel_blob の list / put / delete の代わり (内容はメモリに持ち、GET はローカルのHTTPサーバーで返す)"""
+
+    page_size = 1000
+
+    def __init__(self, base_url, latency):
+        self.base_url = base_url
+        self.latency = latency
+        self.blobs = {}  # { pathname: (data, uploadedAt, url) }
+        self.lock = threading.Lock()
+        self.counts = {"list": 0, "put": 0, "delete": 0, "get": 0}
+        self._clock = 0
+
+    def _uploaded_at(self):
+        # 呼び出し順に単調増加する時刻 (十分に古い時刻から始め、compaction の猶予の対象にしない)
+        self._clock += 1
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(1_600_000_000 + self._clock)) + ".000Z"
+
+    def list(self, options=None):
+        options = options or {}
+        time.sleep(self.latency)
+        with self.lock:
+            self.counts["list"] += 1
+            prefix = options.get("prefix", "")
+            names = sorted(name for name in self.blobs if name.startswith(prefix))
+            start = int(options.get("cursor") or 0)
+            limit = int(options.get("limit") or self.page_size)
+            page = names[start:start + limit]
+            blobs = [
+                {"pathname": name, "url": self.blobs[name][2], "uploadedAt": self.blobs[name][1], "size": len(self.blobs[name][0])}
+                for name in page
+            ]
+        has_more = start + limit < len(names)
+        return {"blobs": blobs, "hasMore": has_more, "cursor": str(start + limit) if has_more else None}
+
+    def put(self, pathname, data, options=None):
+        options = options or {}
+        time.sleep(self.latency)
+        if options.get("addRandomSuffix") == "true":
+            stem, ext = os.path.splitext(pathname)
+            pathname = f"{stem}_{uuid.uuid4().hex[:8]}{ext}"
+        with self.lock:
+            self.counts["put"] += 1
+            url = f"{self.base_url}/{pathname}"
+            self.blobs[pathname] = (data, self._uploaded_at(), url)
+        return {"url": url, "pathname": pathname}
+
+    def delete(self, urls):
+        time.sleep(self.latency)
+        urls = {urls} if isinstance(urls, str) else set(urls)
+        with self.lock:
+            self.counts["delete"] += 1
+            for name in [name for name, blob in self.blobs.items() if blob[2] in urls]:
+                del self.blobs[name]
+
+    def read(self, path):
+        with self.lock:
+            self.counts["get"] += 1
+            blob = self.blobs.get(unquote(path.split("?", 1)[0].lstrip("/")))
+        return blob[0] if blob else None
+
+
+def start_server(latency):
+    store = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = store["blob"].read(self.path)
+            self.send_response(200 if body is not None else 404)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body or b"")))
+            self.end_headers()
+            self.wfile.write(body or b"")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    store["blob"] = BlobStandIn(f"http://127.0.0.1:{server.server_address[1]}", latency)
+    return server, store["blob"]
+
+
+def measure(blob, func, *args):
+    """func の所要時間と、その間の list / GET の回数を返す"""
+    before = dict(blob.counts)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+    requests_made = {k: blob.counts[k] - before[k] for k in ("list", "get", "put", "delete")}
+    return elapsed, requests_made, result
+
+
+def reset_caches():
+    index._blob_content_cache.clear()
+    index._persona_manifest_cache = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--personas", type=int, default=50, help="ペルソナ数")
+    parser.add_argument("--history", type=int, default=20, help="ペルソナごとの保存回数")
+    parser.add_argument("--latency", type=float, default=0.01, help="1リクエストあたりの擬似遅延 (秒)")
+    args = parser.parse_args()
+
+    server, blob = start_server(args.latency)
+    index._vercel_blob = blob
+    names = [f"persona{i}" for i in range(args.personas)]
+
+    # 以前の形式: 保存のたびにランダムなサフィックス付きのBlobが増える
+    for version in range(args.history):
+        for name in names:
+            data = json.dumps({"system_instruction": f"{name} v{version}"}, ensure_ascii=False).encode("utf-8")
+            blob.put(f"{name}.json", data, {"addRandomSuffix": "true"})
+    expected = {name: f"{name} v{args.history - 1}" for name in names}
+    print(f"personas={args.personas} history={args.history} blobs={len(blob.blobs)} latency={args.latency}s")
+
+    def load():
+        return index.load_personalities_from_blob(index.list_personality_blobs())
+
+    rows = []
+    elapsed, counts, loaded = measure(blob, load)
+    assert loaded == expected, "以前の形式: 最新の本文が読み込まれていません"
+    rows.append(("legacy", elapsed, counts))
+
+    elapsed, counts, _ = measure(blob, index.update_persona_manifest, lambda personas: None)
+    rows.append(("migrate", elapsed, counts))
+
+    reset_caches()
+    elapsed, counts, loaded = measure(blob, load)
+    assert loaded == expected
+    rows.append(("cold", elapsed, counts))
+
+    elapsed, counts, loaded = measure(blob, load)
+    assert loaded == expected
+    rows.append(("warm", elapsed, counts))
+
+    index.update_personality_blob(names[0], "更新後")
+    elapsed, counts, loaded = measure(blob, load)
+    assert loaded[names[0]] == "更新後"
+    rows.append(("update", elapsed, counts))
+
+    before = len(blob.blobs)
+    elapsed, counts, result = measure(blob, index.compact_blob_personas, 0.0)
+    rows.append(("compact", elapsed, counts))
+    reset_caches()
+    elapsed, counts, loaded = measure(blob, load)
+    assert loaded == dict(expected, **{names[0]: "更新後"})
+    rows.append(("cold (compacted)", elapsed, counts))
+
+    print(f"  {'':<18} {'time[s]':>8} {'list':>5} {'get':>5} {'put':>5} {'delete':>6}")
+    for label, elapsed, counts in rows:
+        print(f"  {label:<18} {elapsed:>8.3f} {counts['list']:>5} {counts['get']:>5} {counts['put']:>5} {counts['delete']:>6}")
+    print(f"  compaction: {before} -> {len(blob.blobs)} blobs ({json.dumps(result)})")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""サーバーレス関数のコールドスタート (import + 最初のリクエスト) のベンチマーク
+
+ルートごとに新しい Python プロセスを起動し、以下を計測する。
+
+- import : api/index.py の import にかかった時間
+- first  : Flask のテストクライアントで最初のリクエストを処理するまでの時間
+- process: プロセスの起動から終了まで (インタプリタの起動を含む)
+
+Gemini と Fish Audio はローカルのモック (loadtest.py と同じもの) に向け、応答の遅延は 0 にする。
+--ref を指定すると、そのコミットの api/ を取り出して同じ計測を行い、現在のツリーと比較する。
+
+使い方:
+    python benchmarks/bench_cold_start.py --runs 5
+    python benchmarks/bench_cold_start.py --runs 5 --ref HEAD~1
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# (名前, メソッド, パス, JSONボディ)
+ROUTES = [
+    ("index", "GET", "/", None),
+    ("list", "GET", "/api/personalities", None),
+    ("get", "GET", "/api/personalities/electola", None),
+    ("chat", "POST", "/api/chat", {"prompt": "自己紹介して"}),
+    ("chat_stream", "POST", "/api/chat/stream", {"prompt": "自己紹介して"}),
+    ("tts", "POST", "/api/tts", {"text": "こんにちは。"}),
+    ("add", "POST", "/api/personalities/add", {"name": "bench", "text_content": "ベンチマーク用のペルソナです。"}),
+]
+
+RESULT_PREFIX = "COLDSTART "
+
+# --------------------------
+# 計測 (子プロセス側)
+# --------------------------
+
+def child(api_dir, route_name):
+    start = time.perf_counter()
+    sys.path.insert(0, api_dir)
+    import index
+    imported = time.perf_counter()
+
+    _, method, path, body = next(route for route in ROUTES if route[0] == route_name)
+    client = index.app.test_client()
+    if route_name == "add":
+        response = client.post(path, data=body)
+    else:
+        response = client.open(path, method=method, json=body)
+    response.get_data()  # ストリーミング応答は最後まで読む
+    response.close()
+    done = time.perf_counter()
+
+    print(RESULT_PREFIX + json.dumps({
+        "status": response.status_code,
+        "import": imported - start,
+        "first": done - imported,
+    }), flush=True)
+
+# --------------------------
+# 起動と集計 (親プロセス側)
+# --------------------------
+
+def export_ref(ref, dest):
+    """指定したコミットの api/ を dest に取り出す"""
+    archive = subprocess.run(["git", "archive", ref, "api"], cwd=ROOT, check=True, capture_output=True).stdout
+    subprocess.run(["tar", "-x", "-C", dest], input=archive, check=True)
+    return os.path.join(dest, "api")
+
+
+def run_once(api_dir, route_name, env, workdir):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", route_name, "--api-dir", api_dir],
+        cwd=workdir, env=env, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - start
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+            result["process"] = elapsed
+            return result
+    raise RuntimeError(f"{route_name}: 計測結果を取得できませんでした\n{proc.stderr[-2000:]}")
+
+
+def measure(label, api_dir, runs, env):
+    print(f"[{label}] {api_dir}")
+    print(f"  {'route':<12} {'status':>6} {'import[ms]':>11} {'first[ms]':>10} {'process[ms]':>12}")
+    totals = []
+    for route_name, *_ in ROUTES:
+        samples = []
+        for _ in range(runs):
+            # ペルソナの追加などでリポジトリを書き換えないよう、毎回コピーしたディレクトリで実行する
+            with tempfile.TemporaryDirectory() as workdir:
+                shutil.copytree(os.path.join(ROOT, "personalities"), os.path.join(workdir, "personalities"))
+                # 音声キャッシュがヒットしないよう、キャッシュの保存先も毎回空にする
+                run_env = dict(env, TTS_CACHE_DIR=os.path.join(workdir, "tts_cache"))
+                samples.append(run_once(api_dir, route_name, run_env, workdir))
+        median = {key: statistics.median(s[key] for s in samples) for key in ("import", "first", "process")}
+        totals.append(median)
+        print(
+            f"  {route_name:<12} {samples[-1]['status']:>6} {median['import'] * 1000:>11.1f} "
+            f"{median['first'] * 1000:>10.1f} {median['process'] * 1000:>12.1f}"
+        )
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="ルートごとの試行回数 (中央値を表示する)")
+    parser.add_argument("--ref", help="比較するコミット (例: HEAD~1)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--api-dir", default=os.path.join(ROOT, "api"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.api_dir, args.child)
+        return
+
+    from loadtest import start_upstream_mock  # 子プロセスの計測に httpx の import を含めないよう、ここで読み込む
+
+    upstream = start_upstream_mock(0.0, 0.0)
+    upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}"
+    env = dict(
+        os.environ,
+        GOOGLE_API_KEY="coldstart-dummy",
+        GEMINI_BASE_URL=upstream_url,
+        FISH_AUDIO_TOKEN="coldstart-dummy",
+        FISH_AUDIO_API_URL=f"{upstream_url}/v1/tts",
+        BLOB_READ_WRITE_TOKEN="",
+        LOG_LEVEL="WARNING",
+        REQUEST_LOG="false",
+        VERCEL="1",
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        current = measure("current", os.path.join(ROOT, "api"), args.runs, env)
+        if args.ref:
+            baseline = measure(args.ref, export_ref(args.ref, tmp), args.runs, env)
+            print(f"[{args.ref} -> current] process の中央値")
+            for (route_name, *_), before, after in zip(ROUTES, baseline, current):
+                print(f"  {route_name:<12} {before['process'] * 1000:>8.1f}ms -> {after['process'] * 1000:>8.1f}ms "
+                      f"({before['process'] / after['process']:.2f}x)")
+    upstream.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""ペルソナ追加時のファイル取り込み (extract_text_from_file) のベンチマーク
+
+ページ数の多いPDFをその場で生成し、以前の実装 (ページを += で連結する逐次処理) と
+現在の実装 (プロセスプールでページを並列抽出してリストで連結する) の所要時間を比較する。
+最後に /api/personalities/add へ同時にアップロードし、一時ファイルが衝突しないことも確認する。
+
+使い方:
+    python benchmarks/bench_ingest.py --pages 200 400 --lines 40
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PyPDF2 import PdfReader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import index  # noqa: E402
+
+
+def build_pdf(pages, lines):
+    """Helvetica のテキストだけを含む最小限のPDFを作る"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # ページツリーは後で埋める
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for p in range(pages):
+        text = "".join(
+            f"BT /F1 10 Tf 40 {800 - 18 * i} Td (Page {p + 1} line {i + 1}: persona background text for benchmark) Tj ET\n"
+            for i in range(lines)
+        ).encode("ascii")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(text) + text + b"endstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % pages
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % i + obj + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def legacy_extract_pdf(file_path):
+    """以前の実装"""
+    text_content = ""
+    with open(file_path, "rb") as f:
+        reader = PdfReader(f)
+        for page in reader.pages:
+            text_content += page.extract_text() or ""
+    return text_content
+
+
+def timed(func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def check_concurrent_uploads(pdf_bytes, count):
+    """同時アップロードでも各リクエストが自分のファイルの内容を受け取ること"""
+    client = index.app.test_client()
+    index.save_personality = lambda text, name=None: name  # 保存はせずに名前だけ返す
+
+    def upload(i):
+        data = {
+            "name": f"bench_{i}",
+            "file": (io.BytesIO(pdf_bytes if i % 2 else f"テキスト {i}".encode("cp932")), "a.pdf" if i % 2 else "a.txt"),
+        }
+        return client.post("/api/personalities/add", data=data, content_type="multipart/form-data").status_code
+
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=count) as pool:
+        statuses = list(pool.map(upload, range(count)))
+    print(f"concurrent uploads: {statuses.count(200)}/{count} succeeded")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[50, 200, 400])
+    parser.add_argument("--lines", type=int, default=40, help="1ページあたりの行数")
+    args = parser.parse_args()
+
+    print(f"workers={index.INGEST_WORKERS} parallel_min_pages={index.INGEST_PARALLEL_MIN_PAGES}")
+    print(f"{'pages':>6} {'size[KB]':>9} {'legacy[s]':>10} {'current[s]':>11} {'speedup':>8}")
+    last_pdf = None
+    for pages in args.pages:
+        pdf_bytes = build_pdf(pages, args.lines)
+        last_pdf = pdf_bytes
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            f.write(pdf_bytes)
+        try:
+            # プロセスプールの起動時間を含めないよう一度温めておく
+            timed(index.extract_text_from_file, f.name, ".pdf")
+            legacy, expected = timed(legacy_extract_pdf, f.name)
+            current, actual = timed(index.extract_text_from_file, f.name, ".pdf")
+            assert actual == expected, "抽出結果が以前の実装と一致しません"
+            print(f"{pages:>6} {len(pdf_bytes) // 1024:>9} {legacy:>10.3f} {current:>11.3f} {legacy / current:>7.1f}x")
+        finally:
+            os.remove(f.name)
+    check_concurrent_uploads(last_pdf, 8)
+
+
+if __name__ == "__main__":
+    main()
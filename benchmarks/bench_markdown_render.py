@@ -0,0 +1,110 @@
+"""応答の Markdown 変換 (/api/chat/stream の delta と done) のベンチマーク
+
+LLM の応答に近い Markdown (見出し・段落・リスト・コードブロック・表) をチャンクに分けて流し、
+ストリーミング1回分の変換にかかる時間を比較する。
+
+- before: 断片ごとに markdown.markdown() (毎回インスタンスを作る)、done で全体を変換し直す
+- after : MarkdownRenderer (スレッドごとのインスタンス・サニタイズ込み)、done は確定済みの断片を使い回す
+- cached: 同じ応答をもう一度変換した場合 (応答キャッシュの作成・再表示など)
+  (断片の数がキャッシュの件数の上限 (既定 512) を超える長さの応答では、after と同程度になる)
+
+あわせて、サニタイズの高速判定 (python-markdown が出力した HTML) と、
+生の HTML を含む場合 (HTMLParser で組み立て直す) の1回あたりの時間も表示する。
+
+使い方:
+    python benchmarks/bench_markdown_render.py --sizes 2000 20000 100000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import markdown  # noqa: E402
+
+import markdown_render  # noqa: E402
+
+BLOCKS = [
+    "## 手順 {i}\n\n",
+    "ここでは **{i}番目** の手順を説明します。設定ファイルを開き、`timeout` の値を確認してください。\n"
+    "変更したら保存して、[ドキュメント](https://example.com/docs/{i}) を参照してください。\n\n",
+    "- 項目 {i}-1\n- 項目 {i}-2 *補足*\n- 項目 {i}-3\n\n",
+    "```python\ndef step_{i}(value):\n    return value * {i}\n```\n\n",
+    "| 名前 | 値 |\n|---|---|\n| a{i} | {i} |\n| b{i} | {i}0 |\n\n",
+    "> 注意: 手順 {i} の前に必ずバックアップを取ってください。\n\n",
+]
+
+
+def make_reply(size):
+    parts = []
+    i = 0
+    while sum(map(len, parts)) < size:
+        parts.append(BLOCKS[i % len(BLOCKS)].format(i=i))
+        i += 1
+    return "".join(parts)
+
+
+def chunks(text, size=40):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def stream(render, pieces):
+    """MarkdownStream にチャンクを順に流す"""
+    import index
+    md_stream = index.MarkdownStream(render=render)
+    for piece in pieces:
+        md_stream.feed(piece)
+    return md_stream
+
+
+def run_before(pieces):
+    md_stream = stream(lambda text: markdown.markdown(text, extensions=["nl2br"]), pieces)
+    return markdown.markdown(md_stream.text, extensions=["nl2br"])
+
+
+def run_after(renderer, pieces):
+    return stream(renderer.render, pieces).html()
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 20000, 100000], help="応答の文字数")
+    parser.add_argument("--repeat", type=int, default=5, help="計測回数 (中央値を表示)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("REQUEST_LOG", "false")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    print(f"  {'chars':>8} {'before [ms]':>12} {'after [ms]':>12} {'cached [ms]':>12} {'speedup':>8}")
+    for size in args.sizes:
+        reply = make_reply(size)
+        pieces = chunks(reply)
+        # 計測のたびにキャッシュを空にする (cached だけは温めたものを使う)
+        t_before = timed(lambda: run_before(pieces), args.repeat)
+        t_after = timed(lambda: run_after(markdown_render.MarkdownRenderer(), pieces), args.repeat)
+        warm = markdown_render.MarkdownRenderer()
+        run_after(warm, pieces)
+        t_cached = timed(lambda: run_after(warm, pieces), args.repeat)
+        print(f"  {len(reply):>8} {t_before:>12.1f} {t_after:>12.1f} {t_cached:>12.2f} {t_before / t_after:>7.1f}x")
+
+    clean = markdown.markdown(make_reply(2000), extensions=["nl2br"])
+    dirty = clean + '<p onclick="x">raw <script>alert(1)</script><img src=x></p>'
+    n = 200
+    t_clean = timed(lambda: [markdown_render.sanitize_html(clean) for _ in range(n)], 3) / n * 1000
+    t_dirty = timed(lambda: [markdown_render.sanitize_html(dirty) for _ in range(n)], 3) / n * 1000
+    print(f"  sanitize ({len(clean)}文字): 高速判定 {t_clean:.1f}us / 組み立て直し {t_dirty:.1f}us")
+
+
+if __name__ == "__main__":
+    main()
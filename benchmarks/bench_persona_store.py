@@ -0,0 +1,149 @@
+"""ペルソナの保存先 (1ペルソナ1ファイルの JSON と SQLite のストア) のベンチマーク
+
+同じ件数のペルソナを一時ディレクトリに作り、以下を比較する。
+
+- import : JSON はファイルの書き出し、ストアは import_json_dir() での取り込み
+- list   : JSON はすべてのファイルを読んで解析 (load_personalities() と同じ)、
+           ストアは names() と list_meta() (本文は読まない)
+- get    : 名前を指定して1件読み込む (平均)
+- update : 1件を上書きする (JSON は一時ファイルに書いてから置き換える)
+- concurrent: 複数スレッドから同時に update した場合のスループットと、最後に全件が読めるか
+- size   : ディスク上の合計サイズ
+
+使い方:
+    python benchmarks/bench_persona_store.py --count 10000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import persona_store  # noqa: E402
+
+
+def make_instruction(i, size):
+    """それらしい長さのペルソナ本文 (圧縮率が極端にならないよう番号と文を混ぜる)"""
+    sentence = f"あなたはペルソナ{i}番です。丁寧な口調で、利用者の質問に簡潔に答えてください。"
+    return (sentence * (size // len(sentence) + 1))[:size]
+
+
+def write_json(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"system_instruction": text}, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def load_json_dir(directory):
+    personalities = {}
+    for filename in os.listdir(directory):
+        if filename.endswith(".json"):
+            with open(os.path.join(directory, filename), encoding="utf-8") as f:
+                personalities[filename[:-5]] = json.load(f).get("system_instruction", "")
+    return personalities
+
+
+def dir_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_concurrent(update, threads, per_thread, names):
+    errors = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(per_thread):
+            try:
+                update(rng.choice(names), f"更新 {seed} {rng.random()}")
+            except Exception as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    return threads * per_thread / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=10000, help="ペルソナ数")
+    parser.add_argument("--size", type=int, default=2000, help="1件あたりの本文の文字数")
+    parser.add_argument("--lookups", type=int, default=1000, help="get を計測する回数")
+    parser.add_argument("--threads", type=int, default=8, help="同時に更新するスレッド数")
+    parser.add_argument("--updates", type=int, default=100, help="スレッドごとの更新回数")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    names = [f"persona_{i:05d}" for i in range(args.count)]
+    lookups = [rng.choice(names) for _ in range(args.lookups)]
+    print(f"personas={args.count} size={args.size}文字 lookups={args.lookups} threads={args.threads}x{args.updates}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_dir = os.path.join(tmp, "personalities")
+        os.makedirs(json_dir)
+        db_path = os.path.join(tmp, "personas.db")
+
+        t_json_import, _ = timed(lambda: [
+            write_json(os.path.join(json_dir, f"{name}.json"), make_instruction(i, args.size))
+            for i, name in enumerate(names)
+        ])
+        store = persona_store.PersonaStore(db_path)
+        t_store_import, imported = timed(persona_store.import_json_dir, store, json_dir)
+        assert imported == args.count
+
+        t_json_list, loaded = timed(load_json_dir, json_dir)
+        assert len(loaded) == args.count
+        t_store_names, store_names = timed(store.names)
+        t_store_meta, _ = timed(store.list_meta)
+        assert len(store_names) == args.count
+
+        def json_get(name):
+            with open(os.path.join(json_dir, f"{name}.json"), encoding="utf-8") as f:
+                return json.load(f)["system_instruction"]
+
+        t_json_get, _ = timed(lambda: [json_get(name) for name in lookups])
+        t_store_get, _ = timed(lambda: [store.get(name) for name in lookups])
+
+        t_json_update, _ = timed(lambda: [write_json(os.path.join(json_dir, f"{name}.json"), "更新") for name in lookups[:200]])
+        t_store_update, _ = timed(lambda: [store.update(name, "更新") for name in lookups[:200]])
+
+        json_tput, json_errors = bench_concurrent(
+            lambda name, text: write_json(os.path.join(json_dir, f"{name}.json"), text), args.threads, args.updates, names
+        )
+        store_tput, store_errors = bench_concurrent(store.update, args.threads, args.updates, names)
+        # 同時更新の後も全件が読める (壊れたファイル・行がない) ことを確認する
+        assert len(load_json_dir(json_dir)) == args.count
+        assert len(store.get_all()) == args.count
+
+        wal = db_path + "-wal"
+        store_size = os.path.getsize(db_path) + (os.path.getsize(wal) if os.path.exists(wal) else 0)
+
+        n = args.lookups
+        print(f"  {'':<20} {'json':>12} {'store':>12}")
+        print(f"  {'import [s]':<20} {t_json_import:>12.2f} {t_store_import:>12.2f}")
+        print(f"  {'list [ms]':<20} {t_json_list * 1000:>12.1f} {t_store_names * 1000:>12.1f}  (list_meta: {t_store_meta * 1000:.1f}ms)")
+        print(f"  {'get [us/件]':<20} {t_json_get / n * 1e6:>12.1f} {t_store_get / n * 1e6:>12.1f}")
+        print(f"  {'update [us/件]':<20} {t_json_update / 200 * 1e6:>12.1f} {t_store_update / 200 * 1e6:>12.1f}")
+        print(f"  {'concurrent [件/s]':<20} {json_tput:>12.0f} {store_tput:>12.0f}  (errors: {len(json_errors)} / {len(store_errors)})")
+        print(f"  {'size [MB]':<20} {dir_size(json_dir) / 1e6:>12.1f} {store_size / 1e6:>12.1f}")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,798 @@
+"""記録したトラフィックを再生するベンチマーク (Gemini / Fish Audio / Blob はローカルのスタンドイン)
+
+外部APIは standins.py のスタンドインに置き換え、トレース (JSONL) のリクエストを記録どおりの間隔で
+/api/chat・/api/chat/stream・/api/tts・/api/personalities*・/api/personalities/add に送る。
+
+サブコマンド:
+- record : トレースを作る
+    --log PATH    : アプリのリクエストログ (REQUEST_LOG の出力) から、ルート・到着時刻 (started_at)・本文のサイズを取り出す
+    --synthetic N : ルートの比率 (--mix) と到着レート (--rate、ポアソン到着) から N 件作る
+    本文 (プロンプト・読み上げる文・ペルソナ) は --corpus の JSONL (例: requests.jsonl) の文字列から作る。
+    --reuse の割合で、以前と同じプロンプト・文を繰り返す (キャッシュ・同時実行のまとめが効く状況)
+- run    : トレースを再生し、ルートごとのスループットと p50/p95/p99 を表示する
+    --profile DIR を指定すると、ルートごとに数件を1件ずつ処理して CPU (cProfile、DIR/<label>/<route>.prof) と
+    メモリ割り当て (tracemalloc、DIR/<label>/<route>.alloc.txt) のプロファイルを取る
+    (Flask のテストクライアントで処理するため、非同期モードでも同期のハンドラを計測する。
+     cProfile はリクエストを処理したスレッドだけを計測し、CPU 時間はバックグラウンドのスレッドを含む)
+- compare: 2つのコミット (--base / --head、省略時は作業ツリー) で同じトレースを再生するか、
+           run の結果 (--results A.json B.json) を比べ、--threshold を超えて悪化したルートを表示する
+           (悪化があれば終了コード 1)
+
+使い方:
+    python benchmarks/bench_replay.py record --synthetic 300 --rate 10 --corpus requests.jsonl -o trace.jsonl
+    python benchmarks/bench_replay.py record --log app.log --corpus requests.jsonl -o trace.jsonl
+    python benchmarks/bench_replay.py run trace.jsonl --mode sync --profile profiles --out current.json
+    python benchmarks/bench_replay.py compare trace.jsonl --base HEAD~1 --runs 3
+    python benchmarks/bench_replay.py compare --results base.json current.json
+"""
+import argparse
+import asyncio
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from urllib.parse import quote, unquote
+
+import standins
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+API_DIR = os.path.join(ROOT, "api")
+
+# { 名前: (メソッド, ルート) }
+ROUTES = {
+    "chat": ("POST", "/api/chat"),
+    "chat_stream": ("POST", "/api/chat/stream"),
+    "tts": ("POST", "/api/tts"),
+    "list": ("GET", "/api/personalities"),
+    "get": ("GET", "/api/personalities/<name>"),
+    "add": ("POST", "/api/personalities/add"),
+    "update": ("POST", "/api/personalities/update"),
+}
+DEFAULT_MIX = "chat=3,chat_stream=3,tts=6,list=3,get=2,add=1,update=1"
+
+PROFILE_PREFIX = "REPLAY-PROFILE "
+PROCESS_STATS_PATH = "/__replay__/process"
+
+# コーパスがない場合の文
+FALLBACK_CORPUS = [
+    "今日の天気を教えてください。",
+    "明日の会議の準備で、気をつけることはありますか。",
+    "Pythonでファイルを読み込む方法を、例を使って説明してください。",
+    "おすすめの本を3冊挙げて、それぞれの理由を教えてください。",
+    "あなたは丁寧な口調で、利用者の質問に簡潔に答えるアシスタントです。",
+]
+
+# --------------------------
+# トレースの作成 (record)
+# --------------------------
+
+def _strings(value):
+    """JSON の値に含まれる文字列をすべて返す"""
+    if isinstance(value, str):
+        if value.strip():
+            yield value.strip()
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+
+
+def load_corpus(path):
+    """JSONL の1行ごとに、含まれる文字列をつなげた文章を返す (JSON でない行はそのまま使う)"""
+    if not path:
+        return list(FALLBACK_CORPUS)
+    texts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                text = "\n".join(_strings(json.loads(line)))
+            except json.JSONDecodeError:
+                text = line
+            if text:
+                texts.append(text)
+    return texts or list(FALLBACK_CORPUS)
+
+
+def split_sentences(text):
+    return [s.strip() for s in re.split(r"(?<=[。．！？!?\n])|(?<=\. )", text) if s.strip()]
+
+
+def json_overhead(body):
+    """text を除いた JSON の本文のバイト数 (ブラウザの JSON.stringify と同じく非ASCIIはエスケープしない)"""
+    return len(json.dumps(body, ensure_ascii=False).encode("utf-8"))
+
+
+def fit_text(text, target_bytes, overhead):
+    """本文全体が target_bytes バイト程度になるよう text を切り詰める (足りない場合は繰り返す)"""
+    if not target_bytes:
+        return text
+    budget = max(1, target_bytes - overhead)
+    encoded = len(text.encode("utf-8")) or 1
+    if encoded < budget:
+        text = text * (budget // encoded + 1)
+    bytes_per_char = len(text.encode("utf-8")) / len(text)
+    return text[:max(1, int(budget / bytes_per_char))]
+
+
+class TraceBuilder:
+    """コーパスの文章からリクエストを作る"""
+
+    def __init__(self, corpus, personas, rng, reuse=0.3, persona_chars=4000):
+        self.corpus = corpus
+        self.sentences = [s for text in corpus for s in split_sentences(text)] or list(FALLBACK_CORPUS)
+        self.personas = personas or ["electola"]
+        self.rng = rng
+        self.reuse = reuse
+        self.persona_chars = persona_chars
+        self._used = defaultdict(list) # { ルート: 使った文 }
+        self._added = 0
+
+    def _text(self, kind, sentences):
+        used = self._used[kind]
+        if used and self.rng.random() < self.reuse:
+            return self.rng.choice(used)
+        start = self.rng.randrange(len(self.sentences))
+        text = "".join(self.sentences[start:start + sentences]) or self.sentences[0]
+        used.append(text)
+        return text
+
+    def request(self, name, at, request_bytes=None, path=None):
+        method, route = ROUTES[name]
+        entry = {"at": round(at, 4), "name": name, "method": method, "path": route}
+        persona = self.rng.choice(self.personas)
+        if name in ("chat", "chat_stream"):
+            body = {"prompt": "", "personality": persona}
+            body["prompt"] = fit_text(self._text("chat", self.rng.randint(1, 3)), request_bytes, json_overhead(body))
+            entry["json"] = body
+        elif name == "tts":
+            body = {"text": "", "personality": persona}
+            body["text"] = fit_text(self._text("tts", 1), request_bytes, json_overhead(body))
+            entry["json"] = body
+        elif name == "get":
+            # 記録にあるペルソナが手元にない場合は、手元のペルソナに置き換える
+            recorded = unquote(path.rsplit("/", 1)[-1]) if path else None
+            entry["path"] = f"/api/personalities/{quote(recorded if recorded in self.personas else persona)}"
+        elif name in ("add", "update"):
+            # フォーム (multipart) の区切りなどは 200 バイト程度とみなす
+            overhead = json_overhead({"name": persona, "text_content": ""}) if name == "update" else 200
+            text = fit_text(self.rng.choice(self.corpus)[:self.persona_chars], request_bytes, overhead)
+            if name == "update":
+                entry["json"] = {"name": persona, "text_content": text}
+            else:
+                self._added += 1
+                # 半分は名前を指定せず、名前の生成 (Gemini) も通す
+                entry["form"] = {"text_content": text}
+                if self._added % 2:
+                    entry["form"]["name"] = f"replay_{self._added}"
+        return entry
+
+
+def read_request_log(path):
+    """リクエストログ (1行1件の JSON) から (到着時刻, ルート名, 本文のバイト数, パス) を返す
+
+    JSON 以外の行 (通常のログ) は読み飛ばし、再生できないルートは数えるだけにする。
+    到着時刻 (started_at) のない古いログは None を返す。
+    """
+    names = {(method, route): name for name, (method, route) in ROUTES.items()}
+    records, skipped = [], defaultdict(int)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("{"):
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "route" not in record:
+                continue
+            name = names.get((record.get("method"), record["route"]))
+            if name is None:
+                skipped[record["route"]] += 1
+                continue
+            records.append((record.get("started_at"), name, record.get("request_bytes"), record.get("path")))
+    return records, dict(skipped)
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ROUTES:
+            raise ValueError(f"不明なルートです: {name} (指定できるもの: {', '.join(ROUTES)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def record(args):
+    rng = random.Random(args.seed)
+    personas = sorted(f[:-5] for f in os.listdir(args.personalities) if f.endswith(".json"))
+    builder = TraceBuilder(load_corpus(args.corpus), personas, rng, reuse=args.reuse, persona_chars=args.persona_chars)
+    trace = []
+    if args.log:
+        records, skipped = read_request_log(args.log)
+        if not records:
+            raise SystemExit(f"{args.log} に再生できるリクエストがありません (REQUEST_LOG の出力を指定してください)")
+        if all(arrived is not None for arrived, *_ in records):
+            records.sort(key=lambda record: record[0])
+            origin = records[0][0]
+            offsets = [arrived - origin for arrived, *_ in records]
+        else:
+            # 到着時刻のないログは、記録された順に --rate のポアソン到着で並べる
+            offsets, at = [], 0.0
+            for _ in records:
+                at += rng.expovariate(args.rate)
+                offsets.append(at)
+        for at, (_, name, request_bytes, path) in zip(offsets, records):
+            trace.append(builder.request(name, at, request_bytes, path))
+        if skipped:
+            print(f"再生の対象外: {skipped}")
+    else:
+        mix = parse_mix(args.mix)
+        names, weights = list(mix), list(mix.values())
+        at = 0.0
+        for _ in range(args.synthetic):
+            at += rng.expovariate(args.rate)
+            trace.append(builder.request(rng.choices(names, weights)[0], at))
+    with open(args.output, "w", encoding="utf-8") as f:
+        for entry in trace:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    counts = defaultdict(int)
+    for entry in trace:
+        counts[entry["name"]] += 1
+    span = trace[-1]["at"] if trace else 0
+    print(f"{args.output}: {len(trace)} 件 / {span:.1f}秒 {dict(counts)}")
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        trace = [json.loads(line) for line in f if line.strip()]
+    return sorted(trace, key=lambda entry: entry["at"])
+
+# --------------------------
+# アプリの起動 (子プロセス側)
+# --------------------------
+
+def import_app(api_dir):
+    """スタンドインの Blob を使うよう vercel_blob を差し替えてから index を import する"""
+    if os.environ.get("REPLAY_BLOB_URL"):
+        standins.install_blob_client(os.environ["REPLAY_BLOB_URL"])
+    sys.path.insert(0, api_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import index
+    return index
+
+
+def process_stats():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu_s": usage.ru_utime + usage.ru_stime, "max_rss_kb": usage.ru_maxrss, "threads": threading.active_count()}
+
+
+def with_process_stats_wsgi(app):
+    """PROCESS_STATS_PATH でプロセスの CPU 時間・最大RSS を返す WSGI ミドルウェア"""
+    def wrapped(environ, start_response):
+        if environ.get("PATH_INFO") == PROCESS_STATS_PATH:
+            start_response("200 OK", [("Content-Type", "application/json")])
+            return [json.dumps(process_stats()).encode()]
+        return app(environ, start_response)
+    return wrapped
+
+
+def with_process_stats_asgi(app):
+    async def wrapped(scope, receive, send):
+        if scope["type"] == "http" and scope.get("path") == PROCESS_STATS_PATH:
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+            await send({"type": "http.response.body", "body": json.dumps(process_stats()).encode()})
+            return
+        await app(scope, receive, send)
+    return wrapped
+
+
+def serve(mode, api_dir, port, threads):
+    index = import_app(api_dir)
+    sys.stdout = open(os.devnull, "w")
+    if mode == "sync":
+        from loadtest import PooledWSGIServer, QuietHandler
+
+        server = PooledWSGIServer(("127.0.0.1", port), QuietHandler, threads=threads)
+        server.set_app(with_process_stats_wsgi(index.app))
+        server.serve_forever()
+    else:
+        import asgi
+        from hypercorn.asyncio import serve as hypercorn_serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        config.backlog = 1024
+        config.accesslog = None
+        config.errorlog = None
+        asyncio.run(hypercorn_serve(with_process_stats_asgi(asgi.app), config))
+
+
+def send_test_request(client, entry):
+    response = client.open(entry["path"], method=entry["method"], json=entry.get("json"), data=entry.get("form"))
+    response.get_data() # ストリーミング応答は最後まで読む
+    response.close()
+    return response.status_code
+
+
+def top_functions(profiler, api_dir, n):
+    """api/ 以下の関数を累積時間の長い順に n 件"""
+    stats = pstats.Stats(profiler).stats
+    rows = [
+        (cumtime, f"{os.path.basename(filename)}:{line}({func})")
+        for (filename, line, func), (_, _, _, cumtime, _) in stats.items()
+        if filename.startswith(api_dir)
+    ]
+    return [{"function": name, "cum_ms": round(cumtime * 1000, 2)} for cumtime, name in sorted(rows, reverse=True)[:n]]
+
+
+def profile_routes(api_dir, trace_path, samples, out_dir):
+    """ルートごとに samples 件を1件ずつ処理し、CPU とメモリ割り当てのプロファイルを取る"""
+    index = import_app(api_dir)
+    api_dir = os.path.dirname(os.path.abspath(index.__file__))
+    client = index.app.test_client()
+    by_route = defaultdict(list)
+    for entry in load_trace(trace_path):
+        by_route[entry["name"]].append(entry)
+    os.makedirs(out_dir, exist_ok=True)
+
+    results = {}
+    for name, entries in by_route.items():
+        send_test_request(client, entries[0]) # 最初の1件は import などを含むため計測しない
+        measured = entries[1:samples + 1] or entries[:1]
+
+        profiler = cProfile.Profile()
+        cpu_start = time.process_time()
+        for entry in measured:
+            profiler.enable()
+            send_test_request(client, entry)
+            profiler.disable()
+        cpu_ms = (time.process_time() - cpu_start) / len(measured) * 1000
+        profiler.dump_stats(os.path.join(out_dir, f"{name}.prof"))
+
+        # 割り当ては CPU の計測と分けて取る (tracemalloc を有効にすると処理が遅くなるため)
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        peaks = []
+        for entry in measured:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            send_test_request(client, entry)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        growth = [d for d in tracemalloc.take_snapshot().compare_to(before, "lineno") if d.size_diff > 0]
+        tracemalloc.stop()
+        with open(os.path.join(out_dir, f"{name}.alloc.txt"), "w", encoding="utf-8") as f:
+            f.write(f"# {name}: {len(measured)} 件を処理した後に残っている割り当て (増えた順)\n")
+            for diff in growth[:30]:
+                f.write(f"{diff}\n")
+
+        results[name] = {
+            "samples": len(measured),
+            "cpu_ms": round(cpu_ms, 2),
+            "peak_alloc_kb": round(statistics.median(peaks) / 1024, 1),
+            "retained_kb": round(sum(d.size_diff for d in growth) / 1024 / len(measured), 1),
+            "top_cpu": top_functions(profiler, api_dir, 5),
+            "top_alloc": [
+                {"line": f"{os.path.basename(d.traceback[0].filename)}:{d.traceback[0].lineno}", "kb": round(d.size_diff / 1024, 1)}
+                for d in growth[:3]
+            ],
+        }
+    print(PROFILE_PREFIX + json.dumps(results, ensure_ascii=False), flush=True)
+
+# --------------------------
+# 再生と集計 (親プロセス側)
+# --------------------------
+
+def app_env(standin_url, workdir, blob):
+    env = dict(
+        os.environ,
+        GOOGLE_API_KEY="replay-dummy",
+        GEMINI_BASE_URL=standin_url,
+        FISH_AUDIO_TOKEN="replay-dummy",
+        FISH_AUDIO_API_URL=f"{standin_url}/v1/tts",
+        TTS_CACHE_DIR=os.path.join(workdir, "tts_cache"),
+        BLOB_READ_WRITE_TOKEN="",
+        VERCEL_PROJECT_ID="",
+        LOG_LEVEL="WARNING",
+        REQUEST_LOG="false",
+    )
+    env.pop("REPLAY_BLOB_URL", None)
+    if blob:
+        env.update(BLOB_READ_WRITE_TOKEN="replay-dummy", VERCEL_PROJECT_ID="replay-dummy", REPLAY_BLOB_URL=standin_url)
+    return env
+
+
+def launch(mode, api_dir, threads, env, workdir):
+    import httpx
+    from loadtest import free_port
+
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", mode, "--api-dir", api_dir,
+         "--port", str(port), "--serve-threads", str(threads)],
+        cwd=workdir, env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            if httpx.get(f"{base_url}/api/personalities", timeout=5).status_code == 200:
+                return proc, base_url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"{mode} サーバーが起動しませんでした ({api_dir})")
+
+
+async def replay(base_url, trace, speed, concurrency):
+    """トレースの時刻どおりにリクエストを送り (同時に concurrency 件まで)、ルートごとの計測値を返す"""
+    import httpx
+
+    samples = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        start = time.perf_counter()
+
+        async def one(entry):
+            scheduled = start + entry["at"] / speed
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            async with semaphore:
+                sent = time.perf_counter()
+                first_byte, status = None, None
+                try:
+                    async with client.stream(entry["method"], entry["path"], json=entry.get("json"), data=entry.get("form")) as r:
+                        status = r.status_code
+                        async for _ in r.aiter_raw():
+                            if first_byte is None:
+                                first_byte = time.perf_counter()
+                except httpx.HTTPError:
+                    pass
+                done = time.perf_counter()
+            samples[entry["name"]].append({
+                "latency": done - sent,
+                "ttfb": (first_byte or done) - sent,
+                "lag": sent - scheduled, # 送信が予定より遅れた時間 (クライアント側の詰まり)
+                "status": status,
+            })
+
+        await asyncio.gather(*(one(entry) for entry in trace))
+        wall = time.perf_counter() - start
+    return samples, wall
+
+
+def run_once(trace_path, api_dir, args, label, profile_dir=None):
+    """1つのコミット (api_dir) でトレースを1回再生し、計測値を返す"""
+    import httpx
+
+    trace = load_trace(trace_path)
+    stand = standins.StandIns.from_args(args).start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            # ペルソナの追加・更新でリポジトリを書き換えないよう、コピーしたディレクトリで実行する
+            shutil.copytree(os.path.join(ROOT, "personalities"), os.path.join(workdir, "personalities"))
+            if not args.no_blob:
+                stand.seed_personas(os.path.join(workdir, "personalities"))
+            env = app_env(stand.url, workdir, not args.no_blob)
+            proc, base_url = launch(args.mode, api_dir, args.threads, env, workdir)
+            try:
+                before = httpx.get(base_url + PROCESS_STATS_PATH).json()
+                upstream_before = stand.snapshot()
+                samples, wall = asyncio.run(replay(base_url, trace, args.speed, args.concurrency))
+                after = httpx.get(base_url + PROCESS_STATS_PATH).json()
+                upstream = {k: v - upstream_before[k] for k, v in stand.snapshot().items()}
+            finally:
+                proc.terminate()
+                proc.wait()
+
+            profiles = None
+            if profile_dir:
+                profiles = run_profile(trace_path, api_dir, args.profile_samples, os.path.join(profile_dir, label), stand, not args.no_blob)
+    finally:
+        stand.shutdown()
+    return {
+        "samples": samples,
+        "wall_s": wall,
+        "cpu_s": after["cpu_s"] - before["cpu_s"],
+        "max_rss_mb": after["max_rss_kb"] / 1024,
+        "upstream": upstream,
+        "profiles": profiles,
+    }
+
+
+def run_profile(trace_path, api_dir, samples, out_dir, stand, blob):
+    # 再生で変わったペルソナ・キャッシュの影響を受けないよう、新しいディレクトリとBlobで始める
+    with tempfile.TemporaryDirectory() as profile_workdir:
+        shutil.copytree(os.path.join(ROOT, "personalities"), os.path.join(profile_workdir, "personalities"))
+        stand.clear_blobs()
+        if blob:
+            stand.seed_personas(os.path.join(profile_workdir, "personalities"))
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--profile-child", os.path.abspath(trace_path),
+             "--api-dir", api_dir, "--child-samples", str(samples), "--child-out", os.path.abspath(out_dir)],
+            cwd=profile_workdir, env=app_env(stand.url, profile_workdir, blob), capture_output=True, text=True,
+        )
+    for line in proc.stdout.splitlines():
+        if line.startswith(PROFILE_PREFIX):
+            return json.loads(line[len(PROFILE_PREFIX):])
+    raise RuntimeError(f"プロファイルを取得できませんでした\n{proc.stderr[-2000:]}")
+
+
+def summarize(label, api_dir, args, runs):
+    """複数回の再生の計測値をまとめる (百分位数はすべての回のリクエストから求める)"""
+    from loadtest import percentile
+
+    samples = defaultdict(list)
+    for run in runs:
+        for name, items in run["samples"].items():
+            samples[name].extend(items)
+    wall = sum(run["wall_s"] for run in runs)
+    routes = {}
+    for name in sorted(samples, key=list(ROUTES).index):
+        items = samples[name]
+        ok = [s for s in items if s["status"] is not None and s["status"] < 500]
+        latencies = [s["latency"] for s in ok]
+        routes[name] = {
+            "n": len(items),
+            "errors": len(items) - len(ok),
+            "rps": round(len(ok) / wall, 3),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else float("nan"),
+            "ttfb_p50_ms": round(percentile([s["ttfb"] for s in ok], 50) * 1000, 1),
+            "lag_p99_ms": round(percentile([s["lag"] for s in items], 99) * 1000, 1),
+        }
+    upstream = defaultdict(int)
+    for run in runs:
+        for key, value in run["upstream"].items():
+            upstream[key] += value
+    total = sum(len(items) for items in samples.values())
+    return {
+        "label": label,
+        "api_dir": api_dir,
+        "mode": args.mode,
+        "runs": len(runs),
+        "requests": total,
+        "errors": sum(route["errors"] for route in routes.values()),
+        "throughput_rps": round(sum(route["n"] - route["errors"] for route in routes.values()) / wall, 3),
+        "wall_s": round(wall, 2),
+        "cpu_s": round(sum(run["cpu_s"] for run in runs), 2),
+        "max_rss_mb": round(max(run["max_rss_mb"] for run in runs), 1),
+        "upstream": dict(upstream),
+        "routes": routes,
+        "profiles": next((run["profiles"] for run in runs if run["profiles"]), None),
+    }
+
+
+def report(result):
+    print(
+        f"[{result['label']}] {result['mode']} {result['requests']} requests x{result['runs']} in {result['wall_s']:.1f}s "
+        f"-> {result['throughput_rps']:.1f} req/s, errors={result['errors']}, "
+        f"cpu={result['cpu_s']:.1f}s, max_rss={result['max_rss_mb']:.0f}MB"
+    )
+    print(f"  {'route':<12} {'n':>5} {'err':>4} {'req/s':>7} {'p50[ms]':>8} {'p95[ms]':>8} {'p99[ms]':>8} {'ttfb50':>7} {'lag99':>6}")
+    for name, r in result["routes"].items():
+        print(
+            f"  {name:<12} {r['n']:>5} {r['errors']:>4} {r['rps']:>7.2f} {r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f} "
+            f"{r['p99_ms']:>8.0f} {r['ttfb_p50_ms']:>7.0f} {r['lag_p99_ms']:>6.0f}"
+        )
+    print("  upstream: " + ", ".join(f"{k}={v}" for k, v in result["upstream"].items() if v))
+    if result["profiles"]:
+        print(f"  {'profile':<12} {'cpu[ms]':>8} {'peak[KB]':>9} {'kept[KB]':>9}  api/ 以下で累積時間の長い関数")
+        for name, p in sorted(result["profiles"].items(), key=lambda item: list(ROUTES).index(item[0])):
+            top = ", ".join(f["function"] for f in p["top_cpu"][:2]) or "-"
+            print(f"  {name:<12} {p['cpu_ms']:>8.1f} {p['peak_alloc_kb']:>9.0f} {p['retained_kb']:>9.1f}  {top}")
+
+
+def replay_commit(trace_path, api_dir, args, label):
+    profile_dir = getattr(args, "profile", None)
+    runs = [run_once(trace_path, api_dir, args, label, profile_dir if i == 0 else None) for i in range(args.runs)]
+    return summarize(label, api_dir, args, runs)
+
+
+def export_api(ref, dest):
+    from bench_cold_start import export_ref
+
+    os.makedirs(dest, exist_ok=True)
+    return export_ref(ref, dest)
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        api_dir = export_api(args.ref, tmp) if args.ref else API_DIR
+        result = replay_commit(args.trace, api_dir, args, args.ref or "current")
+    report(result)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+# --------------------------
+# 比較 (compare)
+# --------------------------
+
+LATENCY_METRICS = ("p50_ms", "p95_ms", "p99_ms")
+# 悪化の判定に使うのに必要なサンプル数 (p95 は 20 件、p99 は 100 件あれば1件の外れ値だけでは決まらない)
+MIN_SAMPLES = {"p95_ms": 20, "p99_ms": 100}
+
+
+def find_regressions(base, head, threshold, min_ms):
+    """head が base より threshold (割合) かつ min_ms 以上悪化した (ルート, 指標) の一覧"""
+    regressions = []
+    for name, b in base["routes"].items():
+        h = head["routes"].get(name)
+        if h is None:
+            continue
+        for metric in LATENCY_METRICS:
+            if min(b["n"], h["n"]) < MIN_SAMPLES.get(metric, 1):
+                continue # サンプルが少なく、裾のパーセンタイルは1件の外れ値で決まってしまう
+            if h[metric] > b[metric] * (1 + threshold) and h[metric] - b[metric] > min_ms:
+                regressions.append((name, metric))
+        if h["rps"] < b["rps"] * (1 - threshold):
+            regressions.append((name, "rps"))
+        if h["errors"] > b["errors"]:
+            regressions.append((name, "errors"))
+        profile_b, profile_h = (base.get("profiles") or {}).get(name), (head.get("profiles") or {}).get(name)
+        if profile_b and profile_h and profile_h["cpu_ms"] > profile_b["cpu_ms"] * (1 + threshold) \
+                and profile_h["cpu_ms"] - profile_b["cpu_ms"] > min_ms:
+            regressions.append((name, "cpu_ms"))
+    return regressions
+
+
+def print_comparison(base, head, regressions):
+    flagged = set(regressions)
+    print(f"[{base['label']} -> {head['label']}]")
+    print(f"  {'route':<12} {'metric':<8} {'base':>9} {'head':>9} {'ratio':>7}")
+    for name, b in base["routes"].items():
+        h = head["routes"].get(name)
+        if h is None:
+            print(f"  {name:<12} (head にありません)")
+            continue
+        rows = [(m, b[m], h[m]) for m in LATENCY_METRICS + ("rps", "errors")]
+        profile_b, profile_h = (base.get("profiles") or {}).get(name), (head.get("profiles") or {}).get(name)
+        if profile_b and profile_h:
+            rows += [("cpu_ms", profile_b["cpu_ms"], profile_h["cpu_ms"]), ("peak_kb", profile_b["peak_alloc_kb"], profile_h["peak_alloc_kb"])]
+        for metric, before, after in rows:
+            ratio = f"{after / before:.2f}x" if before else "-"
+            mark = "  REGRESSION" if (name, metric) in flagged else ""
+            print(f"  {name:<12} {metric:<8} {before:>9.1f} {after:>9.1f} {ratio:>7}{mark}")
+    print(f"  {'total':<12} {'cpu_s':<8} {base['cpu_s']:>9.1f} {head['cpu_s']:>9.1f}")
+    for key in sorted(set(base["upstream"]) | set(head["upstream"])):
+        before, after = base["upstream"].get(key, 0), head["upstream"].get(key, 0)
+        if before or after:
+            print(f"  {'upstream':<12} {key:<8} {before:>9} {after:>9}")
+    if regressions:
+        print(f"悪化: {len(regressions)} 件 ({', '.join(f'{n}.{m}' for n, m in regressions)})")
+    else:
+        print("悪化なし")
+
+
+def load_result(path):
+    """run --out の結果を読む (compare --out の結果なら head 側を使う)"""
+    with open(path, encoding="utf-8") as f:
+        result = json.load(f)
+    return result["head"] if "routes" not in result and "head" in result else result
+
+
+def compare(args):
+    if args.results:
+        base, head = load_result(args.results[0]), load_result(args.results[1])
+    else:
+        if not args.trace or not args.base:
+            raise SystemExit("compare にはトレースと --base (または --results A B) が必要です")
+        with tempfile.TemporaryDirectory() as tmp:
+            base_dir = export_api(args.base, os.path.join(tmp, "base"))
+            head_dir = export_api(args.head, os.path.join(tmp, "head")) if args.head else API_DIR
+            head_label = args.head or "current"
+            base_runs, head_runs = [], []
+            # 時間による揺らぎが片方に偏らないよう、交互に再生する
+            for i in range(args.runs):
+                profile = args.profile if i == 0 else None
+                base_runs.append(run_once(args.trace, base_dir, args, args.base, profile))
+                head_runs.append(run_once(args.trace, head_dir, args, head_label, profile))
+            base = summarize(args.base, base_dir, args, base_runs)
+            head = summarize(head_label, head_dir, args, head_runs)
+        report(base)
+        report(head)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump({"base": base, "head": head}, f, ensure_ascii=False, indent=2)
+    regressions = find_regressions(base, head, args.threshold, args.min_ms)
+    print_comparison(base, head, regressions)
+    return 1 if regressions else 0
+
+# --------------------------
+# コマンドライン
+# --------------------------
+
+def add_replay_arguments(parser):
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync", help="sync: Flask (スレッド) / async: ASGI (hypercorn)")
+    parser.add_argument("--threads", type=int, default=8, help="sync モードのワーカースレッド数")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度 (2 でトレースの2倍の速さで送る)")
+    parser.add_argument("--concurrency", type=int, default=256, help="同時に送るリクエストの上限")
+    parser.add_argument("--runs", type=int, default=1, help="再生する回数 (百分位数はすべての回から求める)")
+    parser.add_argument("--no-blob", action="store_true", help="Blob を使わず、ローカルのペルソナで再生する")
+    parser.add_argument("--profile", metavar="DIR", help="ルートごとの CPU・メモリ割り当てのプロファイルの出力先")
+    parser.add_argument("--profile-samples", type=int, default=5, help="プロファイルを取るルートごとの件数")
+    parser.add_argument("--out", help="結果の JSON の出力先")
+    standins.add_arguments(parser)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--serve", choices=["sync", "async"], help=argparse.SUPPRESS)
+    parser.add_argument("--profile-child", help=argparse.SUPPRESS)
+    parser.add_argument("--api-dir", default=API_DIR, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--serve-threads", type=int, default=8, help=argparse.SUPPRESS)
+    parser.add_argument("--child-samples", type=int, default=5, help=argparse.SUPPRESS)
+    parser.add_argument("--child-out", help=argparse.SUPPRESS)
+    commands = parser.add_subparsers(dest="command")
+
+    p = commands.add_parser("record", help="トレースを作る")
+    source = p.add_mutually_exclusive_group(required=True)
+    source.add_argument("--log", help="リクエストログ (REQUEST_LOG の出力)")
+    source.add_argument("--synthetic", type=int, metavar="N", help="ルートの比率と到着レートから N 件作る")
+    p.add_argument("--rate", type=float, default=5.0, help="--synthetic (と到着時刻のないログ) の到着レート (件/秒)")
+    p.add_argument("--mix", default=DEFAULT_MIX, help=f"--synthetic のルートの比率 (既定: {DEFAULT_MIX})")
+    p.add_argument("--corpus", help="本文に使う文章の JSONL (例: requests.jsonl)")
+    p.add_argument("--reuse", type=float, default=0.3, help="以前と同じプロンプト・文を繰り返す割合")
+    p.add_argument("--persona-chars", type=int, default=4000, help="追加・更新するペルソナの最大文字数")
+    p.add_argument("--personalities", default=os.path.join(ROOT, "personalities"), help="参照するペルソナのディレクトリ")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("-o", "--output", default="trace.jsonl")
+
+    p = commands.add_parser("run", help="トレースを再生する")
+    p.add_argument("trace")
+    p.add_argument("--ref", help="作業ツリーの代わりに再生するコミット")
+    add_replay_arguments(p)
+
+    p = commands.add_parser("compare", help="2つのコミット (または結果の JSON) を比べる")
+    p.add_argument("trace", nargs="?")
+    p.add_argument("--base", help="基準のコミット (例: HEAD~1)")
+    p.add_argument("--head", help="比べるコミット (省略時は作業ツリー)")
+    p.add_argument("--results", nargs=2, metavar=("BASE_JSON", "HEAD_JSON"), help="run (または compare) --out の結果どうしを比べる")
+    p.add_argument("--threshold", type=float, default=0.1, help="悪化とみなす割合 (0.1 = 10%%)")
+    p.add_argument("--min-ms", type=float, default=5.0, help="悪化とみなす最小の差 (ms)")
+    add_replay_arguments(p)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.api_dir, args.port, args.serve_threads)
+    elif args.profile_child:
+        profile_routes(args.api_dir, args.profile_child, args.child_samples, args.child_out)
+    elif args.command == "record":
+        record(args)
+    elif args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        sys.exit(compare(args))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
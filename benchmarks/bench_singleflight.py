@@ -0,0 +1,95 @@
+"""同じ処理の同時実行をまとめる (single flight) ベンチマーク
+
+複数のタブ・利用者が同時に同じ文の読み上げとペルソナ一覧を要求した場合を想定し、
+スレッドから get_ada_voice() と persona_registry.get_all() を一斉に呼ぶ。
+Fish Audio とペルソナの読み込みは --latency 秒かかるスタブに置き換え、
+まとめない場合 (off) とまとめる場合 (on) の外部APIの呼び出し回数と所要時間を比較する。
+
+使い方:
+    python benchmarks/bench_singleflight.py --clients 50 --texts 5 --latency 0.3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+
+class Passthrough:
+    """まとめずに毎回実行する (off)"""
+
+    def do(self, key, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+def burst(clients, func):
+    """clients 件を同時に呼び始め、全件終わるまでの時間を返す"""
+    start_gate = threading.Barrier(clients)
+
+    def client(i):
+        start_gate.wait()
+        return func(i)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(client, range(clients)))
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50, help="同時に呼ぶ数")
+    parser.add_argument("--texts", type=int, default=5, help="読み上げる文の種類")
+    parser.add_argument("--latency", type=float, default=0.3, help="スタブの応答時間 (秒)")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ.update(REQUEST_LOG="false", LOG_LEVEL="ERROR", TTS_CACHE_DIR=os.path.join(tmp, "tts_cache"))
+    os.environ.pop("BLOB_READ_WRITE_TOKEN", None)
+    import index
+
+    index.FISH_AUDIO_TOKEN = "bench"
+    counts = {"tts": 0, "persona_load": 0}
+    counts_lock = threading.Lock()
+
+    def fake_request(method, url, **kwargs):
+        with counts_lock:
+            counts["tts"] += 1
+        time.sleep(args.latency)
+        return types.SimpleNamespace(content=b"ID3" + kwargs["json"]["text"].encode())
+
+    load_personalities = index.load_personalities
+
+    def slow_load(*a, **kw):
+        with counts_lock:
+            counts["persona_load"] += 1
+        time.sleep(args.latency)
+        return load_personalities(*a, **kw)
+
+    index.fish_audio_upstream.request = fake_request
+    index.load_personalities = slow_load
+    tts_flight, persona_flight = index.tts_flight, index.persona_registry._flight
+
+    print(f"clients={args.clients} texts={args.texts} latency={args.latency}s")
+    print(f"  {'':<8} {'tts calls':>10} {'tts [s]':>8} {'loads':>6} {'load [s]':>9}")
+    for label, flights in (("off", (Passthrough(), Passthrough())), ("on", (tts_flight, persona_flight))):
+        index.tts_flight, index.persona_registry._flight = flights
+        # 音声キャッシュに当たらないよう、文は off と on で変える
+        index.persona_registry.invalidate()
+        counts.update(tts=0, persona_load=0)
+        t_tts, audio = burst(args.clients, lambda i: index.get_ada_voice(f"{label}: 文{i % args.texts}です。"))
+        t_load, loaded = burst(args.clients, lambda i: len(index.persona_registry.get_all()))
+        assert all(audio) and len(set(loaded)) == 1
+        print(f"  {label:<8} {counts['tts']:>10} {t_tts:>8.2f} {counts['persona_load']:>6} {t_load:>9.2f}")
+    for name, stats in index.singleflight.stats().items():
+        if stats["calls"]:
+            print(f"  {name}: coalesced {stats['coalesced']}/{stats['calls']} (rate {stats['coalescing_rate']})")
+
+
+if __name__ == "__main__":
+    main()
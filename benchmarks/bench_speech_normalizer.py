@@ -0,0 +1,113 @@
+"""音声用テキスト変換 (markdown_to_plaintext) のベンチマーク
+
+以前の実装 (re.sub を十数回適用) と新しい実装、逐次変換 (SpeechNormalizer) の所要時間を比較する。
+出力の確認 (期待値を明示したケース・以前の実装との一致) は tests/test_speech_normalizer.py で行う。
+
+使い方:
+    python benchmarks/bench_speech_normalizer.py --repeat 200
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+import index  # noqa: E402
+
+
+def legacy_convert_times_for_speech(text):
+    text = re.sub(r"(\d{1,2}):(\d{2})\s*[-–〜~]\s*(\d{1,2}):(\d{2})", lambda m: index.convert_time_range(m), text)
+    text = re.sub(r"(?<!\d)(\d{1,2}):(\d{2})(?!\d)", lambda m: index.convert_single_time(m), text)
+    return text
+
+
+def legacy_markdown_to_plaintext(md_text):
+    """以前の実装 (インラインコードの結果を捨ててしまう不具合もそのまま)"""
+    if not md_text:
+        return ""
+    text = re.sub(r'`(.*?)`', r'\1', md_text, flags=re.DOTALL)
+    text = re.sub(r'```.*?```', '', md_text, flags=re.DOTALL)
+    text = re.sub(r'^[*-+]\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+    text = re.sub(r'\*(.*?)\*', r'\1', text)
+    text = re.sub(r'__\s*(.*?)\s*__', r'\1', text)
+    text = re.sub(r'\[(.*?)\]\((.*?)\)', r'\1', text)
+    text = re.sub(r'^[#]+\s*', '', text, flags=re.MULTILINE)
+    text = re.sub(r'<[^>]+>', '', text)
+    text = legacy_convert_times_for_speech(text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+
+UNITS = "|".join(re.escape(unit) for unit in sorted(index.SPEECH_UNITS, key=len, reverse=True))
+
+REPLY_TEMPLATE = """# {title}
+
+こんにちは！今日は**{title}**について説明します。*重要な点*を順番に見ていきましょう。
+
+* 最初のポイントは 10:30-11:00 の会議で話し合います。
+* 次に、[公式ドキュメント](http://example.invalid/docs)を確認してください。
++ __まとめ__ は 14:00 に共有します。
+
+## 詳細
+
+{body}
+
+第3話は 2024 年の放送で、全12話のうち7話目までが前半です。
+
+<b>以上</b>です。ご質問があればどうぞ。
+"""
+
+
+def build_corpus():
+    """ペルソナファイルの本文から長い応答を作る (以前の実装と同じ出力になる構文のみ)"""
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "personalities", "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            body = json.load(f).get("system_instruction", "")
+        # 新しい規則 (日付・単位・URL・絵文字) の対象になる表記は比較対象から外す (数字そのものは残す)
+        body = re.sub(r"https?://\S+|[`\-+]|[\U0001F000-\U0001FAFF☀-➿]", "", body)
+        body = re.sub(r"\d{4}[/年]\d{1,2}[/月]\d{1,2}|(?<=\d)[ \t]*(?:" + UNITS + ")", "", body)
+        title = os.path.splitext(os.path.basename(path))[0]
+        corpus.append(REPLY_TEMPLATE.format(title=title, body=body))
+    return corpus
+
+
+def bench(func, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            func(text)
+    return (time.perf_counter() - start) / (repeat * len(texts))
+
+
+def stream_all(text):
+    normalizer = index.SpeechNormalizer()
+    for i in range(0, len(text), 40):
+        normalizer.feed(text[i:i + 40])
+    normalizer.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    corpus = build_corpus()
+    sizes = ", ".join(str(len(t)) for t in corpus)
+    print(f"replies: {len(corpus)} (chars: {sizes})")
+    legacy = bench(legacy_markdown_to_plaintext, corpus, args.repeat)
+    current = bench(index.markdown_to_plaintext, corpus, args.repeat)
+    streamed = bench(stream_all, corpus, args.repeat)
+    print(f"legacy   : {legacy * 1e6:8.1f} us/reply")
+    print(f"current  : {current * 1e6:8.1f} us/reply ({legacy / current:.2f}x)")
+    print(f"streamed : {streamed * 1e6:8.1f} us/reply (40文字ずつ SpeechNormalizer に入力)")
+
+
+if __name__ == "__main__":
+    main()
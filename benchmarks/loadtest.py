@@ -0,0 +1,273 @@
+"""同期 (Flask) と非同期 (ASGI) の負荷試験
+
+Gemini と Fish Audio のモックをローカルに立て、それぞれのモードでアプリを起動して
+/api/chat と /api/tts に同時接続で負荷をかけ、p50/p99 のレイテンシとスループットを表示する。
+
+- sync : index.app を固定数のスレッドで動かすWSGIサーバー (gunicorn の gthread 相当)
+- async: api/asgi.py の app を hypercorn で動かす
+
+使い方:
+    pip install -r requirements-asgi.txt
+    python benchmarks/loadtest.py --requests 400 --concurrency 200 --threads 8
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+import httpx
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+API_DIR = os.path.join(ROOT, "api")
+
+# --------------------------
+# 外部APIのモック
+# --------------------------
+
+class UpstreamMockHandler(BaseHTTPRequestHandler):
+    """Gemini (generateContent / streamGenerateContent) と Fish Audio (/v1/tts) のモック"""
+
+    protocol_version = "HTTP/1.1"
+    gemini_latency = 0.5
+    tts_latency = 0.8
+    stream_chunks = 5
+    reply_text = "こんにちは。これはモックの応答です。"
+    audio = b"\xff\xfb\x90\x00" * 4096
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        if self.path.startswith("/v1/tts"):
+            time.sleep(self.tts_latency)
+            self._send(200, "audio/mpeg", self.audio)
+        elif ":streamGenerateContent" in self.path:
+            self._stream_generate()
+        elif ":generateContent" in self.path:
+            time.sleep(self.gemini_latency)
+            self._send(200, "application/json", json.dumps(self._gemini_body(self.reply_text)).encode())
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    def _gemini_body(self, text):
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}
+
+    def _stream_generate(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for _ in range(self.stream_chunks):
+            time.sleep(self.gemini_latency / self.stream_chunks)
+            self.wfile.write(f"data: {json.dumps(self._gemini_body(self.reply_text))}\r\n\r\n".encode())
+            self.wfile.flush()
+        self.close_connection = True
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_upstream_mock(gemini_latency, tts_latency):
+    UpstreamMockHandler.gemini_latency = gemini_latency
+    UpstreamMockHandler.tts_latency = tts_latency
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamMockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# --------------------------
+# アプリの起動 (子プロセス側)
+# --------------------------
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """固定数のスレッドでリクエストを処理するWSGIサーバー"""
+
+    request_queue_size = 1024
+
+    def __init__(self, *args, threads=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve(mode, port, threads):
+    sys.path.insert(0, API_DIR)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import index
+    # リクエストごとの print が計測に影響しないよう標準出力を捨てる
+    sys.stdout = open(os.devnull, "w")
+    if mode == "sync":
+        server = PooledWSGIServer(("127.0.0.1", port), QuietHandler, threads=threads)
+        server.set_app(index.app)
+        server.serve_forever()
+    else:
+        import asgi
+        from hypercorn.asyncio import serve as hypercorn_serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        config.backlog = 1024
+        config.accesslog = None
+        config.errorlog = None
+        asyncio.run(hypercorn_serve(asgi.app, config))
+
+# --------------------------
+# 負荷をかける側
+# --------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def launch(mode, upstream_url, threads, cache_dir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        GOOGLE_API_KEY="loadtest-dummy",
+        GEMINI_BASE_URL=upstream_url,
+        FISH_AUDIO_TOKEN="loadtest-dummy",
+        FISH_AUDIO_API_URL=f"{upstream_url}/v1/tts",
+        TTS_CACHE_DIR=cache_dir,
+        BLOB_READ_WRITE_TOKEN="",
+        LOG_LEVEL="WARNING",
+        REQUEST_LOG="false",
+    )
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", mode, "--port", str(port), "--threads", str(threads)],
+        cwd=ROOT, env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{base_url}/api/personalities", timeout=1).status_code == 200:
+                return proc, base_url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"{mode} サーバーが起動しませんでした")
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def drive(base_url, total, concurrency, run_id):
+    """chat と tts を交互に total 件、同時に concurrency 件まで送る"""
+    latencies = {"/api/chat": [], "/api/tts": []}
+    errors = {"/api/chat": 0, "/api/tts": 0}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def one(i):
+            route = "/api/chat" if i % 2 == 0 else "/api/tts"
+            # 毎回違う内容にして音声キャッシュに当たらないようにする
+            body = {"prompt": f"質問 {run_id}-{i}"} if route == "/api/chat" else {"text": f"読み上げ {run_id}-{i}。"}
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    r = await client.post(route, json=body)
+                    ok = r.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                elapsed = time.perf_counter() - start
+            if ok:
+                latencies[route].append(elapsed)
+            else:
+                errors[route] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        wall = time.perf_counter() - start
+    return latencies, errors, wall
+
+
+def report(mode, latencies, errors, wall):
+    done = sum(len(v) for v in latencies.values())
+    print(f"[{mode}] {done} ok / {sum(errors.values())} errors in {wall:.2f}s -> {done / wall:.1f} req/s")
+    for route, values in latencies.items():
+        if values:
+            print(
+                f"  {route:<10} n={len(values):<5} p50={percentile(values, 50) * 1000:7.0f}ms "
+                f"p99={percentile(values, 99) * 1000:7.0f}ms mean={statistics.mean(values) * 1000:7.0f}ms "
+                f"errors={errors[route]}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8, help="sync モードのワーカースレッド数")
+    parser.add_argument("--gemini-latency", type=float, default=0.5)
+    parser.add_argument("--tts-latency", type=float, default=0.8)
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"], choices=["sync", "async"])
+    parser.add_argument("--serve", choices=["sync", "async"], help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.threads)
+        return
+
+    upstream = start_upstream_mock(args.gemini_latency, args.tts_latency)
+    upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}"
+    print(
+        f"requests={args.requests} concurrency={args.concurrency} sync_threads={args.threads} "
+        f"gemini={args.gemini_latency}s tts={args.tts_latency}s"
+    )
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            proc, base_url = launch(mode, upstream_url, args.threads, cache_dir)
+            try:
+                latencies, errors, wall = asyncio.run(drive(base_url, args.requests, args.concurrency, mode))
+                report(mode, latencies, errors, wall)
+            finally:
+                proc.terminate()
+                proc.wait()
+    upstream.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""Gemini・Fish Audio・Vercel Blob のローカルのスタンドイン (ベンチマーク用)
+
+1つの HTTP サーバーで3つの外部APIの代わりをする。応答時間と応答のサイズは分布 (Distribution) で指定する。
+
+- Gemini    : POST .../models/<model>:generateContent / :streamGenerateContent (SSE) / .../cachedContents
+              応答の文字数を --gemini-chars から取り、最初のトークンまで --gemini-ttft 秒、
+              その後は --gemini-cps 文字/秒で生成したものとして返す
+              (systemInstruction のないリクエストはペルソナ名の生成とみなし、短い名前を返す)
+- Fish Audio: POST /v1/tts (--tts-latency 秒後に、テキストの文字数 × --tts-bytes-per-char バイトの音声を返す)
+- Blob      : GET /blob/<pathname> と、install_blob_client() で差し替える vercel_blob の list / put / delete
+
+呼び出し回数はサービスごとに counts に数える。
+
+分布の書き方:
+    0.5 / const:0.5        常に 0.5
+    uniform:0.2,0.8        0.2〜0.8 の一様分布
+    lognormal:0.4,0.5      中央値 0.4、σ=0.5 の対数正規分布 (外部APIの応答時間に近い裾の長い分布)
+    exp:0.3                平均 0.3 の指数分布
+"""
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import types
+import urllib.parse
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Distribution:
+    """応答時間・サイズの分布 (文字列で指定する)"""
+
+    def __init__(self, spec):
+        self.spec = str(spec)
+        kind, _, params = self.spec.partition(":")
+        if not params:
+            kind, params = "const", kind
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",")]
+        expected = {"const": 1, "uniform": 2, "lognormal": 2, "exp": 1}.get(kind)
+        if expected is None or len(self.params) != expected:
+            raise ValueError(f"分布の指定が不正です: {spec}")
+
+    def sample(self, rng):
+        p = self.params
+        if self.kind == "const":
+            return p[0]
+        if self.kind == "uniform":
+            return rng.uniform(p[0], p[1])
+        if self.kind == "lognormal":
+            return rng.lognormvariate(math.log(p[0]), p[1])
+        return rng.expovariate(1 / p[0]) if p[0] > 0 else 0.0
+
+    def __str__(self):
+        return self.spec
+
+
+def add_arguments(parser):
+    """スタンドインの設定を argparse に追加する"""
+    group = parser.add_argument_group("スタンドイン (外部APIの代わり)")
+    group.add_argument("--gemini-ttft", type=Distribution, default=Distribution("lognormal:0.4,0.4"), help="最初のトークンまでの秒数")
+    group.add_argument("--gemini-chars", type=Distribution, default=Distribution("lognormal:600,0.6"), help="応答の文字数")
+    group.add_argument("--gemini-cps", type=float, default=400.0, help="生成速度 (文字/秒)")
+    group.add_argument("--tts-latency", type=Distribution, default=Distribution("lognormal:0.5,0.4"), help="音声合成の秒数")
+    group.add_argument("--tts-bytes-per-char", type=Distribution, default=Distribution("const:1000"), help="1文字あたりの音声のバイト数")
+    group.add_argument("--blob-latency", type=Distribution, default=Distribution("lognormal:0.03,0.5"), help="Blob の1リクエストの秒数")
+    group.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    return group
+
+
+# 応答の Markdown (見出し・段落・リスト・コードブロック) のひな形
+REPLY_BLOCKS = [
+    "## ポイント {i}\n\n",
+    "ご質問ありがとうございます。**{i}番目**の点について説明します。設定を確認し、`option_{i}` を有効にしてください。\n\n",
+    "- 手順 {i}-1 を行う\n- 手順 {i}-2 を確認する\n- 必要なら *再起動* する\n\n",
+    "```python\nresult_{i} = compute({i})\nprint(result_{i})\n```\n\n",
+    "以上で完了です。ほかに気になる点があれば、いつでも聞いてください。\n\n",
+]
+
+
+def make_reply(chars):
+    """chars 文字程度の Markdown の応答"""
+    parts, size, i = [], 0, 0
+    while size < chars:
+        block = REPLY_BLOCKS[i % len(REPLY_BLOCKS)].format(i=i)
+        parts.append(block)
+        size += len(block)
+        i += 1
+    return "".join(parts)[:max(1, int(chars))]
+
+
+class StandIns:
+    """3つの外部APIのスタンドイン (start() でサーバーを起動する)"""
+
+    def __init__(self, gemini_ttft, gemini_chars, gemini_cps, tts_latency, tts_bytes_per_char, blob_latency, seed=0):
+        self.gemini_ttft = gemini_ttft
+        self.gemini_chars = gemini_chars
+        self.gemini_cps = gemini_cps
+        self.tts_latency = tts_latency
+        self.tts_bytes_per_char = tts_bytes_per_char
+        self.blob_latency = blob_latency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.blobs = {} # { pathname: (data, uploadedAt) }
+        self.counts = {
+            "gemini_generate": 0, "gemini_stream": 0, "gemini_cache": 0, "tts": 0,
+            "blob_get": 0, "blob_list": 0, "blob_put": 0, "blob_delete": 0,
+        }
+        self.server = None
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.gemini_ttft, args.gemini_chars, args.gemini_cps, args.tts_latency,
+                   args.tts_bytes_per_char, args.blob_latency, args.seed)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        standins = self
+
+        class Handler(StandInHandler):
+            pass
+
+        Handler.standins = standins
+        ThreadingHTTPServer.request_queue_size = 1024
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def sample(self, distribution):
+        with self._lock:
+            return max(0.0, distribution.sample(self._rng))
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+    # ---- Blob ----
+
+    def blob_url(self, pathname):
+        return f"{self.url}/blob/{urllib.parse.quote(pathname)}"
+
+    def put_blob(self, pathname, data, add_random_suffix=False):
+        if add_random_suffix:
+            stem, dot, ext = pathname.rpartition(".")
+            pathname = f"{stem}_{uuid.uuid4().hex[:8]}.{ext}" if dot else f"{pathname}_{uuid.uuid4().hex[:8]}"
+        uploaded_at = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + f".{int(time.time() * 1000) % 1000:03d}Z"
+        with self._lock:
+            self.blobs[pathname] = (data, uploaded_at)
+        return {"url": self.blob_url(pathname), "pathname": pathname}
+
+    def seed_personas(self, personalities_dir):
+        """personalities ディレクトリの JSON を、以前の形式 (ルート直下の <名前>_<サフィックス>.json) で置く"""
+        for filename in sorted(os.listdir(personalities_dir)):
+            if filename.endswith(".json"):
+                with open(os.path.join(personalities_dir, filename), "rb") as f:
+                    self.put_blob(filename, f.read(), add_random_suffix=True)
+
+    def clear_blobs(self):
+        with self._lock:
+            self.blobs.clear()
+
+    def list_blobs(self, prefix="", cursor=None, limit=1000):
+        with self._lock:
+            names = sorted(name for name in self.blobs if name.startswith(prefix or ""))
+            start = int(cursor or 0)
+            page = names[start:start + limit]
+            blobs = [
+                {"pathname": name, "url": self.blob_url(name), "uploadedAt": self.blobs[name][1], "size": len(self.blobs[name][0])}
+                for name in page
+            ]
+        has_more = start + limit < len(names)
+        return {"blobs": blobs, "hasMore": has_more, "cursor": str(start + limit) if has_more else None}
+
+    def delete_blobs(self, urls):
+        urls = set(urls)
+        with self._lock:
+            for name in [name for name in self.blobs if self.blob_url(name) in urls]:
+                del self.blobs[name]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    standins = None
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path.startswith("/blob/"):
+            self._blob_delay("blob_get")
+            with self.standins._lock:
+                blob = self.standins.blobs.get(urllib.parse.unquote(path[len("/blob/"):]))
+            if blob is None:
+                self._send(404, "text/plain", b"not found")
+            else:
+                self._send(200, "application/json", blob[0])
+        elif path == "/blob-api/list":
+            self._blob_delay("blob_list")
+            params = dict(urllib.parse.parse_qsl(query))
+            listed = self.standins.list_blobs(params.get("prefix", ""), params.get("cursor"), int(params.get("limit") or 1000))
+            self._send_json(listed)
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    def do_HEAD(self):
+        # 接続の事前確立 (TTS_WARM_CONNECTIONS) 用
+        self._send(200, "text/plain", b"")
+
+    def do_PUT(self):
+        path, _, query = self.path.partition("?")
+        body = self._read_body()
+        if path == "/blob-api/put":
+            self._blob_delay("blob_put")
+            params = dict(urllib.parse.parse_qsl(query))
+            self._send_json(self.standins.put_blob(params["pathname"], body, params.get("addRandomSuffix") == "true"))
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    def do_POST(self):
+        path = self.path.partition("?")[0]
+        body = self._read_body()
+        if path == "/blob-api/delete":
+            self._blob_delay("blob_delete")
+            self.standins.delete_blobs(json.loads(body)["urls"])
+            self._send_json({})
+        elif path.startswith("/v1/tts"):
+            self._tts(json.loads(body or b"{}"))
+        elif path.endswith(":streamGenerateContent"):
+            self._gemini_stream(json.loads(body or b"{}"))
+        elif path.endswith(":generateContent"):
+            self._gemini_generate(json.loads(body or b"{}"))
+        elif path.endswith("/cachedContents"):
+            self.standins.count("gemini_cache")
+            time.sleep(self.standins.sample(self.standins.gemini_ttft))
+            self._send_json({"name": f"cachedContents/{uuid.uuid4().hex[:12]}", "model": "models/stand-in"})
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    # ---- Gemini ----
+
+    def _reply_text(self, request_body):
+        if "systemInstruction" not in request_body and "cachedContent" not in request_body:
+            return f"ペルソナ{uuid.uuid4().hex[:4]}" # 名前の生成
+        return make_reply(self.standins.sample(self.standins.gemini_chars))
+
+    @staticmethod
+    def _gemini_body(text):
+        return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}
+
+    def _gemini_generate(self, request_body):
+        self.standins.count("gemini_generate")
+        text = self._reply_text(request_body)
+        time.sleep(self.standins.sample(self.standins.gemini_ttft) + len(text) / self.standins.gemini_cps)
+        self._send_json(self._gemini_body(text))
+
+    def _gemini_stream(self, request_body, chunk_chars=40):
+        self.standins.count("gemini_stream")
+        text = self._reply_text(request_body)
+        time.sleep(self.standins.sample(self.standins.gemini_ttft))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i in range(0, len(text), chunk_chars):
+            if i:
+                time.sleep(chunk_chars / self.standins.gemini_cps)
+            piece = text[i:i + chunk_chars]
+            self.wfile.write(f"data: {json.dumps(self._gemini_body(piece), ensure_ascii=False)}\r\n\r\n".encode())
+            self.wfile.flush()
+        self.close_connection = True
+
+    # ---- Fish Audio ----
+
+    def _tts(self, request_body):
+        self.standins.count("tts")
+        time.sleep(self.standins.sample(self.standins.tts_latency))
+        text = request_body.get("text", "")
+        size = int(len(text) * self.standins.sample(self.standins.tts_bytes_per_char))
+        fmt = request_body.get("format", "mp3")
+        header, content_type = {
+            "opus": (b"OggS", "audio/ogg"), "wav": (b"RIFF", "audio/wav"),
+        }.get(fmt, (b"ID3", "audio/mpeg"))
+        self._send(200, content_type, header + b"\x00" * max(0, size - len(header)))
+
+    # ---- 共通 ----
+
+    def _blob_delay(self, name):
+        self.standins.count(name)
+        time.sleep(self.standins.sample(self.standins.blob_latency))
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _send_json(self, data):
+        self._send(200, "application/json", json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def install_blob_client(base_url):
+    """vercel_blob モジュールを、スタンドインの Blob を使うもの (list / put / delete) に差し替える
+
+    api/index.py を import する前に呼ぶ (index.py は vercel_blob を初めて使うときに import する)。
+    """
+    def call(method, path, query=None, data=None):
+        url = f"{base_url}/blob-api/{path}" + (f"?{urllib.parse.urlencode(query)}" if query else "")
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method=method), timeout=30) as r:
+            return json.loads(r.read() or b"{}")
+
+    def blob_list(options=None):
+        options = {k: v for k, v in (options or {}).items() if v is not None}
+        return call("GET", "list", options)
+
+    def blob_put(pathname, body, options=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        options = options or {}
+        return call("PUT", "put", {"pathname": pathname, "addRandomSuffix": options.get("addRandomSuffix", "true")}, body)
+
+    def blob_delete(urls):
+        urls = [urls] if isinstance(urls, str) else list(urls)
+        return call("POST", "delete", data=json.dumps({"urls": urls}).encode("utf-8"))
+
+    module = types.ModuleType("vercel_blob")
+    module.list, module.put, module.delete = blob_list, blob_put, blob_delete
+    sys.modules["vercel_blob"] = module
+    return module
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# api/index.py をモジュールとして import できるようにする (リクエストごとのログは出さない)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+os.environ.setdefault("REQUEST_LOG", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
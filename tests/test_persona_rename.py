@@ -0,0 +1,28 @@
+"""ペルソナ名の変更 (rename_personality) のテスト"""
+import json
+import os
+
+import index
+
+
+def test_rename_does_not_overwrite_persona_saved_concurrently(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("personalities")
+    index.write_persona_json(os.path.join("personalities", "persona_x.json"), "仮の名前のペルソナ")
+    names = index.persona_registry.names()
+    # 一覧を読んだ後に、同じ名前のペルソナが別のリクエストで保存された場合
+    index.write_persona_json(os.path.join("personalities", "Taro.json"), "別のペルソナ")
+    (tmp_path / "personalities" / "Taro.index").write_text("{}", encoding="utf-8")
+    (tmp_path / "personalities" / "persona_x.index").write_text('{"old": 1}', encoding="utf-8")
+    monkeypatch.setattr(index.persona_registry, "names", lambda: names)
+
+    assert index.rename_personality("persona_x", "Taro") == "Taro_2"
+
+    def instruction(name):
+        with open(tmp_path / "personalities" / f"{name}.json", encoding="utf-8") as f:
+            return json.load(f)["system_instruction"]
+
+    assert instruction("Taro") == "別のペルソナ"
+    assert instruction("Taro_2") == "仮の名前のペルソナ"
+    assert (tmp_path / "personalities" / "Taro.index").read_text(encoding="utf-8") == "{}"
+    assert not (tmp_path / "personalities" / "persona_x.json").exists()
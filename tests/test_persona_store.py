@@ -0,0 +1,43 @@
+"""SQLite のペルソナストア (persona_store) のテスト"""
+import json
+
+import index
+import persona_store
+
+
+def write_json(path, data):
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+
+
+def test_iter_json_dir_skips_unreadable_files(tmp_path, caplog):
+    write_json(tmp_path / "Alice.json", {"system_instruction": "アリス", "voice": {"reference_id": "a"}})
+    (tmp_path / "Broken.json").write_text('{"system_instruction": "途中で', encoding="utf-8")
+    write_json(tmp_path / "List.json", ["オブジェクトではない"])
+    write_json(tmp_path / "Bob.json", {"system_instruction": "ボブ"})
+
+    voices = {}
+    assert list(persona_store.iter_json_dir(str(tmp_path), voices)) == [("Alice", "アリス"), ("Bob", "ボブ")]
+    assert voices == {"Alice": {"reference_id": "a"}}
+    assert "Broken.json" in caplog.text and "List.json" in caplog.text
+
+
+def test_get_persona_store_imports_around_malformed_json(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "personalities").mkdir()
+    write_json(tmp_path / "personalities" / "Alice.json", {"system_instruction": "アリス"})
+    (tmp_path / "personalities" / "Broken.json").write_text("{", encoding="utf-8")
+    monkeypatch.setattr(index, "PERSONA_STORE", "sqlite")
+    monkeypatch.setattr(index, "PERSONA_STORE_PATH", str(tmp_path / "personas.db"))
+    monkeypatch.setattr(index, "_persona_store", None)
+
+    store = index.get_persona_store()
+    assert store is not None
+    assert store.get_all() == {"Alice": "アリス"}
+
+
+def test_put_without_voice_keeps_existing_voice(tmp_path):
+    store = persona_store.PersonaStore(str(tmp_path / "personas.db"))
+    store.put("Alice", "アリス", voice={"reference_id": "a"})
+    store.put("Alice", "新しいアリス")
+    assert store.get("Alice") == "新しいアリス"
+    assert store.voices() == {"Alice": {"reference_id": "a"}}
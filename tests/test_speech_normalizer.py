@@ -0,0 +1,91 @@
+"""音声用テキスト変換 (markdown_to_plaintext / SpeechNormalizer / split_speech_sentences) のテスト"""
+import os
+import sys
+
+import pytest
+
+import index
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from bench_speech_normalizer import build_corpus, legacy_markdown_to_plaintext  # noqa: E402
+
+# 以前の実装と出力が変わる入力 (不具合の修正・新しい規則) の期待値
+GOLDEN_CASES = [
+    ("`code` と ```py\nprint(1)\n``` の後", "code と の後"),
+    ("- ハイフンの項目\n+ プラスの項目", "ハイフンの項目\nプラスの項目"),
+    ("# 手順\n\n- 材料を用意する\n\n混ぜます。", "手順\n材料を用意する\n混ぜます。"),
+    ("2024-03-05 と 2024/3/5", "2024年3月5日 と 2024年3月5日"),
+    ("5km 走って 3.5kg 減り 30% 達成 25℃", "5キロメートル 走って 3.5キログラム 減り 30パーセント 達成 25度"),
+    ("距離は5kmです", "距離は5キロメートルです"),
+    ("体重は3.5kg。気温25℃、約30%の人", "体重は3.5キログラム。気温25度、約30パーセントの人"),
+    ("100m走と型番A5m", "100メートル走と型番A5m"),
+    ("詳細は https://example.com/a?b=1 を参照", "詳細は を参照"),
+    ("楽しいですね😀✨", "楽しいですね"),
+    ("**[リンク](http://x) は 9:30**", "リンク は 9時30分"),
+    ("会議は 10:30-11:00 です", "会議は 10時30分から11時00分 です"),
+]
+
+CORPUS = build_corpus()
+
+
+def feed_all(pieces):
+    """チャンクを順に流し、finish() より前に確定した文と finish() で確定した文を返す"""
+    normalizer = index.SpeechNormalizer()
+    early = []
+    for piece in pieces:
+        early += index.split_speech_sentences(normalizer.feed(piece))
+    return early, index.split_speech_sentences(normalizer.finish())
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("text, expected", GOLDEN_CASES)
+def test_golden(text, expected):
+    assert index.markdown_to_plaintext(text) == expected
+
+
+@pytest.mark.parametrize("text", CORPUS, ids=lambda text: text.splitlines()[0])
+def test_matches_legacy_on_persona_replies(text):
+    # 新しい実装は行の区切りを改行として残すため、空白の違いは無視して比べる
+    assert " ".join(index.markdown_to_plaintext(text).split()) == legacy_markdown_to_plaintext(text)
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 40])
+@pytest.mark.parametrize("text", CORPUS + [text for text, _ in GOLDEN_CASES], ids=lambda text: text[:12])
+def test_incremental_feed_matches_whole_conversion(text, size):
+    # どこでチャンクが切れても、読み上げる文の並びは全体を一度に変換した場合と同じになる
+    early, rest = feed_all(chunked(text, size))
+    assert early + rest == index.split_speech_sentences(index.markdown_to_plaintext(text))
+
+
+def test_sentences_in_one_paragraph_are_spoken_before_finish():
+    text = "こんにちは。今日は**良い天気**ですね！散歩に行きましょうか？それでは"
+    early, rest = feed_all(chunked(text, 3))
+    assert early == ["こんにちは。", "今日は良い天気ですね！", "散歩に行きましょうか？"]
+    assert rest == ["それでは"]
+
+
+def test_unfinished_markup_and_fences_are_held_back():
+    early, rest = feed_all(["**強調の。", "途中**です。\n", "```py\nprint('a。')", "\n```\n終わり。"])
+    assert early == ["強調の。", "途中です。"]
+    assert rest == ["終わり。"]
+
+
+def test_closing_bracket_split_across_chunks_stays_with_its_sentence():
+    early, rest = feed_all(["彼は「本当？", "」と聞いた。次"])
+    assert early == ["彼は「本当？」", "と聞いた。"]
+    assert rest == ["次"]
+
+
+def test_ascii_question_mark_in_url_does_not_split():
+    early, rest = feed_all(["詳細は https://example.com/a?b=1", " を参照! 次"])
+    assert early == ["詳細は を参照!"]
+    assert rest == ["次"]
+
+
+def test_fence_opened_mid_line_is_held_until_closed():
+    early, rest = feed_all(["`code` と ```py\nprint('a。')\n", "``` の後。\n"])
+    assert early == ["code と の後。"]
+    assert rest == []